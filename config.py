@@ -33,6 +33,15 @@ PORT = 8000
 # configuration. If SERVER_MODE is False it must be used only in localhost.
 SERVER_MODE = False
 
+# Load the whole search index in RAM at startup (useful in server mode, if the machine has
+# plenty of memory), decompressing beforehand this quantity of its most important pages
+INDEX_IN_MEMORY = False
+INDEX_HOT_PAGES = 200
+
+# Maximum time (in milliseconds) for searching in the text of the articles, when few titles
+# are found (only if the image type indexed that text, which may change this value)
+INDEX_FULLTEXT_LATENCY = 200
+
 # Nombre de la edicion especial, modifica el INDEX y ASSETS en código
 EDICION_ESPECIAL = None
 # EDICION_ESPECIAL = "educar"
@@ -77,6 +86,16 @@ BROWSER_WD_SECONDS = 120
 # Quantity of default search results per page
 SEARCH_RESULTS = 20
 
+# Maximum size (in MB) of the results of the last searches kept in memory, and if they are
+# saved (in a temporary directory) when closing, to have them at the next start
+SEARCH_CACHE_SIZE = 8
+SEARCH_CACHE_PERSIST = False
+
+# Maximum size (in MB) of the last articles read kept in memory (already decompressed),
+# in a normal installation and in server mode
+ARTICLES_CACHE_SIZE = 4
+ARTICLES_CACHE_SIZE_SERVER = 64
+
 # info para el compresor / decompresor
 ARTICLES_PER_BLOCK = 2000
 DIR_PAGES_BLOCKS = "temp/pages"
@@ -89,6 +108,14 @@ DIR_TEMP = "temp"
 # Donde irán los archivos del índice
 DIR_INDICE = "temp/indice"
 
+# Quantity of shards in which the postings of the index are split, to search in them in
+# parallel (useful for big indexes in server mode, the postings are stored twice)
+INDEX_SHARDS = 1
+
+# Update the index of the previous run with the articles added, removed and rescored since
+# then, instead of recreating it
+INDEX_INCREMENTAL = False
+
 # Directorio destino de los archivos preprocesados.
 DIR_PREPROCESADO = DIR_TEMP + "/preprocesado"
 
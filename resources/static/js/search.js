@@ -1,75 +1,52 @@
-
 $(document).ready(function() {
 
-    $.ajaxSetup({
-          cache: false
-    });
-
-    var search_string = "";
-    var buscando = "buscando";
-    var esperando = "generando índice"
-    var index_ready = false;
-    var get_resultados = function () {
-        var status="NOTDONE";
+    // suggest articles while the user writes in the search box
+    var input = $("#searchInput");
+    var suggestions = $('<ul id="search-suggestions"></ul>').hide();
+    input.attr("autocomplete", "off").after(suggestions);
 
-        var res_completa="";
-        var res_detallada="";
-
-        $.get('/ajax/buscar/resultado', function(data) {
-                var html;
-                status = data.status;
-                res_completa = $.fn.base64Decode(data.res_completa);
-                res_detallada = $.fn.base64Decode(data.res_detallada);
-                if (status == "NOTDONE")
-                {
-                    setTimeout(get_resultados, 500);
-                    buscando += ".";
-                    html = "<h2>Resultados para: "+search_string+"</h2>"+"<i>"+buscando+"</i><br/>"+res_completa + res_detallada;
-                }
-                else{
-                    buscando = "";
-                    if (res_detallada === "" && res_completa === "")
-                        {html = "<h2>No se encontró nada para lo ingresado!</h2>";}
-                    else
-                        {html = "<h2>Resultados para: "+search_string+"</h2><br/>"+res_completa + res_detallada;}
-                }
-                $("#content").html(html);
+    var timer = null;
+    var last_text = "";
 
+    var show_suggestions = function(data) {
+        suggestions.empty();
+        $.each(data, function(i, item) {
+            var link = $("<a></a>").attr("href", item.link).text(item.title);
+            suggestions.append($("<li></li>").append(link));
         });
+        if (data.length) {
+            suggestions.show();
+        } else {
+            suggestions.hide();
+        }
     };
 
-    var index_is_ready = function(on_ready){
-        $.get('/search_index/ready', function(data) {
-            if (data===true){
-                index_ready = true;
-                if (on_ready){
-                    esperando = "generando índice";
-                    on_ready();
-                }
-            }
-            else{
-                esperando += ".";
-                $("#content").html('<h1><font color="#0000cc" size="+1">Por favor, aguarde mientras CDpedia termina de cargar el índice</font></h1><br/>'+"<i>"+esperando+"</i>");
-                setTimeout(index_is_ready, 1000, buscar);
+    var suggest = function() {
+        var text = $.trim(input.val());
+        if (text === last_text) {
+            return;
+        }
+        last_text = text;
+        if (!text) {
+            suggestions.hide();
+            return;
+        }
+        $.getJSON("/search/suggest", {q: text}, function(data) {
+            // discard answers for texts that are not the current one
+            if (text === last_text) {
+                show_suggestions(data);
             }
         });
     };
 
-    var buscar = function(){
-        $.get('/ajax/buscar', {keywords:search_string});
-        buscando = "buscando";
-        setTimeout(get_resultados,500);
-        $("#content").html("<h2>Resultados para: "+search_string+"</h2> <br/> <i>buscando</i><br/>");
-    };
+    input.keyup(function() {
+        clearTimeout(timer);
+        timer = setTimeout(suggest, 150);
+    });
 
-    /*
-    $("#search-form").submit(function(event){
-        event.preventDefault();
-        search_string = $("#searchInput").val();
-        if (search_string){
-            index_is_ready(buscar);
-        }
+    input.blur(function() {
+        // let a click on a suggestion happen before hiding them
+        setTimeout(function() { suggestions.hide(); }, 200);
     });
-    */
 
 });
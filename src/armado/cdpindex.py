@@ -18,15 +18,16 @@
 
 import base64
 import config
+import itertools
 import logging
 import os
-import re
 import shutil
 import threading
+import time
 import urllib.parse
 from collections import defaultdict
 
-from .sqlite_index import Index, normalize_words
+from .sqlite_index import Index, normalize_many, normalize_words
 
 
 logger = logging.getLogger(__name__)
@@ -40,11 +41,15 @@ class IndexInterface(threading.Thread):
      - link: the path to the file
      - title: the article's title
      - score: to weight the relative importance of each article
+
+    If in_memory, the whole index is copied to RAM and its most important pages are
+    decompressed beforehand, so searches don't depend on the disk latency.
     """
-    def __init__(self, directory):
+    def __init__(self, directory, in_memory=False):
         super(IndexInterface, self).__init__()
         self.ready = threading.Event()
         self.directory = directory
+        self.in_memory = in_memory
         self.daemon = True
 
     def is_ready(self):
@@ -52,7 +57,13 @@ class IndexInterface(threading.Thread):
 
     def run(self):
         """Starts the index."""
-        self.index = Index(self.directory)
+        initial_time = time.time()
+        self.index = Index(self.directory, in_memory=self.in_memory,
+                           fulltext_latency=config.INDEX_FULLTEXT_LATENCY / 1000)
+        if self.index.in_memory:
+            pages = self.index.warm_up(config.INDEX_HOT_PAGES)
+            logger.info("Index loaded in memory in %.2f seconds: %d MB, %d pages decompressed",
+                        time.time() - initial_time, self.index.memory_used() // 1024 ** 2, pages)
         self.ready.set()
 
     def listado_words(self):
@@ -71,10 +82,39 @@ class IndexInterface(threading.Thread):
         value = self.index.random()
         return value
 
-    def search(self, words):
+    def search(self, words, corrections=None):
         """Search whole words in the index."""
         self.ready.wait()
-        return self.index.search(words)
+        return self.index.search(words, corrections)
+
+    def search_ranked(self, words, corrections=None):
+        """Return the docids of the articles found for the words, from the best one."""
+        self.ready.wait()
+        return self.index.search_ranked(words, corrections)
+
+    def get_doc(self, docid):
+        """Return the article of a docid."""
+        self.ready.wait()
+        return self.index.get_doc(docid)
+
+    def version(self):
+        """Return the version of the index, which changes if it is rebuilt or updated."""
+        self.ready.wait()
+        return self.index.version
+
+    def did_you_mean(self, text, corrections=None):
+        """Return the text with its misspelled words corrected, or None if there are none."""
+        self.ready.wait()
+        return self.index.did_you_mean(text, corrections)
+
+    def suggest(self, text):
+        """Return the best articles with a word starting as the last word of the text."""
+        self.ready.wait()
+        return self.index.suggest(text)
+
+
+# chars that separate the tokens, besides the spaces
+_TOKEN_SEPARATORS = str.maketrans("_()", "   ")
 
 
 def tokenize(title):
@@ -86,9 +126,24 @@ def tokenize(title):
         - underscore
         - open and close parentheses
     """
-    normalized = normalize_words(title)
-    cleaned = re.sub(r'[_\(\)]', ' ', normalized)
-    return cleaned.split()
+    return normalize_words(title).translate(_TOKEN_SEPARATORS).split()
+
+
+def tokenize_many(titles):
+    """Yield the list of tokens of each title (see tokenize), normalizing many at once."""
+    for normalized in normalize_many(titles):
+        yield normalized.translate(_TOKEN_SEPARATORS).split()
+
+
+def article_text(link):
+    """Return the text of the body of an article, from its final HTML."""
+    # This isn't needed on the final user, so it is imported here
+    import bs4
+
+    with open(os.path.join(config.DIR_PAGSLISTAS, link), 'rb') as fh:
+        soup = bs4.BeautifulSoup(fh, features='lxml', from_encoding='utf-8')
+    node = soup.find('div', class_='mw-parser-output') or soup
+    return node.get_text(' ')
 
 
 def generate_from_html(dirbase, verbose):
@@ -99,10 +154,12 @@ def generate_from_html(dirbase, verbose):
     # make redirections
     # use a set to avoid duplicated titles after normalization
     redirs = defaultdict(set)
-    for line in open(config.LOG_REDIRECTS, "rt", encoding="utf-8"):
-        redir_article, orig_article = line.strip().split(config.SEPARADOR_COLUMNAS)
-        words = tokenize(redir_article)
-        redirs[orig_article].add(tuple(words))
+    with open(config.LOG_REDIRECTS, "rt", encoding="utf-8") as fh:
+        redirects, titles = itertools.tee(
+            line.strip().split(config.SEPARADOR_COLUMNAS) for line in fh)
+        all_words = tokenize_many(redir_article for redir_article, _ in titles)
+        for (redir_article, orig_article), words in zip(redirects, all_words):
+            redirs[orig_article].add(tuple(words))
 
     top_pages = preprocess.pages_selector.top_pages
 
@@ -120,18 +177,23 @@ def generate_from_html(dirbase, verbose):
             raise KeyError("Duplicated document in: {}".format(data))
         already_seen.add(data)
 
-    def gen():
-        for dir3, arch, pagerank in top_pages:
+    def get_score(pagerank):
+        """Give the title's words great score: 50 plus the original one divided by 1000."""
+        # the original score is used to tie-break
+        return 50 + pagerank // 1000
+
+    def gen(pages):
+        pages, titles = itertools.tee(pages)
+        all_words = tokenize_many(titles_texts[arch][0] for _, arch, _ in titles)
+        for (dir3, arch, pagerank), orig_words in zip(pages, all_words):
             # auxiliar info
             link = os.path.join(dir3, arch)
             title, description = titles_texts[arch]
             check_already_seen((title, link))
             logger.debug("Adding to index: [%r]  (%r)", title, link)
 
-            # give the title's words great score: 50 plus
-            # the original score divided by 1000, to tie-break
-            score = 50 + pagerank // 1000
-            orig_words = tuple(tokenize(title))
+            score = get_score(pagerank)
+            orig_words = tuple(orig_words)
 
             # pass words to the redirects which points to
             # this html file, using the same score
@@ -141,11 +203,54 @@ def generate_from_html(dirbase, verbose):
                 redirs[arch_orig].discard(orig_words)
                 redir_words = redirs[arch_orig]
             yield title, link, score, description, orig_words, redir_words
+
+    # the full text of the articles is indexed only for some image types
+    fulltext = config.imageconf.get('fulltext')
+    fulltext_size = fulltext_text = None
+    if fulltext:
+        fulltext_size = fulltext['max_size'] * 1024 ** 2
+        if fulltext.get('body'):
+            fulltext_text = article_text
+    typos = config.imageconf.get('typos', True)
+
+    # the previous index is updated only if it was created as the current one would be
+    params = {"fulltext_size": fulltext_size, "fulltext_body": fulltext_text is not None,
+              "shards": config.INDEX_SHARDS, "typos": typos}
+    previous_pages = preprocess.pages_selector.previous_pages
+    index_filename = os.path.join(config.DIR_INDICE, "index.sqlite")
+    incremental = config.INDEX_INCREMENTAL and previous_pages and os.path.exists(index_filename)
+    if incremental:
+        previous_params = Index.stored_params(config.DIR_INDICE)
+        if previous_params != params:
+            logger.info("The index is created again, as its parameters changed from %s to %s",
+                        previous_params, params)
+            incremental = False
+
+    if incremental:
+        # apply to the previous index the differences between both runs
+        previous = {os.path.join(dir3, arch): pagerank for dir3, arch, pagerank in previous_pages}
+        current = set()
+        added = []
+        rescored = {}
+        for dir3, arch, pagerank in top_pages:
+            link = os.path.join(dir3, arch)
+            current.add(link)
+            if link not in previous:
+                added.append((dir3, arch, pagerank))
+            elif get_score(previous[link]) != get_score(pagerank):
+                rescored[link] = get_score(pagerank)
+        removed = [link for link in previous if link not in current]
+        Index.update(config.DIR_INDICE, gen(added), removed, rescored,
+                     fulltext_text=fulltext_text, fulltext_size=fulltext_size)
+        logger.info("Index updated at %s", config.DIR_INDICE)
+        return len(top_pages)
+
     # ensures an empty directory
     if os.path.exists(config.DIR_INDICE):
         shutil.rmtree(config.DIR_INDICE)
     os.mkdir(config.DIR_INDICE)
 
-    Index.create(config.DIR_INDICE, gen())
+    Index.create(config.DIR_INDICE, gen(top_pages), fulltext_size=fulltext_size,
+                 fulltext_text=fulltext_text, shards=config.INDEX_SHARDS, typos=typos)
     logger.info("Index created at %s", config.DIR_INDICE)
     return len(top_pages)
@@ -17,26 +17,36 @@
 """
 Compressor of the raw content (files, images) to the block files.
 
-Format of the block:
+Format of the block (all numbers are little endian):
 
     - 4 bytes: header length
 
-    - header: pickle of a dict:
-        key -> name of the original file (unicode!)
-        value -> if string, it's a redirect, pointing to the real file name
-                 otherwise it's a (position, size) tuple
+    - header: the items of the block (see BlockHeader), by the name of the original file;
+      each one is the position and size of the file, or a redirect, pointing to the
+      block, position and size of the real file (which may be in other block)
 
     - all the articles, smashed one after the other (origin 0 is after the header)
+
+The blocks are memory mapped, and the header is read from there only as needed.
+
+In the blocks of articles, the header starts with the seek table of the frames: their
+quantity (4 bytes), the positions of the articles where each frame starts, and the
+positions of the frames (plus the end of the last one), all of them of 8 bytes. Each frame
+is a group of whole articles compressed by itself, so to read an article only its frame is
+decompressed.
 """
 
+import collections
+import hashlib
 import logging
 import lzma
+import mmap
 import os
-import pickle
 import struct
+import sys
+import threading
 import urllib.parse
 from functools import lru_cache
-from lzma import LZMAFile as CompressedFile
 from os import path
 
 import config
@@ -51,6 +61,10 @@ logger = logging.getLogger(__name__)
 # The most restricted system appears to be windows with 512 files per proocess.
 BLOCKS_CACHE_SIZE = 100
 
+# The maximum size of the articles put together in a frame of a block of articles (unless
+# one article is bigger than that), as all of them are decompressed to read one.
+FRAME_SIZE = 64 * 1024
+
 
 class BloqueManager(object):
     """Base class for the blockfiles handlers; not intended to be used directly.
@@ -110,50 +124,180 @@ class BloqueManager(object):
         return item
 
 
+def name_hash(name):
+    """Return the hash of a name to find it in the header of a block (8 bytes)."""
+    return struct.unpack("<Q", hashlib.md5(name.encode("utf8")).digest()[:8])[0]
+
+
+# a redirect in a block, to the target name and the block number, position and size of it
+Redirect = collections.namedtuple('Redirect', 'target block position size')
+
+
+def bisect_numbers(data, start, quantity, value):
+    """Return the position to insert the value in an array of sorted numbers in the data.
+
+    The numbers are of 8 bytes, from the start of the data; as in bisect.bisect_left, the
+    position is the one of the first number that is not less than the value.
+    """
+    low, high = 0, quantity
+    while low < high:
+        middle = (low + high) // 2
+        if struct.unpack_from("<Q", data, start + 8 * middle)[0] < value:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+class BlockHeader:
+    """The items of a block, found in its data only when needed.
+
+    Format (all numbers are little endian):
+
+    - quantity of items (4 bytes)
+    - the hashes of the names of the items (8 bytes each, see name_hash), sorted
+    - the records of the items, in that order: kind (1 byte), position (8 bytes) and size
+      (4 bytes); the position and size are the ones of the item in the block, or for the
+      redirects, the offset of their target in the targets area and the length of the
+      target's name
+    - the targets of the redirects, one after the other: the number of their block (4
+      bytes), their position and size (the ones of the item in that block, 8 and 4 bytes)
+      and their name, utf8 encoded
+    """
+
+    ITEM = 0
+    REDIRECT = 1
+    _RECORD = struct.Struct("<BQI")
+    _TARGET = struct.Struct("<IQI")
+
+    def __init__(self, data, start):
+        self._data = data
+        self._size = struct.unpack_from("<I", data, start)[0]
+        self._hashes_start = start + 4
+        self._records_start = self._hashes_start + 8 * self._size
+        self._names_start = self._records_start + self._RECORD.size * self._size
+
+    def __len__(self):
+        return self._size
+
+    def _info(self, idx):
+        """Return the info of the item in that position of the records."""
+        kind, position, size = self._RECORD.unpack_from(
+            self._data, self._records_start + self._RECORD.size * idx)
+        if kind == self.REDIRECT:
+            start = self._names_start + position + self._TARGET.size
+            name = self._data[start:start + size].decode("utf8")
+            target = self._TARGET.unpack_from(self._data, start - self._TARGET.size)
+            return Redirect(name, *target)
+        return position, size
+
+    def get(self, name):
+        """Return the Redirect if the item is a redirect, its (position, size) if it's a
+        file, or None if it is not in the block."""
+        value = name_hash(name)
+        idx = bisect_numbers(self._data, self._hashes_start, self._size, value)
+        if idx == self._size:
+            return None
+        if struct.unpack_from("<Q", self._data, self._hashes_start + 8 * idx)[0] != value:
+            return None
+        return self._info(idx)
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+    def values(self):
+        """Yield the info of all the items (see get)."""
+        for idx in range(self._size):
+            yield self._info(idx)
+
+    def items(self):
+        """Yield the hash of the name (see name_hash) and the info of all the items."""
+        for idx in range(self._size):
+            value = struct.unpack_from("<Q", self._data, self._hashes_start + 8 * idx)[0]
+            yield value, self._info(idx)
+
+    @classmethod
+    def encode(cls, header):
+        """Serialize a dict of the items by name, their values as the ones given by get."""
+        items = sorted((name_hash(name), info) for name, info in header.items())
+        hashes = [value for value, _ in items]
+        if len(set(hashes)) < len(hashes):
+            raise ValueError("Some names in the block have the same hash")
+        records = []
+        names = []
+        names_size = 0
+        for _, info in items:
+            if isinstance(info, Redirect):
+                name = info.target.encode("utf8")
+                records.append(cls._RECORD.pack(cls.REDIRECT, names_size, len(name)))
+                target = cls._TARGET.pack(info.block, info.position, info.size) + name
+                names.append(target)
+                names_size += len(target)
+            else:
+                records.append(cls._RECORD.pack(cls.ITEM, *info))
+        hashes = struct.pack("<I%dQ" % len(hashes), len(hashes), *hashes)
+        return hashes + b"".join(records) + b"".join(names)
+
+
 class Bloque(object):
     """Common functionality for a block."""
 
+    def __init__(self, fname, verbose=False, manager=None):
+        if os.path.exists(fname):
+            with open(fname, "rb") as fh:
+                self.data = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            self.header_size = struct.unpack_from("<l", self.data)[0]
+            self.header = BlockHeader(self.data, self._header_start())
+        else:
+            # no need to define self.data or self.header_size because will never be
+            # used, as no item will be found in the empty header
+            self.header = {}
+        self.verbose = verbose
+        self.manager = manager
+
+    def _header_start(self):
+        """Return where the items start in the header."""
+        return 4
+
     def get_item(self, fileName):
         """Return the item if present, else None."""
-        if fileName not in self.header:
+        info = self.header.get(fileName)
+        if info is None:
             return None
 
-        info = self.header[fileName]
         logger.debug("found: %s", info)
-        if isinstance(info, str):
-            # info is a link to the real page, let's go semi-recursive
+        if isinstance(info, Redirect):
+            # info points to the real page, read it directly from its block
             logger.debug("redirect!")
-            data = self.manager.get_item(info)
+            block_name = "%08x%s" % (info.block, self.manager.archive_extension)
+            data = self.manager.getBloque(block_name)._read(info.position, info.size)
         else:
             (seek, size) = info
-            self.fh.seek(4 + self.header_size + seek)
-            data = self.fh.read(size)
+            data = self._read(seek, size)
         return data
 
+    def _read(self, seek, size):
+        """Read the item in that position."""
+        start = 4 + self.header_size + seek
+        return self.data[start:start + size]
+
     def close(self):
         """Cleanup."""
-        if hasattr(self, "fh"):
-            logger.debug("closing block: %s", self.fh.name)
-            self.fh.close()
+        if hasattr(self, "data"):
+            self.data.close()
 
 
 class BloqueImagenes(Bloque):
     """A block of images.
 
-    Here the header is compressed with lzma, but the header size and the images are not.
+    Here nothing is compressed, so the images are returned as memoryviews of the mapped
+    block, without copying them.
     """
-    def __init__(self, fname, verbose=False, manager=None):
-        if os.path.exists(fname):
-            self.fh = open(fname, "rb")
-            self.header_size = struct.unpack("<l", self.fh.read(4))[0]
-            header_bytes = self.fh.read(self.header_size)
-            self.header = pickle.loads(lzma.decompress(header_bytes))
-        else:
-            # no need to define self.fh or self.header_size because will never be
-            # used, as no item will be found in the empty header
-            self.header = {}
-        self.verbose = verbose
-        self.manager = manager
+
+    def _read(self, seek, size):
+        """Return a view of the item in that position."""
+        start = 4 + self.header_size + seek
+        return memoryview(self.data)[start:start + size]
 
     @classmethod
     def crear(cls, bloqNum, fileNames, verbose=False):
@@ -171,7 +315,7 @@ class BloqueImagenes(Bloque):
             header[fileName] = (seek, size)
             seek += size
 
-        headerBytes = lzma.compress(pickle.dumps(header))
+        headerBytes = BlockHeader.encode(header)
         logger.debug(
             "  files: %d   total seek: %d   header length: %d",
             len(fileNames), seek, len(headerBytes))
@@ -195,61 +339,149 @@ class BloqueImagenes(Bloque):
 class Comprimido(Bloque):
     """A block of articles.
 
-    Here everything is compressed together.
+    Here the articles are compressed with lzma, in frames of some of them (see FRAME_SIZE)
+    that are decompressed independently.
     """
 
-    def __init__(self, fname, verbose=False, manager=None):
-        if os.path.exists(fname):
-            self.fh = CompressedFile(fname, "rb")
-            self.header_size = struct.unpack("<l", self.fh.read(4))[0]
-            header_bytes = self.fh.read(self.header_size)
-            self.header = pickle.loads(header_bytes)
-        else:
-            # no need to define self.fh or self.header_size because will never be
-            # used, as no item will be found in the empty header
-            self.header = {}
-        self.verbose = verbose
-        self.manager = manager
+    def _header_start(self):
+        """Return where the items start in the header, after the seek table of the frames."""
+        self.frames = struct.unpack_from("<I", self.data, 4)[0]
+        return 8 + 8 * (2 * self.frames + 1)
+
+    def _frame(self, seek):
+        """Return the position of the articles where the frame of the article in that
+        position starts, and the start and end of the frame in the block."""
+        starts = 8
+        frame = bisect_numbers(self.data, starts, self.frames, seek + 1) - 1
+        (frame_start,) = struct.unpack_from("<Q", self.data, starts + 8 * frame)
+        positions = starts + 8 * self.frames
+        frame_from, frame_to = struct.unpack_from("<QQ", self.data, positions + 8 * frame)
+        return frame_start, frame_from, frame_to
+
+    def _read(self, seek, size):
+        """Read the article in that position, decompressing its frame up to its end."""
+        frame_start, frame_from, frame_to = self._frame(seek)
+        base = 4 + self.header_size
+        compressed = self.data[base + frame_from:base + frame_to]
+        end = seek - frame_start + size
+        data = lzma.LZMADecompressor().decompress(compressed, max_length=end)
+        return data[end - size:]
 
     @classmethod
-    def crear(cls, redirects, bloqNum, top_filenames, verbose=False):
-        """Generate the compressed file."""
-        logger.debug("Processing block %s", bloqNum)
-
+    def layout(cls, top_filenames):
+        """Return the position/size of each page in the block (by their names), the full
+        names of the pages of each frame, and the positions where the frames start."""
         header = {}
-
-        # fill the header with real file info, with the page as key, and the position/size as value
+        frames = []
+        frame_starts = []
         seek = 0
         for dir3, filename in top_filenames:
             fullName = path.join(config.DIR_PAGSLISTAS, dir3, filename)
             size = path.getsize(fullName)
+            if not frames or (frames[-1] and seek - frame_starts[-1] + size > FRAME_SIZE):
+                frames.append([])
+                frame_starts.append(seek)
+            frames[-1].append(fullName)
             header[filename] = (seek, size)
             seek += size
+        return header, frames, frame_starts
 
-        # put also in the header the redirects, being the value the page that is destination of
-        # the redirection
-        for orig, dest in redirects:
-            header[orig] = dest
+    @classmethod
+    def crear(cls, redirects, bloqNum, top_filenames, verbose=False):
+        """Generate the compressed file."""
+        logger.debug("Processing block %s", bloqNum)
 
-        headerBytes = pickle.dumps(header)
+        # fill the header with real file info, with the page as key, and the position/size as
+        # value, grouping the pages in frames
+        header, frames, frame_starts = cls.layout(top_filenames)
+        seek = sum(size for _, size in header.values())
+
+        # put also in the header the redirects, being the value the Redirect to the page that
+        # is destination of the redirection
+        for orig, redirect in redirects:
+            header[orig] = redirect
+
+        # compress each frame
+        compressed_frames = []
+        frame_positions = [0]
+        for fullNames in frames:
+            data = []
+            for fullName in fullNames:
+                with open(fullName, "rb") as src_fh:
+                    data.append(src_fh.read())
+            compressed = lzma.compress(b"".join(data))
+            compressed_frames.append(compressed)
+            frame_positions.append(frame_positions[-1] + len(compressed))
+
+        seek_table = struct.pack("<I%dQ%dQ" % (len(frames), len(frames) + 1), len(frames),
+                                 *(frame_starts + frame_positions))
+        headerBytes = seek_table + BlockHeader.encode(header)
         logger.debug(
-            "  files: %d   total seek: %d   header length: %d",
-            len(top_filenames), seek, len(headerBytes))
+            "  files: %d   total seek: %d   frames: %d   header length: %d",
+            len(top_filenames), seek, len(frames), len(headerBytes))
 
         # open the compressed file
         nomfile = path.join(config.DIR_PAGES_BLOCKS, "%08x.cdp" % bloqNum)
         logger.debug("  saving in %s", nomfile)
 
-        with CompressedFile(nomfile, "wb") as dst_fh:
+        with open(nomfile, "wb") as dst_fh:
             # save the header length, and the header itself
             dst_fh.write(struct.pack("<l", len(headerBytes)))
             dst_fh.write(headerBytes)
 
-            # save each of the articles
-            for dir3, filename in top_filenames:
-                fullName = path.join(config.DIR_PAGSLISTAS, dir3, filename)
-                with open(fullName, "rb") as src_fh:
-                    dst_fh.write(src_fh.read())
+            # save each of the frames
+            for compressed in compressed_frames:
+                dst_fh.write(compressed)
+
+
+class ArticleCache:
+    """The last articles read (already decoded), by their names.
+
+    The least recently used articles are discarded when all of them take more than
+    max_size bytes.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        """Return the article with that name, or None if it isn't in the cache."""
+        with self._lock:
+            article = self._entries.get(name)
+            if article is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._entries.move_to_end(name)
+            return article
+
+    def put(self, name, article):
+        """Keep the article, unless it is bigger than the whole cache."""
+        size = sys.getsizeof(article)
+        if size > self.max_size:
+            return
+        with self._lock:
+            previous = self._entries.pop(name, None)
+            if previous is not None:
+                self._size -= sys.getsizeof(previous)
+            self._entries[name] = article
+            self._size += size
+            while self._size > self.max_size:
+                _, discarded = self._entries.popitem(last=False)
+                self._size -= sys.getsizeof(discarded)
+
+    def stats(self):
+        """Return the hits and misses of the cache, and the articles and bytes it has."""
+        with self._lock:
+            total = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': self.hits / total if total else 0.0,
+                    'articles': len(self._entries), 'size': self._size}
 
 
 class ArticleManager(BloqueManager):
@@ -258,6 +490,15 @@ class ArticleManager(BloqueManager):
     archive_class = Comprimido
     items_per_block = config.ARTICLES_PER_BLOCK
 
+    def __init__(self, verbose=False, cache_size=None):
+        super(ArticleManager, self).__init__(verbose)
+        if cache_size is None:
+            if config.SERVER_MODE:
+                cache_size = config.ARTICLES_CACHE_SIZE_SERVER
+            else:
+                cache_size = config.ARTICLES_CACHE_SIZE
+        self.cache = ArticleCache(cache_size * 1024 ** 2)
+
     @classmethod
     def generar_bloques(cls, lang, verbose):
         cls._prep_archive_dir(lang)
@@ -282,23 +523,38 @@ class ArticleManager(BloqueManager):
             bloques.setdefault(bloqNum, []).append((dir3, filename))
             logger.debug("  files: %s %r %r", bloqNum, dir3, filename)
 
-        # build the redirect dict, also separated by blocks to know where to find them
-        redirects = {}
+        # where each article will be, to point the redirects directly there
+        positions = {}
+        for bloqNum, fileNames in bloques.items():
+            header, _, _ = Comprimido.layout(fileNames)
+            for filename, (seek, size) in header.items():
+                positions[urllib.parse.unquote(filename)] = (bloqNum, seek, size)
+
+        # the destination of each redirect, discarding any possible 'fragment'
+        redirect_dests = {}
         for line in open(config.LOG_REDIRECTS, "rt", encoding="utf-8"):
             orig, dest = line.strip().split(config.SEPARADOR_COLUMNAS)
+            redirect_dests[orig] = dest.split("#")[0]
 
-            # only keep this redirect if really points to an useful article (discarding any
-            # possible 'fragment')
-            only_name = dest.split("#")[0]
-            if only_name not in all_filenames:
+        # build the redirect dict, also separated by blocks to know where to find them
+        redirects = {}
+        for orig, dest in redirect_dests.items():
+            # collapse the chains of redirects, to point to the final article
+            seen = {orig}
+            while dest not in all_filenames and dest in redirect_dests and dest not in seen:
+                seen.add(dest)
+                dest = redirect_dests[dest]
+
+            # only keep this redirect if really points to an useful article
+            if dest not in all_filenames:
                 continue
 
-            # put it in a block
+            # put it in a block; target must be disk filename
             bloqNum = utiles.coherent_hash(orig.encode('utf8')) % numBloques
-            # target must be disk filename
             dest_filename = to3dirs.to_filename(dest)
-            redirects.setdefault(bloqNum, []).append((orig, dest_filename))
-            logger.debug("  redirs: %s %r %r", bloqNum, orig, dest_filename)
+            redirect = Redirect(dest_filename, *positions[dest])
+            redirects.setdefault(bloqNum, []).append((orig, redirect))
+            logger.debug("  redirs: %s %r %r", bloqNum, orig, redirect)
 
         # build each of the compressed blocks
         tot_archs = 0
@@ -312,13 +568,14 @@ class ArticleManager(BloqueManager):
         return (len(bloques), tot_archs, tot_redirs)
 
     def get_item(self, name):
+        article = self.cache.get(name)
+        if article is not None:
+            return article
         article = super(ArticleManager, self).get_item(name)
 
-        # check for unicode before decoding, as we may be here twice in
-        # the case of articles that are redirects to others (so, let's avoid
-        # double decoding!)
-        if article is not None and isinstance(article, bytes):
+        if article is not None:
             article = article.decode("utf-8")
+            self.cache.put(name, article)
         return article
 
 
@@ -16,17 +16,28 @@
 
 
 import array
+import bisect
+import concurrent.futures
+import contextlib
+import heapq
+import itertools
 import logging
 import math
 import operator
 import os
+import pathlib
 import pickle
+import queue
 import random
+import re
+import sys
 import unicodedata
 import sqlite3
-from collections import defaultdict
+import struct
+import time
+from collections import defaultdict, deque
 from functools import lru_cache
-import lzma as best_compressor  # zlib is faster, lzma has better ratio.
+import zlib as best_compressor  # much faster than lzma to decompress, with a worse ratio
 
 from src.armado import to3dirs
 
@@ -35,6 +46,78 @@ logger = logging.getLogger(__name__)
 PAGE_SIZE = 512
 MAX_RESULTS = 500
 
+# quantity of ranked documents computed each time more results of a search are needed
+SEARCH_CHUNK = 100
+
+# quantity of decompressed pages of docs kept in memory
+PAGES_CACHE_SIZE = 1000
+
+# size of the n-grams used to find the tokens that contain a given key
+NGRAM_SIZE = 3
+
+# quantity of tokens retrieved by query when fetching them by id
+FETCH_CHUNK = 500
+
+# the budget of a search for each of its keys: if the key is in more tokens than that, only
+# the tokens starting with it are used (up to that quantity), and if those tokens have more
+# postings than that only the ones of their best documents are used
+MAX_KEY_TOKENS = 2000
+MAX_KEY_POSTINGS = 200000
+
+# quantity of suggestions given for a prefix, and of best docids stored for each of the
+# short prefixes (longer ones are looked for in the tokens, up to a limit of tokens)
+SUGGEST_RESULTS = 10
+SUGGEST_STORED = 20
+SUGGEST_PREFIX_LENGTH = 3
+SUGGEST_SCAN_LIMIT = 1000
+
+# postings held in memory while creating the index (the rest are spilled to disk), and
+# the quantity of them written together in those temporary files
+MAX_POSTINGS_IN_MEMORY = 2000000
+RUN_BLOCK_SIZE = 10000
+
+# idle read only connections kept to search the index, and the size of the memory map
+# and of the page cache (negative, in KiB) of each of them
+POOL_SIZE = 8
+MMAP_SIZE = 128 * 1024 ** 2
+CACHE_SIZE = -8000
+
+# the first SQLite version whose memdb VFS can be shared by the connections (used to have
+# the index in memory)
+MEMDB_SQLITE_VERSION = (3, 36, 0)
+
+# maximum edit distance of the misspelled words that are corrected, the minimum length of
+# the words for that, and the length of the start of the words whose variants with deleted
+# chars are stored to find the close ones
+TYPO_DISTANCE = 1
+TYPO_MIN_LENGTH = 4
+TYPO_PREFIX_LENGTH = 7
+
+# the maximum quantity of processes used to search in the shards of an index, and the
+# structure of the databases of those shards
+MAX_SHARD_WORKERS = os.cpu_count() or 1
+SHARD_SCRIPT = """
+    PRAGMA journal_mode = OFF;
+    PRAGMA synchronous = OFF;
+    CREATE TABLE tokens
+        (word TEXT PRIMARY KEY,
+        docsets BLOB);
+    """
+
+# the rank of the documents removed from an updated index
+DELETED_RANK = 0xFFFFFFFF
+
+# the virtual table to search in the text of the articles, storing only what is needed to
+# find and rank them (not their text, nor the position of the words)
+FULLTEXT_TABLE = "CREATE VIRTUAL TABLE fulltext USING fts5(text, content='', detail=none)"
+
+# minimum quantity of results found in the titles not to search also in the full text of
+# the articles (if it was indexed), the default maximum time in seconds for that search, and
+# the quantity of SQLite virtual machine instructions between checks of that time
+FULLTEXT_FALLBACK = 5
+FULLTEXT_LATENCY = .2
+FULLTEXT_CHECK_PERIOD = 1000
+
 
 class IndexEntry:
     """Article or redir index entry data structure."""
@@ -66,17 +149,101 @@ class IndexEntry:
         return hash(tuple(getattr(self, attr) for attr in self.__slots__))
 
 
+class DocsPage:
+    """A page of index entries, stored by columns so each one can be read by itself.
+
+    Format (compressed as a whole), all numbers are little endian:
+
+    - header: quantity of entries (2 bytes) and the start of each text column (4 bytes each)
+    - rtype column: 1 byte per entry
+    - score and orig_docid columns: 4 bytes per entry each
+    - text columns (title, link, description, subtitle): the offsets of each entry's text
+      (4 bytes each, plus the end of the last one), and the utf8 encoded texts
+
+    Empty titles and links are stored for the ones that are None.
+    """
+
+    TEXT_COLUMNS = ('title', 'link', 'description', 'subtitle')
+    _HEADER = struct.Struct('<H' + 'I' * len(TEXT_COLUMNS))
+
+    def __init__(self, data):
+        self._data = data
+        self._size, *self._text_starts = self._HEADER.unpack_from(data)
+        self._scores_start = self._HEADER.size + self._size
+        self._orig_docids_start = self._scores_start + 4 * self._size
+
+    def __len__(self):
+        return self._size
+
+    def __iter__(self):
+        return (self[i] for i in range(self._size))
+
+    def _get_text(self, column, idx):
+        """Return the text of an entry in the given column."""
+        start = self._text_starts[column]
+        text_from, text_to = struct.unpack_from('<II', self._data, start + 4 * idx)
+        base = start + 4 * (self._size + 1)
+        return self._data[base + text_from:base + text_to].decode('utf8')
+
+    def __getitem__(self, idx):
+        """Build the entry in that position."""
+        if not 0 <= idx < self._size:
+            raise IndexError("Non existing entry in the page")
+        data = self._data
+        title, link, description, subtitle = (
+            self._get_text(column, idx) for column in range(len(self.TEXT_COLUMNS)))
+        return IndexEntry(
+            rtype=data[self._HEADER.size + idx],
+            link=link or None,
+            title=title or None,
+            score=struct.unpack_from('<I', data, self._scores_start + 4 * idx)[0],
+            description=description,
+            subtitle=subtitle,
+            orig_docid=struct.unpack_from('<I', data, self._orig_docids_start + 4 * idx)[0])
+
+    @classmethod
+    def encode(cls, entries):
+        """Serialize and compress the entries."""
+        size = len(entries)
+        numbers = array.array('I', [entry.score for entry in entries])
+        numbers.extend(entry.orig_docid for entry in entries)
+        if sys.byteorder != 'little':
+            numbers.byteswap()
+        parts = [bytes(entry.rtype for entry in entries), numbers.tobytes()]
+        position = cls._HEADER.size + 9 * size
+
+        text_starts = []
+        for name in cls.TEXT_COLUMNS:
+            texts = [(getattr(entry, name) or '').encode('utf8') for entry in entries]
+            offsets = [0]
+            offsets.extend(itertools.accumulate(len(text) for text in texts))
+            text_starts.append(position)
+            parts.append(struct.pack('<{}I'.format(size + 1), *offsets))
+            parts.append(b''.join(texts))
+            position += 4 * (size + 1) + offsets[-1]
+
+        header = cls._HEADER.pack(size, *text_starts)
+        return best_compressor.compress(header + b''.join(parts), 9)
+
+    @classmethod
+    def decode(cls, compressed):
+        """Decompress the page."""
+        return cls(best_compressor.decompress(compressed))
+
+
 # cache for normalized chars
 _normalized_chars = {}
 
+# the quantity of texts normalized at once, and the separator used to join them
+NORMALIZE_BATCH = 5000
+_BATCH_SEPARATOR = "\x00"
 
-def normalize_words(txt):
-    """Normalize every word from a sentence.
+_NON_ASCII = re.compile('[^\x00-\x7f]')
+_NON_BMP = re.compile('[\U00010000-\U0010ffff]')
 
-    - remove all diacritical marks
-    - convert all letters to lowercase
-    - keep non-ascii chars to support non-latin alphabets
-    """
+
+def _normalize_chars(txt):
+    """Normalize the text char by char, after decomposing it."""
     # decompose unicode chars
     txt = unicodedata.normalize('NFKD', txt)
 
@@ -93,45 +260,309 @@ def normalize_words(txt):
     return ''.join(txt_norm)
 
 
-def decompress_data(data):
-    return pickle.loads(best_compressor.decompress(data))
+@lru_cache(1)
+def _normalization_table():
+    """Return the translation table with the normalization of each char in the BMP.
+
+    As the combining marks are removed, normalizing each char by itself is the same as
+    normalizing the whole text. A list is used as it's faster to index than a dict.
+    """
+    table = []
+    for code in range(0x10000):
+        char = chr(code)
+        if 0xD800 <= code <= 0xDFFF:
+            # surrogates, not real chars
+            table.append(char)
+        else:
+            table.append(_normalize_chars(char))
+    return table
+
+
+def normalize_words(txt):
+    """Normalize every word from a sentence.
+
+    - remove all diacritical marks
+    - convert all letters to lowercase
+    - keep non-ascii chars to support non-latin alphabets
+    """
+    if not _NON_ASCII.search(txt):
+        # nothing to decompose
+        return txt.lower()
+    if _NON_BMP.search(txt):
+        return _normalize_chars(txt)
+    return txt.translate(_normalization_table())
+
+
+def normalize_many(texts):
+    """Normalize the texts (which can't include NUL chars), working on many at once."""
+    texts = iter(texts)
+    while True:
+        batch = list(itertools.islice(texts, NORMALIZE_BATCH))
+        if not batch:
+            return
+        yield from normalize_words(_BATCH_SEPARATOR.join(batch)).split(_BATCH_SEPARATOR)
+
+
+# the proximity operator of the queries, with the maximum quantity of words between the keys
+_NEAR_OPERATOR = re.compile(r'near/(\d+)$')
+
+
+def parse_query(keys):
+    """Separate the keys of a query from its phrase and proximity operators.
+
+    The words between double quotes form a phrase, they must be consecutive in the title;
+    the ones joined by NEAR/k can have up to k other words between them (in any order).
+
+    Return the keys, the phrases (tuples of the indexes of their keys) and the proximity
+    conditions (tuples with the indexes of both keys and the distance).
+    """
+    result = []
+    phrases = []
+    near = []
+    pending_distance = None
+    for i, part in enumerate(" ".join(keys).split('"')):
+        in_phrase = i % 2 == 1
+        indexes = []
+        for word in part.split():
+            match = _NEAR_OPERATOR.match(word)
+            if match and not in_phrase:
+                if result:
+                    pending_distance = int(match.group(1))
+                continue
+            if pending_distance is not None:
+                near.append((len(result) - 1, len(result), pending_distance))
+                pending_distance = None
+            indexes.append(len(result))
+            result.append(word)
+        if in_phrase and len(indexes) > 1:
+            phrases.append(tuple(indexes))
+    return result, phrases, near
+
+
+def ngrams(word):
+    """Return the set of n-grams of the word (empty if the word is too short)."""
+    return {word[i:i + NGRAM_SIZE] for i in range(len(word) - NGRAM_SIZE + 1)}
+
+
+def deletes(word, distance=TYPO_DISTANCE):
+    """Return the variants of the start of the word with up to that quantity of deletions."""
+    variants = {word[:TYPO_PREFIX_LENGTH]}
+    for _ in range(distance):
+        variants.update([variant[:i] + variant[i + 1:]
+                         for variant in variants for i in range(len(variant))])
+    return variants
+
+
+def edit_distance(word1, word2):
+    """Return the edit distance between the words.
+
+    It's the Levenshtein distance, also counting as one edit the transposition of two
+    adjacent chars (optimal string alignment).
+    """
+    before_previous = None
+    previous = list(range(len(word2) + 1))
+    for i, char1 in enumerate(word1, 1):
+        current = [i] + [0] * len(word2)
+        for j, char2 in enumerate(word2, 1):
+            current[j] = min(previous[j] + 1, current[j - 1] + 1,
+                             previous[j - 1] + (char1 != char2))
+            if i > 1 and j > 1 and char1 == word2[j - 2] and word1[i - 2] == char2:
+                current[j] = min(current[j], before_previous[j - 2] + 1)
+        before_previous, previous = previous, current
+    return previous[-1]
+
+
+def intersect_sorted(small, large):
+    """Intersect two sorted sequences of unique numbers.
+
+    It's walked through the small one, galloping over the large one to find each value.
+    """
+    result = []
+    size = len(large)
+    low = 0
+    for value in small:
+        # everything before 'low' is smaller than value; find an upper bound doubling the step
+        bound = 1
+        while low + bound < size and large[low + bound] < value:
+            bound *= 2
+        low = bisect.bisect_left(large, value, low + bound // 2, min(low + bound + 1, size))
+        if low == size:
+            break
+        if large[low] == value:
+            result.append(value)
+            low += 1
+    return result
+
+
+# a number encoded in more than one byte: bytes with the continuation flag, and the last one
+_MULTIBYTE_VARINT = re.compile(rb'[\x80-\xff]+[\x00-\x7f]')
 
 
 class DocSet:
-    """Data type to encode, decode & compute documents-id's sets."""
+    """Data type to encode, decode & compute documents-id's sets.
+
+    The (docid, position) pairs are kept in two parallel arrays, ordered by docid (and then
+    by position) when they are used.
+    """
     SEPARATOR = 0xFF
 
     def __init__(self):
-        self._docs_list = defaultdict(list)
-        self.items = self._docs_list.items
+        self._docids = array.array('I')
+        # positions are stored wider than a byte while building, so the ones that can not
+        # be encoded are detected when encoding
+        self._positions = array.array('H')
+        self._sorted = True
 
     def append(self, docid, position):
         """Append an item to the docs_list."""
-        self._docs_list[docid].append(position)
+        if self._sorted and self._docids:
+            last = self._docids[-1]
+            if docid < last or (docid == last and position < self._positions[-1]):
+                self._sorted = False
+        self._docids.append(docid)
+        self._positions.append(position)
+
+    def _sort(self):
+        """Order the pairs by docid and position, if needed."""
+        if not self._sorted:
+            pairs = sorted(zip(self._docids, self._positions))
+            self._docids = array.array('I', (docid for docid, _ in pairs))
+            self._positions = array.array(self._positions.typecode, (pos for _, pos in pairs))
+            self._sorted = True
 
     def __len__(self):
-        return len(self._docs_list)
+        return len(set(self._docids))
+
+    def __bool__(self):
+        return bool(self._docids)
 
     def __repr__(self):
-        value = repr(self._docs_list).replace("[", "").replace("],", "|").replace("]})", "}")
-        curly = value.index("{")
-        value = value[curly:curly + 75]
+        value = "{" + "| ".join(
+            "{}: {}".format(docid, ", ".join(map(str, positions)))
+            for docid, positions in self.items()) + "}"
+        value = value[:75]
         if not value.endswith("}"):
             value += " ..."
-        return "<Docset: len={} {}>".format(len(self._docs_list), value)
+        return "<Docset: len={} {}>".format(len(self), value)
 
     def __eq__(self, other):
-        return self._docs_list == other._docs_list
+        self._sort()
+        other._sort()
+        return self._docids == other._docids and self._positions == other._positions
+
+    def items(self):
+        """Yield each docid with the list of its positions."""
+        self._sort()
+        pairs = zip(self._docids, self._positions)
+        for docid, group in itertools.groupby(pairs, key=operator.itemgetter(0)):
+            yield docid, [pos for _, pos in group]
+
+    def docids(self):
+        """Return the ordered documents ids in the set."""
+        self._sort()
+        return list(dict.fromkeys(self._docids))
+
+    def docids_range(self, start, end):
+        """Return a new docset with the pairs whose docid is in the [start, end) range."""
+        self._sort()
+        first = bisect.bisect_left(self._docids, start)
+        last = bisect.bisect_left(self._docids, end, first)
+        docset = DocSet()
+        docset._docids = self._docids[first:last]
+        docset._positions = self._positions[first:last]
+        return docset
+
+    def items_for(self, docids):
+        """Yield the docid and positions of the given docids (a set) that are in the docset."""
+        self._sort()
+        all_docids = self._docids
+        if len(docids) < len(all_docids):
+            # look for each of them in the ordered docids
+            for docid in docids:
+                start = bisect.bisect_left(all_docids, docid)
+                end = bisect.bisect_right(all_docids, docid, start)
+                if start < end:
+                    yield docid, list(self._positions[start:end])
+        else:
+            for docid, positions in self.items():
+                if docid in docids:
+                    yield docid, positions
+
+    @classmethod
+    def postings_quantity(cls, encoded):
+        """Return the quantity of (docid, position) pairs in an encoded docset."""
+        if len(encoded) > 1:
+            return encoded.index(cls.SEPARATOR)
+        return 0
+
+    @classmethod
+    def first_docids(cls, encoded, quantity):
+        """Return the first distinct docids of an encoded docset (the better ones, unless
+        the index was updated).
+
+        Only the needed part of the encoded docids is decoded.
+        """
+        result = []
+        if len(encoded) > 1:
+            limit = encoded.index(cls.SEPARATOR)
+            prev_doc = doc = shift = 0
+            for b in encoded[limit + 1:]:
+                doc |= (b & 0x7F) << shift
+                shift += 7
+                if not (b & 0x80):
+                    prev_doc += doc
+                    doc = shift = 0
+                    if not result or result[-1] != prev_doc:
+                        if len(result) == quantity:
+                            break
+                        result.append(prev_doc)
+        return result
+
+    @classmethod
+    def best_postings(cls, encoded, quantity, rank_of):
+        """Return the encoded docset with only the (docid, position) pairs of its best
+        documents by their rank, up to that quantity of them.
+
+        It's used instead of first_postings when the docids don't follow the importance of
+        the documents (in an updated index); the whole docset is decoded.
+        """
+        if quantity >= cls.postings_quantity(encoded):
+            return encoded
+        best = cls()
+        for docid, positions in sorted(cls.decode(encoded).items(),
+                                       key=lambda item: rank_of(item[0])):
+            if len(best._docids) + len(positions) > quantity:
+                break
+            for position in positions:
+                best.append(docid, position)
+        return best.encode() if best else b""
+
+    @classmethod
+    def first_postings(cls, encoded, quantity):
+        """Return the encoded docset with only its first quantity of (docid, position) pairs.
+
+        The docids are not decoded, just the end of the quantity-th one is found.
+        """
+        limit = cls.postings_quantity(encoded)
+        if quantity >= limit:
+            return encoded
+        if quantity <= 0:
+            return b""
+        # each encoded delta is some bytes with the high bit set and one without it
+        docids = re.match(rb'(?:[\x80-\xff]*[\x00-\x7f]){%d}' % quantity, encoded[limit + 1:])
+        return encoded[:quantity] + bytes([cls.SEPARATOR]) + docids.group()
 
     @staticmethod
     def delta_encode(ordered):
         """Compress an array of numbers into a bytes object."""
+        deltas = [doc - prev_doc for prev_doc, doc in zip(itertools.chain([0], ordered), ordered)]
+        if not deltas or max(deltas) < 0x80:
+            # all of them fit in one byte
+            return bytes(deltas)
+
         result = array.array('B')
         add_to_result = result.append
-
-        prev_doc = 0
-        for doc in ordered:
-            doc, prev_doc = doc - prev_doc, doc
+        for doc in deltas:
             while True:
                 b = doc & 0x7F
                 doc >>= 7
@@ -151,42 +582,35 @@ class DocSet:
         """Decode a compressed encoded bucket.
 
         - ordered is a bytes object, representing a byte's array
-        - ctor is the final container
-        - append is the callable attribute used to add an element into the ctor
-        """
-        result = []
-        add_to_result = result.append
-
-        prev_doc = doc = shift = 0
-
-        for b in ordered:
-            doc |= (b & 0x7F) << shift
-            shift += 7
-
-            if not (b & 0x80):
-                # the sequence ended
-                prev_doc += doc
-                add_to_result(prev_doc)
-                doc = shift = 0
 
-        return result
+        The deltas that use only one byte (usually most of them) are taken in batches,
+        only the ones using more bytes are decoded one by one.
+        """
+        deltas = []
+        prev_end = 0
+        for match in _MULTIBYTE_VARINT.finditer(ordered):
+            start, end = match.span()
+            deltas.extend(ordered[prev_end:start])
+            doc = shift = 0
+            for b in match.group():
+                doc |= (b & 0x7F) << shift
+                shift += 7
+            deltas.append(doc)
+            prev_end = end
+        deltas.extend(ordered[prev_end:])
+        return list(itertools.accumulate(deltas))
 
     def encode(self):
         """Encode to store compressed inside the database."""
-        if not self._docs_list:
+        if not self._docids:
             return ""
-        docs_list = []
-        for key, values in self._docs_list.items():
-            docs_list.extend((key, value) for value in values)
-        docs_list.sort()
-        docs = [v[0] for v in docs_list]
-        docs_enc = DocSet.delta_encode(docs)
+        self._sort()
+        docs_enc = DocSet.delta_encode(self._docids)
         # if any score is greater than 255 or lesser than 1, it won't work
-        position = [v[1] for v in docs_list]
-        if any([x >= self.SEPARATOR for x in position]):
+        if max(self._positions) >= self.SEPARATOR:
             raise ValueError("Positions can't be greater than 254.")
+        position = array.array("B", self._positions)
         position.append(self.SEPARATOR)
-        position = array.array("B", position)
         return position.tobytes() + docs_enc
 
     @classmethod
@@ -195,15 +619,13 @@ class DocSet:
         docset = cls()
         if len(encoded) > 1:
             limit = encoded.index(cls.SEPARATOR)
-            docsid = cls.delta_decode(encoded[limit + 1:])
-            positions = array.array('B')
-            positions.frombytes(encoded[:limit])
-            for docid, position in zip(docsid, positions):
-                docset._docs_list[docid].append(position)
+            docset._docids = array.array('I', cls.delta_decode(encoded[limit + 1:]))
+            docset._positions = array.array('B')
+            docset._positions.frombytes(encoded[:limit])
         return docset
 
 
-def open_connection(filename):
+def open_connection(filename, uri=False):
     """Connect and register data types and aggregate function."""
     # Register the adapter
     def adapt_docset(docset):
@@ -215,10 +637,222 @@ def open_connection(filename):
         return DocSet.decode(s)
     sqlite3.register_converter("docset", convert_docset)
 
-    con = sqlite3.connect(filename, check_same_thread=False, detect_types=sqlite3.PARSE_COLNAMES)
+    con = sqlite3.connect(filename, check_same_thread=False, uri=uri,
+                          detect_types=sqlite3.PARSE_COLNAMES)
     return con
 
 
+class ConnectionPool:
+    """Keep read only connections to the database, each one used by one thread at a time.
+
+    The server creates a thread per request, so connections are not tied to threads but
+    lent to them, keeping the idle ones (and their caches) for the next requests.
+    """
+
+    def __init__(self, filename, size=POOL_SIZE, mmap_size=MMAP_SIZE, cache_size=CACHE_SIZE,
+                 in_memory=False):
+        self._uri = pathlib.Path(filename).absolute().as_uri() + "?mode=ro"
+        if in_memory:
+            # copy the database to one in memory, that will live while the keeper
+            # connection is open; it's in the memdb VFS (and not in a shared cache, which
+            # serializes the connections), so each connection has its own cache
+            source = open_connection(self._uri, uri=True)
+            self._uri = "file:/cdpindex-{}?vfs=memdb".format(id(self))
+            self._keeper = open_connection(self._uri, uri=True)
+            source.backup(self._keeper)
+            source.close()
+        self._pragmas = """
+            PRAGMA query_only = True;
+            PRAGMA temp_store = MEMORY;
+            PRAGMA mmap_size = {};
+            PRAGMA cache_size = {};
+            """.format(mmap_size, cache_size)
+        self._idle = queue.LifoQueue(maxsize=size)
+
+    def _open(self):
+        """Open a new connection."""
+        con = open_connection(self._uri, uri=True)
+        con.executescript(self._pragmas)
+        return con
+
+    def memory_used(self):
+        """Return the size in bytes of the database."""
+        with self.connection() as con:
+            page_count = con.execute("PRAGMA page_count").fetchone()[0]
+            page_size = con.execute("PRAGMA page_size").fetchone()[0]
+        return page_count * page_size
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Lend a connection to be used inside the context."""
+        try:
+            con = self._idle.get_nowait()
+        except queue.Empty:
+            con = self._open()
+        try:
+            yield con
+        finally:
+            try:
+                self._idle.put_nowait(con)
+            except queue.Full:
+                con.close()
+
+
+def fetch_tokenids(db, tokenids):
+    """Yield the word and encoded docset of the tokens with the given ids."""
+    tokenids = sorted(tokenids)
+    sql = "select word, docsets from tokens where tokenid in ({})"
+    for i in range(0, len(tokenids), FETCH_CHUNK):
+        chunk = tokenids[i:i + FETCH_CHUNK]
+        cur = db.execute(sql.format(",".join("?" * len(chunk))), chunk)
+        yield from cur.fetchall()
+
+
+def fetch_tokens(db, key):
+    """Yield the word and encoded docset of the tokens that contain the key.
+
+    If the key is in too many tokens (see MAX_KEY_TOKENS) only the ones starting with it
+    are given.
+    """
+    if len(key) < NGRAM_SIZE:
+        # too short to use the n-grams, the quantity of tokens having it was precomputed
+        row = db.execute("select tokens from short_keys where key = ?", (key,)).fetchone()
+        if row is None:
+            return
+        if row[0] <= MAX_KEY_TOKENS:
+            # go through all the tokens
+            sql = "select word, docsets from tokens where instr(word, ?)"
+            cur = db.execute(sql, (key,))
+            for row in cur.fetchall():
+                yield row[0], row[1]
+            return
+    else:
+        tokenids = get_candidate_tokens(db, key)
+        if len(tokenids) <= MAX_KEY_TOKENS:
+            for word, docset in fetch_tokenids(db, tokenids):
+                # all the n-grams being present doesn't assure the key is in the word
+                if key in word:
+                    yield word, docset
+            return
+
+    logger.debug("Too many tokens for key %r, using only the ones starting with it", key)
+    yield from fetch_prefixed_tokens(db, key, MAX_KEY_TOKENS)
+
+
+def fetch_prefixed_tokens(db, key, quantity):
+    """Return the word and encoded docset of up to quantity tokens starting with the key."""
+    # the words are compared by their UTF-8 encoding, which keeps the order of the chars
+    sql = "select word, docsets from tokens where word >= ? and word < ? order by word limit ?"
+    return db.execute(sql, (key, key + chr(sys.maxunicode), quantity)).fetchall()
+
+
+def short_keys(word):
+    """Return the set of keys too short to use the n-grams that are in the word."""
+    return {word[i:i + size] for size in range(1, NGRAM_SIZE) for i in range(len(word) - size + 1)}
+
+
+def limit_postings(tokens, quantity, rank_of=None):
+    """Return the (word, encoded docset) tokens with up to that quantity of postings in total.
+
+    The budget is shared among the tokens: the ones with few postings are kept whole, and
+    only the first postings of the biggest ones are kept (or the ones of their best
+    documents, if the rank_of them is given).
+    """
+    sizes = [DocSet.postings_quantity(encoded) for _, encoded in tokens]
+    if sum(sizes) <= quantity:
+        return tokens
+
+    result = [None] * len(tokens)
+    pending = len(tokens)
+    for size, idx in sorted(zip(sizes, range(len(tokens)))):
+        word, encoded = tokens[idx]
+        share = quantity // pending
+        if size > share:
+            if rank_of is None:
+                encoded = DocSet.first_postings(encoded, share)
+            else:
+                encoded = DocSet.best_postings(encoded, share, rank_of)
+            size = share
+        result[idx] = (word, encoded)
+        quantity -= size
+        pending -= 1
+    return result
+
+
+def get_candidate_tokens(db, key):
+    """Return the ids of the tokens that have all the n-grams of the key."""
+    grams = ngrams(key)
+    sql = "select tokenids from trigrams where gram in ({})".format(",".join("?" * len(grams)))
+    cur = db.execute(sql, list(grams))
+    postings = [row[0] for row in cur.fetchall()]
+    if len(postings) < len(grams):
+        # some n-gram is not in any token
+        return set()
+
+    # intersect starting from the shortest postings
+    postings.sort(key=len)
+    candidates = set(DocSet.delta_decode(postings[0]))
+    for encoded in postings[1:]:
+        if not candidates:
+            break
+        candidates.intersection_update(DocSet.delta_decode(encoded))
+    return candidates
+
+
+def fetch_key_tokens(db, key, rank_of=None, corrections=None):
+    """Return the words and encoded docsets of a partial key search.
+
+    If no word has the key it may be misspelled, so the words close to it are used (and the
+    closest one is put in corrections, if given). The rank_of the documents is given if the
+    index was updated (see limit_postings).
+    """
+    tokens = list(fetch_tokens(db, key))
+    if not tokens:
+        close = get_close_tokens(db, key)
+        if close and corrections is not None:
+            corrections[key] = closest_word(close)
+        tokens = [(word, docset) for _, word, docset in close]
+    return limit_postings(tokens, MAX_KEY_POSTINGS, rank_of)
+
+
+def closest_word(close):
+    """Return the word of the closest tokens (see get_close_tokens), the most used one
+    between the equally close."""
+    best = min(close, key=lambda item: (item[0], -DocSet.postings_quantity(item[2])))
+    return best[1]
+
+
+def get_close_tokens(db, key):
+    """Return the (distance, word, encoded docset) of the tokens close to the key.
+
+    The tokens sharing with the key some variant with deleted chars are found directly in
+    the deletes table, and then only those are checked to be within the edit distance.
+    """
+    if len(key) < TYPO_MIN_LENGTH:
+        return []
+    variants = list(deletes(key))
+    sql = "select tokenids from deletes where variant in ({})"
+    tokenids = set()
+    for row in db.execute(sql.format(",".join("?" * len(variants))), variants).fetchall():
+        tokenids.update(DocSet.delta_decode(row[0]))
+
+    result = []
+    for word, docset in fetch_tokenids(db, tokenids):
+        distance = edit_distance(key, word)
+        if distance <= TYPO_DISTANCE:
+            result.append((distance, word, docset))
+    return result
+
+
+def read_ranks(db, pageid):
+    """Read the ranks of a page of docs."""
+    ranks = array.array('I')
+    row = db.execute("SELECT ranks FROM ranks where pageid = ?", (pageid,)).fetchone()
+    if row:
+        ranks.frombytes(row[0])
+    return ranks
+
+
 def to_filename(title):
     """Compute the filename from the title."""
     tt = title.replace(" ", "_")
@@ -236,39 +870,191 @@ def to_filename(title):
 
 class Search:
     """Fetch and order some search."""
-    def __init__(self, db, keys):
+
+    # similitude of an exact match, the lowest value iterative_levenshtein can return
+    EXACT_MATCH = -1000
+
+    # the costs of the edit operations between the keys and the words of the titles
+    DELETE_COST = 200
+    INSERT_COST = 25
+    SUBSTITUTE_COST = 30
+
+    def __init__(self, db, keys, rank_of=None, phrases=(), near=(), tokens=None):
         self.db = db
         self.docs = defaultdict(dict)
         self.keys = keys
-        # create a set of result w/all keys
-        results = self._get_docs(keys[0])
-        for key in keys[1:]:
-            results &= self._get_docs(key)
+        self._keys = tuple(keys)
+        self._costs = {}
+        self._similitudes = {}
+        self.phrases = phrases
+        self.near = near
+        # the closest words of the keys that are not in any token
+        self.corrections = {}
+        if tokens is None:
+            tokens = [fetch_key_tokens(db, key, rank_of, self.corrections) for key in keys]
+        # the candidates, from the most important to the least one
+        candidates = self._intersect(tokens)
+        if rank_of is None:
+            self._docids = None
+        else:
+            # an updated index, the importance is given by the rank of the documents
+            # (and not by their docids); the candidates are their ranks
+            self._docids = {}
+            for docid in candidates:
+                rank = rank_of(docid)
+                if rank != DELETED_RANK:
+                    self._docids[rank] = docid
+            candidates = sorted(self._docids)
+        self.candidates = candidates
+        self._scores = {}
+        # the word_quants of the pages of docs read, freed with the search
+        self._pages = {}
+
+    def _docid(self, candidate):
+        """Return the docid of a candidate."""
+        if self._docids is None:
+            return candidate
+        return self._docids[candidate]
+
+    def _intersect(self, tokens):
+        """Return the sorted docids that have all the keys, given the tokens of each one.
+
+        The keys are processed from the most selective one (the one with less postings in
+        its tokens), only decoding what is needed; the positions of the words are stored
+        only for the surviving documents, which are then filtered by the phrases and
+        proximity conditions, if any.
+        """
+        if not tokens:
+            return []
+        matches = list(enumerate(tokens))
+        matches.sort(key=lambda item: sum(DocSet.postings_quantity(enc) for _, enc in item[1]))
+
+        results = None
+        decoded = []
+        for idx, tokens in matches:
+            docsets = [(word, DocSet.decode(encoded)) for word, encoded in tokens]
+            decoded.append((idx, docsets))
+            if len(docsets) == 1:
+                key_docids = docsets[0][1].docids()
+            else:
+                key_docids = set()
+                for _, docset in docsets:
+                    key_docids.update(docset.docids())
+                key_docids = sorted(key_docids)
+            results = key_docids if results is None else intersect_sorted(results, key_docids)
+            if not results:
+                return []
+
+        survivors = set(results)
+        keys_positions = defaultdict(lambda: defaultdict(set))
+        for idx, docsets in decoded:
+            for word, docset in docsets:
+                for docid, positions in docset.items_for(survivors):
+                    for pos in positions:
+                        self.docs[docid][pos] = word
+                    keys_positions[docid][idx].update(positions)
+
+        if self.phrases or self.near:
+            results = [docid for docid in results if self._is_close(keys_positions[docid])]
+        return results
+
+    def _is_close(self, keys_positions):
+        """Tell if the positions of the keys in a document fulfill the phrases and proximity
+        conditions."""
+        for phrase in self.phrases:
+            first, rest = phrase[0], phrase[1:]
+            if not any(all(pos + i in keys_positions[idx] for i, idx in enumerate(rest, 1))
+                       for pos in keys_positions[first]):
+                return False
+        for idx1, idx2, distance in self.near:
+            if not any(0 < abs(pos1 - pos2) <= distance + 1
+                       for pos1 in keys_positions[idx1] for pos2 in keys_positions[idx2]):
+                return False
+        return True
+
+    @staticmethod
+    def order_factor(candidate):
+        """Return the importance of the candidate, which always decreases with it."""
+        # first docid (or ranks) are a LOT more important
+        return int(40000 * math.pow(candidate + 1, -.5))
+
+    def score(self, candidate):
+        """Compute the score of a candidate, the higher the better."""
+        try:
+            return self._scores[candidate]
+        except KeyError:
+            pass
 
         # computes the similitude of phrase
-        self.ordered = []
-        for docid in results:
-            word_quant = self._get_doc_word_quant(docid)
-            phrase = [""] * word_quant
-            for pos, word in self.docs[docid].items():
-                phrase[pos] = word
-            similitude = self.iterative_levenshtein(phrase)
+        docid = self._docid(candidate)
+        word_quant = self._get_doc_word_quant(docid)
+        phrase = [""] * word_quant
+        for pos, word in self.docs[docid].items():
+            phrase[pos] = word
+        similitude = self.iterative_levenshtein(phrase)
+
+        score = self.order_factor(candidate) - similitude
+        self._scores[candidate] = score
+        return score
+
+    def top(self, quantity):
+        """Return the best (score, docid) pairs, ordered from best to worst.
+
+        Only a bounded heap of the best candidates is kept; as the order factor decreases
+        with the docid, once even an exact match of the next candidate can not enter the
+        heap none of the following ones can, so the rest are not even scored.
+        """
+        heap = []
+        for candidate in self.candidates:
+            if len(heap) < quantity:
+                heapq.heappush(heap, (self.score(candidate), candidate))
+                continue
+
+            # being greater than all in the heap, the candidate would enter it
+            # even having the same score than the worst one there
+            worst_score = heap[0][0]
+            if self.order_factor(candidate) - self.EXACT_MATCH < worst_score:
+                break
+            score = self.score(candidate)
+            if score >= worst_score:
+                heapq.heapreplace(heap, (score, candidate))
 
-            # first docid are a LOT more important
-            order_factor = int(40000 * math.pow(docid + 1, -.5))
+        heap.sort(reverse=True)
+        if self._docids is None:
+            return heap
+        return [(score, self._docids[candidate]) for score, candidate in heap]
 
-            self.ordered.append((order_factor - similitude, docid))
+    def ranked(self, quantity=MAX_RESULTS):
+        """Yield all the (score, docid) pairs from best to worst.
 
-        self.ordered.sort(reverse=True)
+        The ranking is done lazily, doubling the quantity of computed results each time
+        the consumer needs more than the already yielded ones.
+        """
+        yielded = 0
+        while yielded < len(self.candidates):
+            best = self.top(yielded + quantity)
+            yield from best[yielded:]
+            yielded = len(best)
+            quantity *= 2
+
+    @property
+    def ordered(self):
+        """All the (score, docid) pairs, from best to worst."""
+        return self.top(len(self.candidates))
 
-    @lru_cache(1000)
     def _get_page(self, pageid):
         """Return the array of word_quants in word of a page's titles."""
+        try:
+            return self._pages[pageid]
+        except KeyError:
+            pass
+
         cur = self.db.execute("SELECT word_quants FROM docs where pageid = ?", (pageid,))
         row = cur.fetchone()
         decomp_data = array.array("B")
         if row:
             decomp_data.frombytes(row[0])
+        self._pages[pageid] = decomp_data
         return decomp_data
 
     def _get_doc_word_quant(self, docid):
@@ -279,145 +1065,414 @@ class Search:
             raise ValueError("Inconsistency on data, docid non exists")
         return word_quants[rel_position]
 
-    def _get_docs(self, key):
-        """Store the words asoc w/ the docs & return a found docs's set."""
-        found = set()
-        for word, docset in self._fetch(key):
-            for docid, positions in docset.items():
-                for pos in positions:
-                    self.docs[docid][pos] = word
-                found.add(docid)
-        return found
-
-    def _fetch(self, key):
-        """Return all the values of a partial key search."""
-        sql = "select word, docsets as 'ds [docset]' from tokens"
-        sql += " where word like '%{}%'".format(key)
-        cur = self.db.execute(sql)
-        for row in cur.fetchall():
-            yield row[0], row[1]
+    def _substitution_costs(self, word):
+        """Return the costs of substituting each key by the word in the phrase."""
+        try:
+            return self._costs[word]
+        except KeyError:
+            pass
+
+        costs = []
+        for key in self.keys:
+            lenkey = len(key)
+            lendiff = len(word) - lenkey
+            if key == word:
+                cost = 0  # if equal, no subtituion cost
+            elif word.startswith(key):
+                # if starts with key, just half cost
+                cost = lendiff * (self.SUBSTITUTE_COST // 2)
+            elif key in word:
+                # if includes the key, multiply
+                cost = lendiff * self.SUBSTITUTE_COST
+            else:
+                # total substitution, cost by sum of lengths
+                cost = self.SUBSTITUTE_COST * (lendiff + 2 * lenkey)
+            costs.append(cost)
+        self._costs[word] = costs
+        return costs
 
     def iterative_levenshtein(self, phrase):
         """Compute the Levenshtein distance between the lists keys and phrase.
 
-        For all i and j, dist[i,j] will contain the Levenshtein
-        distance between the first i items of keys and the
-        first j items of phrase
+        For all i and j, the distance between the first i items of keys and the first j
+        items of phrase is computed from the row of i - 1, so only two rows are kept. The
+        result is cached by phrase, as many documents (e.g. redirects) share their titles.
         """
+        phrase = tuple(phrase)
+        try:
+            return self._similitudes[phrase]
+        except KeyError:
+            pass
 
         # If there are exact match, put on the top
-        if self.keys == phrase:
-            return -1000
-
-        keys = self.keys
-        rows = len(keys) + 1
-        cols = len(phrase) + 1
-        deletes, inserts, substitutes = 200, 25, 30
+        if self._keys == phrase:
+            self._similitudes[phrase] = self.EXACT_MATCH
+            return self.EXACT_MATCH
 
-        dist = [[0 for c in range(cols)] for r in range(rows)]
-
-        # source prefixes can be transformed into empty strings
-        # by deletions:
-        for row in range(1, rows):
-            dist[row][0] = row * deletes
+        deletes, inserts = self.DELETE_COST, self.INSERT_COST
+        columns = [self._substitution_costs(word) for word in phrase]
 
         # target prefixes can be created from an empty source string
         # by inserting the characters.
         # Inserts in the last positions cost more.
-        for col in range(1, cols):
-            dist[0][col] = int(col * inserts ** 1.2)
-
-        for row in range(1, rows):
-            lenkey = len(keys[row - 1])
-
-            for col in range(1, cols):
-                lendiff = len(phrase[col - 1]) - lenkey
-                if keys[row - 1] == phrase[col - 1]:
-                    cost = 0  # if equal, no subtituion cost
-                elif phrase[col - 1].startswith(keys[row - 1]):
-                    # if starts with key, just half cost
-                    cost = lendiff * (substitutes // 2)
-                elif keys[row - 1] in phrase[col - 1]:
-                    # if includes the key, multiply
-                    cost = lendiff * substitutes
-                else:
-                    # total substitution, cost by sum of lengths
-                    lendiff += 2 * lenkey
-                    cost = substitutes * lendiff
+        previous = [int(col * inserts ** 1.2) for col in range(len(phrase) + 1)]
+
+        for row in range(len(self._keys)):
+            # source prefixes can be transformed into empty strings
+            # by deletions:
+            left = (row + 1) * deletes
+            current = [left]
+            for above_left, above, costs in zip(previous, previous[1:], columns):
+                left = min(above + deletes,  # deletion
+                           left + inserts,  # insertion
+                           above_left + costs[row])  # substitution
+                current.append(left)
+            previous = current
+
+        self._similitudes[phrase] = previous[-1]
+        return previous[-1]
+
+
+# the connections used by each worker process searching in the shards, by database
+_worker_pools = {}
+
 
-                dist[row][col] = min(dist[row - 1][col] + deletes,
-                                     dist[row][col - 1] + inserts,
-                                     dist[row - 1][col - 1] + cost)  # substitution
+def _worker_connection(filename):
+    """Return the context manager to use a connection to the database in a worker."""
+    try:
+        pool = _worker_pools[filename]
+    except KeyError:
+        pool = _worker_pools[filename] = ConnectionPool(filename, size=1)
+    return pool.connection()
 
-        return dist[row][col]
+
+def search_shard(directory, shardid, words, keys, ranked, phrases, near, quantity):
+    """Return the best (score, docid) pairs of a shard, ordered from best to worst.
+
+    It runs in a worker process; words are the ones of the tokens found for each key.
+    """
+    with contextlib.ExitStack() as stack:
+        db = stack.enter_context(_worker_connection(os.path.join(directory, "index.sqlite")))
+        shard_db = stack.enter_context(_worker_connection(shard_filename(directory, shardid)))
+        pages = {}
+
+        def rank_of(docid):
+            pageid, rel_position = divmod(docid, PAGE_SIZE)
+            if pageid not in pages:
+                pages[pageid] = read_ranks(db, pageid)
+            return pages[pageid][rel_position]
+
+        tokens = []
+        sql = "SELECT word, docsets FROM tokens WHERE word IN ({})"
+        for key_words in words:
+            key_tokens = []
+            for i in range(0, len(key_words), FETCH_CHUNK):
+                chunk = key_words[i:i + FETCH_CHUNK]
+                cur = shard_db.execute(sql.format(",".join("?" * len(chunk))), chunk)
+                key_tokens.extend(cur.fetchall())
+            if not key_tokens:
+                # some key is not in this shard at all
+                return []
+            tokens.append(
+                limit_postings(key_tokens, MAX_KEY_POSTINGS, rank_of if ranked else None))
+
+        search = Search(db, keys, rank_of if ranked else None, phrases, near, tokens)
+        return search.top(quantity)
+
+
+def shard_filename(directory, shardid):
+    """Return the filename of the database of a shard of the index."""
+    return os.path.join(directory, "shard-{}.sqlite".format(shardid))
+
+
+class ShardedSearch:
+    """Fetch and order some search in the shards of the index, in parallel.
+
+    The tokens for the keys are found in the whole index, and then each shard gives its
+    best results; as all the shards share the same docids (or ranks) their scores can be
+    compared, so those lists are merged to get the best ones.
+    """
+
+    def __init__(self, index, keys, phrases=(), near=()):
+        self.index = index
+        self.keys = keys
+        self.phrases = phrases
+        self.near = near
+        self.corrections = {}
+        with index.connection() as db:
+            self.words = [[word for word, _ in fetch_key_tokens(db, key, None, self.corrections)]
+                          for key in keys]
+
+    def top(self, quantity):
+        """Return the best (score, docid) pairs, ordered from best to worst."""
+        if not all(self.words):
+            return []
+        futures = [
+            self.index.executor.submit(
+                search_shard, self.index.directory, shardid, self.words, self.keys,
+                self.index.ranked, self.phrases, self.near, quantity)
+            for shardid in self.index.shards]
+        best = [future.result() for future in futures]
+        return list(itertools.islice(heapq.merge(*best, reverse=True), quantity))
+
+    def ranked(self, quantity=MAX_RESULTS):
+        """Yield all the (score, docid) pairs from best to worst.
+
+        The ranking is done lazily, doubling the quantity of computed results each time
+        the consumer needs more than the already yielded ones.
+        """
+        yielded = 0
+        while True:
+            best = self.top(yielded + quantity)
+            yield from best[yielded:]
+            if len(best) < yielded + quantity:
+                return
+            yielded = len(best)
+            quantity *= 2
+
+
+class PostingsRuns:
+    """Collect (word, docid, position) postings using a bounded quantity of memory.
+
+    When the buffer is full it's sorted and spilled to a temporary file (a "run"); at the
+    end all the runs are merged, giving the postings grouped by word.
+    """
+
+    def __init__(self, tempdir, max_postings, name="run"):
+        self._tempdir = tempdir
+        self._name = name
+        self._max_postings = max_postings
+        self._buffer = []
+        self._runs = []
+
+    def append(self, word, docid, position):
+        """Add a posting, spilling the buffer to disk if full."""
+        self._buffer.append((word, docid, position))
+        if len(self._buffer) >= self._max_postings:
+            self._spill()
+
+    def _spill(self):
+        """Write the sorted buffer to a new run."""
+        self._buffer.sort()
+        path = os.path.join(self._tempdir, "{}-{}".format(self._name, len(self._runs)))
+        with open(path, "wb") as fh:
+            for i in range(0, len(self._buffer), RUN_BLOCK_SIZE):
+                pickle.dump(self._buffer[i:i + RUN_BLOCK_SIZE], fh, pickle.HIGHEST_PROTOCOL)
+        logger.debug("Spilled %d postings to %s", len(self._buffer), path)
+        self._runs.append(path)
+        self._buffer = []
+
+    @staticmethod
+    def _read_run(path):
+        """Yield the postings of a run, loading a block at a time."""
+        with open(path, "rb") as fh:
+            while True:
+                try:
+                    block = pickle.load(fh)
+                except EOFError:
+                    return
+                yield from block
+
+    def docsets(self):
+        """Yield each word with its DocSet, ordered by word."""
+        self._buffer.sort()
+        runs = [self._read_run(path) for path in self._runs]
+        runs.append(iter(self._buffer))
+        merged = heapq.merge(*runs)
+        for word, postings in itertools.groupby(merged, key=operator.itemgetter(0)):
+            docset = DocSet()
+            for _, docid, position in postings:
+                docset.append(docid, position)
+            yield word, docset
+
+
+def sorted_by_score(source, tempdir):
+    """Return the quantity of items in the source, and an iterator of them by score.
+
+    The items are ordered from the highest score, keeping the original order between the
+    ones with the same score; they are stored in a temporary file, only their scores and
+    positions there are kept in memory.
+    """
+    scores = []
+    offsets = array.array('Q')
+    path = os.path.join(tempdir, "source")
+    with open(path, "wb") as fh:
+        for item in source:
+            offsets.append(fh.tell())
+            scores.append(item[2])
+            pickle.dump(item, fh, pickle.HIGHEST_PROTOCOL)
+    order = sorted(range(len(scores)), key=scores.__getitem__, reverse=True)
+    del scores
+
+    def gen():
+        with open(path, "rb") as fh:
+            for idx in order:
+                fh.seek(offsets[idx])
+                yield pickle.load(fh)
+
+    return len(order), gen()
+
+
+def article_text(idx_entry, get_text=None):
+    """Return the text of an article to search in it: its description, and the text given
+    for its link by get_text (if any)."""
+    if get_text is None:
+        return idx_entry.description
+    link = idx_entry.link or to_filename(idx_entry.title)
+    return idx_entry.description + " " + get_text(link)
+
+
+def source_documents(source, first_docid=0):
+    """Yield the docid, the entry and the words of each document from the source items.
+
+    Each article gives its document and then the ones of its redirects.
+    """
+    docid = first_docid
+    for title, link, score, description, orig_words, redir_words in source:
+        idx_entry = IndexEntry(
+            link=link,
+            title=title,
+            score=score,
+            rtype=IndexEntry.TYPE_ORIG_ARTICLE,
+            description=description)
+        if idx_entry.link == to_filename(idx_entry.title):
+            idx_entry.link = None
+            idx_entry.rtype = IndexEntry.TYPE_ORIG_SIMPLE_LINK
+        orig_docid = docid
+        yield docid, idx_entry, orig_words
+        docid += 1
+        for word_set in redir_words:
+            redir_entry = IndexEntry(
+                link=None,
+                title=None,
+                subtitle=' '.join(word_set),
+                score=0,
+                rtype=IndexEntry.TYPE_REDIRECT,
+                orig_docid=orig_docid)
+            yield docid, redir_entry, word_set
+            docid += 1
 
 
 class Index:
-    """Handle the index."""
+    """Handle the index.
 
-    def __init__(self, directory):
-        self._directory = directory
+    The importance of the documents is given by their docids, unless the index was updated
+    with a delta: then their ranks are stored (by page, as the docs) in the ranks table.
+    """
+
+    def __init__(self, directory, pool_size=POOL_SIZE, mmap_size=MMAP_SIZE,
+                 cache_size=CACHE_SIZE, in_memory=False, fulltext_latency=FULLTEXT_LATENCY):
+        self.directory = directory
+        self._fulltext_latency = fulltext_latency
         keyfilename = os.path.join(directory, "index.sqlite")
-        self.db = open_connection(keyfilename)
-        self.db.executescript('''
-            PRAGMA query_only = True;
-            PRAGMA journal_mode = MEMORY;
-            PRAGMA temp_store = MEMORY;
-            PRAGMA synchronous = OFF;
-            ''')
+        if in_memory and not hasattr(sqlite3.Connection, 'backup'):
+            logger.warning("Can't load the index in memory with this Python version")
+            in_memory = False
+        if in_memory and sqlite3.sqlite_version_info < MEMDB_SQLITE_VERSION:
+            logger.warning("Can't load the index in memory with this SQLite version")
+            in_memory = False
+        self.in_memory = in_memory
+        self._pool = ConnectionPool(keyfilename, pool_size, mmap_size, cache_size, in_memory)
+        # get a connection right away, to fail early if the database is not there
+        with self.connection() as db:
+            self.ranked = db.execute("SELECT count(*) FROM ranks").fetchone()[0] > 0
+            sql = "SELECT count(*) FROM sqlite_master WHERE name = 'fulltext'"
+            self.has_fulltext = db.execute(sql).fetchone()[0] > 0
+            self.shards = [row[0] for row in db.execute("SELECT shardid FROM shards")]
+        # changes if the index is recreated or updated
+        stat = os.stat(keyfilename)
+        self.version = "{}-{}".format(stat.st_size, stat.st_mtime_ns)
+
+        # the shards are searched by other processes (they're not loaded in memory)
+        self.executor = None
+        if self.shards:
+            self.executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=min(len(self.shards), MAX_SHARD_WORKERS))
+
+    def connection(self):
+        """Context manager that lends a database connection to the current thread."""
+        return self._pool.connection()
+
+    def _fetchall(self, sql, params=()):
+        """Execute the query and return all its rows."""
+        with self.connection() as db:
+            return db.execute(sql, params).fetchall()
 
     def keys(self):
         """Return an iterator over the stored keys."""
-        cur = self.db.execute("SELECT word FROM tokens")
-        for row in cur.fetchall():
+        for row in self._fetchall("SELECT word FROM tokens"):
             yield row[0]
 
     def items(self):
         """Return an iterator over the stored items."""
         sql = "select word, docsets as 'ds [docset]' from tokens"
-        cur = self.db.execute(sql)
-        for row in cur.fetchall():
+        for row in self._fetchall(sql):
             yield row[0], row[1]
 
     def values(self):
         """Return an iterator over the stored values."""
-        cur = self.db.execute("SELECT pageid, data FROM docs ORDER BY pageid")
-        for row in cur.fetchall():
-            decomp_data = decompress_data(row[1])
-            for doc in decomp_data:
-                yield doc
+        for row in self._fetchall("SELECT pageid, data FROM docs ORDER BY pageid"):
+            page = DocsPage.decode(row[1])
+            if not self.ranked:
+                yield from page
+                continue
+            for idx, entry in enumerate(page):
+                if self._rank(row[0] * PAGE_SIZE + idx) != DELETED_RANK:
+                    yield entry
 
     @lru_cache(1)
     def __len__(self):
         """Compute the total number of docs in compressed pages."""
         sql = "Select pageid, data from docs order by pageid desc limit 1"
-        cur = self.db.execute(sql)
-        row = cur.fetchone()
-        decomp_data = decompress_data(row[1])
-        return row[0] * PAGE_SIZE + len(decomp_data)
+        row = self._fetchall(sql)[0]
+        return row[0] * PAGE_SIZE + len(DocsPage.decode(row[1]))
 
     def random(self):
         """Return a random value."""
-        docid = random.randint(0, len(self) - 1)
-        return self.get_doc(docid)
+        while True:
+            docid = random.randint(0, len(self) - 1)
+            if self._rank(docid) != DELETED_RANK:
+                return self.get_doc(docid)
 
     def __contains__(self, key):
         """Return if the key is in the index or not."""
-        cur = self.db.execute("SELECT word FROM tokens where word = ?", (key,))
-        if cur.fetchone():
+        if self._fetchall("SELECT word FROM tokens where word = ?", (key,)):
             return True
         return False
 
-    @lru_cache(1000)
+    def memory_used(self):
+        """Return the size in bytes of the database (only in memory if loaded there)."""
+        return self._pool.memory_used()
+
+    def warm_up(self, quantity):
+        """Decompress the first pages of docs, the most important ones; return how many."""
+        total = math.ceil(len(self) / PAGE_SIZE)
+        quantity = min(quantity, total, PAGES_CACHE_SIZE)
+        for pageid in range(quantity):
+            self._get_page(pageid)
+        return quantity
+
+    @lru_cache(PAGES_CACHE_SIZE)
     def _get_page(self, pageid):
         """Get a page of doc entry data."""
-        cur = self.db.execute("SELECT data FROM docs where pageid = ?", (pageid,))
-        row = cur.fetchone()
-        if row:
-            decomp_data = decompress_data(row[0])
-            return decomp_data
+        rows = self._fetchall("SELECT data FROM docs where pageid = ?", (pageid,))
+        if rows:
+            return DocsPage.decode(rows[0][0])
         return None
 
+    @lru_cache(PAGES_CACHE_SIZE)
+    def _get_ranks(self, pageid):
+        """Get the ranks of a page of docs."""
+        with self.connection() as db:
+            return read_ranks(db, pageid)
+
+    def _rank(self, docid):
+        """Return the rank of a document (its docid, if the index was not updated)."""
+        if not self.ranked:
+            return docid
+        page_id, rel_position = divmod(docid, PAGE_SIZE)
+        return self._get_ranks(page_id)[rel_position]
+
     def _get_raw_doc(self, docid):
         """Return one stored document item, no redirect compute."""
         page_id, rel_position = divmod(docid, PAGE_SIZE)
@@ -445,34 +1500,202 @@ class Index:
         else:
             return idx_entry
 
-    def search(self, keys):
-        """Return all the values that are found for those keys.
+    def search(self, keys, corrections=None):
+        """Return an iterator of all the values that are found for those keys.
 
-        The AND boolean operation is applied to the keys.
+        The AND boolean operation is applied to the keys, which can include phrases and
+        proximity operators (see parse_query). If few titles have them, the articles with
+        them in their text are given after those (only without those operators). If
+        corrections (a dict) is given, the closest words of the keys that are not in any
+        token are put there (see did_you_mean).
+
+        The results are ranked lazily, by chunks; as no connection is held between them, the
+        iterator can be kept to get more results later.
         """
-        keys = list(map(normalize_words, keys))
+        return (entry for _, entry in self._search(keys, corrections))
+
+    def search_ranked(self, keys, corrections=None):
+        """Return the docids of the values found for those keys (see search), from the best
+        one to the worst.
+
+        All the results are ranked at once, so their values can be taken later from them
+        (see get_doc) without searching again.
+        """
+        return [docid for docid, _ in self._search(keys, corrections)]
+
+    def _search(self, keys, corrections):
+        """Start the search of the keys (see search); return the iterator of the docids and
+        values found."""
+        keys, phrases, near = parse_query(map(normalize_words, keys))
+        if not keys:
+            # only operators, nothing to search
+            return iter(())
+        with self.connection() as db:
+            if self.shards:
+                docset = ShardedSearch(self, keys, phrases, near)
+            else:
+                docset = Search(db, keys, self._rank if self.ranked else None, phrases, near)
+        if corrections is not None:
+            corrections.update(docset.corrections)
+        return self._search_results(docset, keys, phrases, near)
+
+    def _search_results(self, docset, keys, phrases, near):
+        """Yield the docids and values found by the search (see search)."""
         files_yielded = set()
-        docset = Search(self.db, keys)
-        for score, ndoc in docset.ordered:
-            doc_data = self.get_doc(ndoc)
-            # Do not return more than one index result to the same file.
-            if doc_data.link not in files_yielded:
-                files_yielded.add(doc_data.link)
-                yield doc_data
-            if len(files_yielded) >= MAX_RESULTS:
+        ranked = docset.ranked()
+        while True:
+            with self.connection() as db:
+                if not self.shards:
+                    # the quantity of words of the documents is read while ranking them
+                    docset.db = db
+                chunk = list(itertools.islice(ranked, SEARCH_CHUNK))
+            for score, ndoc in chunk:
+                doc_data = self.get_doc(ndoc)
+                # Do not return more than one index result to the same file.
+                if doc_data.link not in files_yielded:
+                    files_yielded.add(doc_data.link)
+                    yield ndoc, doc_data
+                if len(files_yielded) >= MAX_RESULTS:
+                    return
+            if len(chunk) < SEARCH_CHUNK:
                 break
 
+        # the positions of the words are not stored in the full text
+        if phrases or near:
+            return
+        if self.has_fulltext and len(files_yielded) < FULLTEXT_FALLBACK:
+            with self.connection() as db:
+                docids = self._search_fulltext(db, keys)
+            for ndoc in docids:
+                doc_data = self.get_doc(ndoc)
+                if doc_data.link not in files_yielded:
+                    files_yielded.add(doc_data.link)
+                    yield ndoc, doc_data
+                if len(files_yielded) >= MAX_RESULTS:
+                    return
+
+    def _search_fulltext(self, db, keys):
+        """Return the docids of the articles with words starting with all the keys in their
+        text, the most relevant (by BM25) first.
+
+        If it takes longer than the latency budget the search is interrupted, finding nothing.
+        """
+        query = " AND ".join('"{}"*'.format(key.replace('"', '""')) for key in keys if key)
+        if not query:
+            return []
+        deadline = time.monotonic() + self._fulltext_latency
+        db.set_progress_handler(lambda: time.monotonic() > deadline, FULLTEXT_CHECK_PERIOD)
+        sql = "SELECT rowid FROM fulltext WHERE fulltext MATCH ? ORDER BY rank LIMIT ?"
+        try:
+            docids = [row[0] for row in db.execute(sql, (query, MAX_RESULTS))]
+        except sqlite3.OperationalError as err:
+            logger.warning("Full text search of %r failed: %s", keys, err)
+            return []
+        finally:
+            db.set_progress_handler(None, 0)
+        return [docid for docid in docids if self._rank(docid) != DELETED_RANK]
+
+    def _best_docids(self, docids):
+        """Return the most important of the given docids, leaving out the deleted ones."""
+        if not self.ranked:
+            return heapq.nsmallest(SUGGEST_STORED, docids)
+        ranks = {docid: self._rank(docid) for docid in docids}
+        alive = [docid for docid, rank in ranks.items() if rank != DELETED_RANK]
+        return heapq.nsmallest(SUGGEST_STORED, alive, key=ranks.__getitem__)
+
+    def did_you_mean(self, text, corrections=None):
+        """Return the text with the words that are not in any token replaced by the closest
+        ones (the most used, between the equally close), or None if nothing is replaced.
+
+        The corrections found when searching the same text can be given (see search), so
+        the words are not looked for again.
+        """
+        words = normalize_words(text).split()
+        # keep the query operators
+        keys = [word.strip('"') for word in words]
+        if corrections is None:
+            corrections = {}
+            with self.connection() as db:
+                for key in keys:
+                    if not key or _NEAR_OPERATOR.match(key) or key in corrections:
+                        continue
+                    if any(True for _ in fetch_tokens(db, key)):
+                        continue
+                    close = get_close_tokens(db, key)
+                    if close:
+                        corrections[key] = closest_word(close)
+        replaced = False
+        for i, (word, key) in enumerate(zip(words, keys)):
+            if key in corrections and not _NEAR_OPERATOR.match(key):
+                words[i] = word.replace(key, corrections[key])
+                replaced = True
+        if replaced:
+            return " ".join(words)
+        return None
+
+    def _get_prefix_docids(self, prefix):
+        """Return the best docids of the documents with a word starting with the prefix."""
+        if len(prefix) <= SUGGEST_PREFIX_LENGTH:
+            rows = self._fetchall("SELECT docids FROM prefixes WHERE prefix = ?", (prefix,))
+            return self._best_docids(DocSet.delta_decode(rows[0][0])) if rows else []
+
+        # the tokens with this prefix are contiguous in the words index
+        sql = "SELECT docsets FROM tokens WHERE word >= ? AND word < ? LIMIT ?"
+        rows = self._fetchall(sql, (prefix, prefix + chr(0x10FFFF), SUGGEST_SCAN_LIMIT))
+        docids = set()
+        for row in rows:
+            if self.ranked:
+                # the best ones are not the first docids anymore
+                docids.update(DocSet.decode(row[0]).docids())
+            else:
+                docids.update(DocSet.first_docids(row[0], SUGGEST_STORED))
+        return self._best_docids(docids)
+
+    def suggest(self, text, quantity=SUGGEST_RESULTS):
+        """Return the best entries with a word starting with the last word of the text.
+
+        The entries are ordered by score, without repeating links.
+        """
+        words = normalize_words(text).split()
+        if not words:
+            return []
+        entries = []
+        links = set()
+        for docid in self._get_prefix_docids(words[-1]):
+            entry = self.get_doc(docid)
+            if entry.link not in links:
+                links.add(entry.link)
+                entries.append(entry)
+        entries.sort(key=operator.attrgetter('score'), reverse=True)
+        return entries[:quantity]
+
     @classmethod
-    def create(cls, directory, source):
+    def create(cls, directory, source, max_postings=MAX_POSTINGS_IN_MEMORY, workers=None,
+               fulltext_size=None, fulltext_text=None, shards=1, typos=True):
         """Create the index in the directory.
 
         The source must give path, page_score, title and
         a list of extracted words from title in an ordered fashion
         It must return the quantity of pairs indexed.
+
+        The source and the postings are kept in temporary files while building, holding
+        up to max_postings of the latter in memory. The pages of documents are compressed
+        using that quantity of worker processes (by default, one per CPU).
+
+        If fulltext_size is given, the description of the articles (and the text given for
+        their links by fulltext_text, if any) is indexed to be searched with FTS5, from the
+        most important articles up to that quantity of bytes of text.
+
+        With more than one shard, the postings of the tokens are also split in that quantity
+        of databases by ranges of docids, to search in them in parallel.
+
+        If typos is false, the variants of the tokens with deleted chars are not stored (so
+        the misspelled keys are not found), making the index much smaller.
         """
-        import pickletools
         import time
+        import tempfile
         from progress.bar import Bar
+        from progress.counter import Counter
 
         class SQLmany:
             """Execute many INSERTs greatly improves the performance."""
@@ -481,7 +1704,10 @@ class Index:
                 self.name = name
                 self.count = 0
                 self.buffer = []
-                self.progress_bar = Bar(name, max=quantity, suffix='%(index)d/%(max)d\r')
+                if quantity is None:
+                    self.progress_bar = Counter(name + ' ')
+                else:
+                    self.progress_bar = Bar(name, max=quantity, suffix='%(index)d/%(max)d\r')
 
             def append(self, data):
                 """Append one data set to persist on db."""
@@ -511,7 +1737,13 @@ class Index:
         class Compressed(SQLmany):
             """Creates the table of compressed documents information.
 
-            The groups is PAGE_SIZE word_quant, pickled and compressed."""
+            The groups is PAGE_SIZE word_quant, and the entries in a compressed DocsPage.
+            The pages are serialized and compressed in other processes, and committed in
+            order, with a bounded quantity of them in flight."""
+            def __init__(self, *args):
+                super().__init__(*args)
+                self.pending = deque()
+
             def persist(self):
                 """Compress and commit data to index."""
                 docs_data = []
@@ -519,71 +1751,214 @@ class Index:
                 for word_quant, data in self.buffer:
                     word_quants.append(word_quant)
                     docs_data.append(data)
-                pickdata = pickletools.optimize(pickle.dumps(docs_data))
-                comp_data = best_compressor.compress(pickdata)
                 page_id = (self.count - 1) // PAGE_SIZE
-                database.execute(self.sql, (page_id, word_quants.tobytes(), comp_data))
+                future = executor.submit(DocsPage.encode, docs_data)
+                self.pending.append((page_id, word_quants.tobytes(), future))
+                if len(self.pending) > max_in_flight:
+                    self.commit_oldest()
+
+            def commit_oldest(self):
+                """Wait for the oldest page in flight, and commit it."""
+                page_id, word_quants, future = self.pending.popleft()
+                database.execute(self.sql, (page_id, word_quants, future.result()))
+                database.commit()
+
+            def finish(self):
+                """Commit all the pages in flight too."""
+                super().finish()
+                while self.pending:
+                    self.commit_oldest()
+
+        class FullText(SQLmany):
+            """Store the text of the articles, until reaching its size limit."""
+            def __init__(self, *args):
+                super().__init__(*args)
+                self.size = 0
+
+            @property
+            def full(self):
+                """If there is no room for the text of more articles."""
+                return self.size >= fulltext_size
+
+            def append(self, data):
+                """Append the text of one article."""
+                docid, text = data
+                self.size += len(text.encode("utf8"))
+                super().append((docid, normalize_words(text)))
+
+            def finish(self):
+                """Finish the process and store the size used, to keep it in the updates."""
+                super().finish()
+                sql = "INSERT INTO params (name, value) VALUES (?, ?)"
+                database.executemany(
+                    sql, [("fulltext_size", fulltext_size), ("fulltext_used", self.size)])
                 database.commit()
 
+        class ShardTokens(SQLmany):
+            """Store the tokens of a shard, in its own database."""
+            def __init__(self, shardid):
+                self.shard_db = open_connection(shard_filename(directory, shardid))
+                self.shard_db.executescript(SHARD_SCRIPT)
+                sql = "insert into tokens (word, docsets) values (?, ?)"
+                super().__init__("Shard {} tokens".format(shardid), sql, None)
+
+            def persist(self):
+                """Commit data to the shard."""
+                self.shard_db.executemany(self.sql, self.buffer)
+                self.shard_db.commit()
+
+            def finish(self):
+                """Finish the process and close the shard."""
+                super().finish()
+                self.shard_db.close()
+
         def create_database():
             """Creates de basic structure of new database."""
             script = """
                 PRAGMA journal_mode = OFF;
                 PRAGMA synchronous = OFF;
                 CREATE TABLE tokens
-                    (word TEXT,
+                    (tokenid INTEGER PRIMARY KEY,
+                    word TEXT,
                     docsets BLOB);
+                CREATE TABLE trigrams
+                    (gram TEXT PRIMARY KEY,
+                    tokenids BLOB) WITHOUT ROWID;
+                CREATE TABLE prefixes
+                    (prefix TEXT PRIMARY KEY,
+                    docids BLOB) WITHOUT ROWID;
+                CREATE TABLE deletes
+                    (variant TEXT PRIMARY KEY,
+                    tokenids BLOB) WITHOUT ROWID;
+                CREATE TABLE short_keys
+                    (key TEXT PRIMARY KEY,
+                    tokens INTEGER) WITHOUT ROWID;
                 CREATE TABLE docs
                     (pageid INTEGER PRIMARY KEY,
                     word_quants BLOB,
                     data BLOB);
+                CREATE TABLE ranks
+                    (pageid INTEGER PRIMARY KEY,
+                    ranks BLOB);
+                CREATE TABLE shards
+                    (shardid INTEGER PRIMARY KEY,
+                    first_docid INTEGER);
+                CREATE TABLE params
+                    (name TEXT PRIMARY KEY,
+                    value INTEGER) WITHOUT ROWID;
                 """
 
             database.executescript(script)
+            if fulltext_size is not None:
+                database.execute(FULLTEXT_TABLE)
 
-        def add_docs_keys(source):
-            """Add docs and keys registers to db and its rel in memory."""
-            idx_dict = defaultdict(DocSet)
+        def add_docs_keys(quantity, source):
+            """Add docs registers to db and collect the postings of its keys."""
+            postings = PostingsRuns(tempdir, max_postings)
             sql = "INSERT INTO docs (pageid, word_quants, data) VALUES (?, ?, ?)"
-            docs_table = Compressed("Documents", sql, len(source))
-
-            for title, link, score, description, orig_words, redir_words in source:
-                idx_entry = IndexEntry(
-                    link=link,
-                    title=title,
-                    score=score,
-                    rtype=IndexEntry.TYPE_ORIG_ARTICLE,
-                    description=description)
-                if idx_entry.link == to_filename(idx_entry.title):
-                    idx_entry.link = None
-                    idx_entry.rtype = IndexEntry.TYPE_ORIG_SIMPLE_LINK
-                orig_docid = docs_table.append((len(orig_words), idx_entry))
-                for idx, word in enumerate(orig_words):
-                    idx_dict[word].append(orig_docid, idx)
-                for word_set in redir_words:
-                    redir_entry = IndexEntry(
-                        link=None,
-                        title=None,
-                        subtitle=' '.join(word_set),
-                        score=0,
-                        rtype=IndexEntry.TYPE_REDIRECT,
-                        orig_docid=orig_docid)
-                    redir_docid = docs_table.append((len(word_set), redir_entry))
-                    for idx, word in enumerate(word_set):
-                        idx_dict[word].append(redir_docid, idx)
+            docs_table = Compressed("Documents", sql, quantity)
+            if fulltext_size is not None:
+                sql = "INSERT INTO fulltext (rowid, text) VALUES (?, ?)"
+                fulltext_table = FullText("Full text", sql, None)
+
+            for docid, idx_entry, words in source_documents(source):
+                docs_table.append((len(words), idx_entry))
+                for idx, word in enumerate(words):
+                    postings.append(word, docid, idx)
+                if fulltext_size is None or idx_entry.rtype == IndexEntry.TYPE_REDIRECT:
+                    continue
+                # the text of the articles is not even read once there is no room for it
+                if not fulltext_table.full:
+                    fulltext_table.append((docid, article_text(idx_entry, fulltext_text)))
 
             docs_table.finish()
-            return idx_dict
-
-        def add_tokens_to_db(idx_dict):
-            """Insert token words in the database."""
-            sql_ins = "insert into tokens (word, docsets) values (?, ?)"
-            token_store = SQLmany("Tokens", sql_ins, len(idx_dict))
-            for word, docs_list in idx_dict.items():
+            if fulltext_size is not None:
+                fulltext_table.finish()
+            return postings, docs_table.count
+
+        def create_shards(docs_quantity):
+            """Create the shards, return their stores of tokens and the docids in each one."""
+            if shards <= 1:
+                return [], docs_quantity
+            shard_size = math.ceil(docs_quantity / shards)
+            stores = []
+            for shardid, first_docid in enumerate(range(0, docs_quantity, shard_size)):
+                database.execute("INSERT INTO shards (shardid, first_docid) VALUES (?, ?)",
+                                 (shardid, first_docid))
+                stores.append(ShardTokens(shardid))
+            database.commit()
+            return stores, shard_size
+
+        def add_tokens_to_db(postings, shard_stores, shard_size):
+            """Insert token words in the database (and their postings in the shards).
+
+            Return the n-grams of them, the best docids for their short prefixes, the
+            variants of them with deleted chars (collected as the "postings" of the tokens),
+            and the quantity of tokens that have each of the short keys.
+            """
+            grams_dict = defaultdict(lambda: array.array('I'))
+            prefixes_dict = defaultdict(list)
+            short_keys_dict = defaultdict(int)
+            variants = PostingsRuns(tempdir, max_postings, name="deletes")
+            sql_ins = "insert into tokens (tokenid, word, docsets) values (?, ?, ?)"
+            token_store = SQLmany("Tokens", sql_ins, None)
+            for tokenid, (word, docs_list) in enumerate(postings.docsets()):
                 logger.debug("Word: %s %r" % (word, docs_list))
                 dict_stats["Indexed"] += len(docs_list)
-                token_store.append((word, docs_list))
+                token_store.append((tokenid, word, docs_list))
+                for shardid, shard_store in enumerate(shard_stores):
+                    first_docid = shardid * shard_size
+                    shard_docset = docs_list.docids_range(first_docid, first_docid + shard_size)
+                    if shard_docset:
+                        shard_store.append((word, shard_docset))
+                for gram in ngrams(word):
+                    grams_dict[gram].append(tokenid)
+                for key in short_keys(word):
+                    short_keys_dict[key] += 1
+                if typos and len(word) >= TYPO_MIN_LENGTH:
+                    for variant in deletes(word):
+                        variants.append(variant, tokenid, 0)
+                best_docids = docs_list.docids()[:SUGGEST_STORED]
+                for size in range(1, min(len(word), SUGGEST_PREFIX_LENGTH) + 1):
+                    prefix = word[:size]
+                    prefixes_dict[prefix] = heapq.nsmallest(
+                        SUGGEST_STORED, set(prefixes_dict[prefix]).union(best_docids))
             token_store.finish()
+            for shard_store in shard_stores:
+                shard_store.finish()
+            return grams_dict, prefixes_dict, variants, short_keys_dict
+
+        def add_deletes_to_db(variants):
+            """Insert the variants of the tokens with deleted chars, with their tokenids."""
+            sql_ins = "insert into deletes (variant, tokenids) values (?, ?)"
+            deletes_store = SQLmany("Deletes", sql_ins, None)
+            for variant, docset in variants.docsets():
+                deletes_store.append((variant, DocSet.delta_encode(docset.docids())))
+            deletes_store.finish()
+
+        def add_ngrams_to_db(grams_dict):
+            """Insert the n-grams with the (ordered) ids of the tokens that include them."""
+            sql_ins = "insert into trigrams (gram, tokenids) values (?, ?)"
+            gram_store = SQLmany("Trigrams", sql_ins, len(grams_dict))
+            for gram, tokenids in grams_dict.items():
+                gram_store.append((gram, DocSet.delta_encode(tokenids)))
+            gram_store.finish()
+
+        def add_short_keys_to_db(short_keys_dict):
+            """Insert the keys too short for the n-grams, with the quantity of tokens with them."""
+            sql_ins = "insert into short_keys (key, tokens) values (?, ?)"
+            short_keys_store = SQLmany("Short keys", sql_ins, len(short_keys_dict))
+            for key, tokens in short_keys_dict.items():
+                short_keys_store.append((key, tokens))
+            short_keys_store.finish()
+
+        def add_prefixes_to_db(prefixes_dict):
+            """Insert the short prefixes with the (ordered) best docids for them."""
+            sql_ins = "insert into prefixes (prefix, docids) values (?, ?)"
+            prefix_store = SQLmany("Prefixes", sql_ins, len(prefixes_dict))
+            for prefix, docids in prefixes_dict.items():
+                prefix_store.append((prefix, DocSet.delta_encode(docids)))
+            prefix_store.finish()
 
         def create_indexes():
             script = '''
@@ -598,14 +1973,270 @@ class Index:
         keyfilename = os.path.join(directory, "index.sqlite")
         database = open_connection(keyfilename)
         create_database()
-        ordered_source = sorted(source, reverse=True, key=operator.itemgetter(2))
-        if not ordered_source:
-            raise ValueError("No data to index")
-        idx_dict = add_docs_keys(ordered_source)
-        add_tokens_to_db(idx_dict)
+        database.executemany("INSERT INTO params (name, value) VALUES (?, ?)", [
+            ("typos", typos), ("shards", shards), ("fulltext_body", fulltext_text is not None)])
+        if workers is None:
+            workers = os.cpu_count() or 1
+        max_in_flight = 2 * workers
+        with tempfile.TemporaryDirectory() as tempdir:
+            quantity, ordered_source = sorted_by_score(source, tempdir)
+            if not quantity:
+                raise ValueError("No data to index")
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+                postings, docs_quantity = add_docs_keys(quantity, ordered_source)
+            shard_stores, shard_size = create_shards(docs_quantity)
+            grams_dict, prefixes_dict, variants, short_keys_dict = add_tokens_to_db(
+                postings, shard_stores, shard_size)
+            add_deletes_to_db(variants)
+        add_ngrams_to_db(grams_dict)
+        add_short_keys_to_db(short_keys_dict)
+        add_prefixes_to_db(prefixes_dict)
         create_indexes()
         dict_stats["Total time"] = int(time.time() - initial_time)
         # Finally, show some statistics.
         for k, v in dict_stats.items():
             logger.info("{:>20}:{}".format(k, v))
         return dict_stats["Indexed"]
+
+    @staticmethod
+    def stored_params(directory):
+        """Return the parameters used to create the index in the directory (see create):
+        fulltext_size (None if the full text was not indexed), fulltext_body (if some text
+        was given for the articles besides their description), shards and typos."""
+        database = open_connection(os.path.join(directory, "index.sqlite"))
+        try:
+            params = dict(database.execute("SELECT name, value FROM params"))
+        finally:
+            database.close()
+        return {
+            "fulltext_size": params.get("fulltext_size"),
+            "fulltext_body": bool(params.get("fulltext_body")),
+            "shards": params.get("shards", 1),
+            "typos": bool(params.get("typos", True)),
+        }
+
+    @classmethod
+    def update(cls, directory, source, removed=(), rescored=None, fulltext_text=None,
+               fulltext_size=None):
+        """Apply a delta to the index in the directory, instead of recreating it.
+
+        The source gives the added articles (as the one used to create the index), removed
+        the links of the articles to take out, and rescored the new scores of some links.
+
+        The documents of the added articles are appended in new pages and their postings
+        merged in the DocSets of the tokens; the removed ones are just marked as deleted.
+        As the docids don't follow the importance of the documents anymore, their ranks are
+        stored, rewriting only the pages of ranks that changed (and the best documents of
+        the short prefixes are found again by them). If the full text of the articles was
+        indexed, the one of the added articles is included while the size of all of them is
+        under fulltext_size (by default, the one used when creating the index).
+
+        It returns the quantity of added documents.
+        """
+        removed = set(removed)
+        rescored = rescored or {}
+        database = open_connection(os.path.join(directory, "index.sqlite"))
+        sql = "SELECT count(*) FROM sqlite_master WHERE name = 'fulltext'"
+        has_fulltext = database.execute(sql).fetchone()[0] > 0
+        params = dict(database.execute("SELECT name, value FROM params"))
+        if fulltext_size is None:
+            fulltext_size = params.get("fulltext_size")
+        fulltext_used = params.get("fulltext_used", 0)
+        typos = params.get("typos", True)
+
+        # the ranks of a previous update, if any
+        old_ranks = array.array('I')
+        for _, ranks in database.execute("SELECT pageid, ranks FROM ranks ORDER BY pageid"):
+            old_ranks.frombytes(ranks)
+
+        # walk the current docs, rescoring the articles and finding the removed ones
+        orig_docids = array.array('I')
+        scores = array.array('I')
+        deleted = set()
+        last_entries, last_quants = [], array.array('B')
+        sql = "SELECT pageid, word_quants, data FROM docs ORDER BY pageid"
+        for pageid, word_quants, data in database.execute(sql).fetchall():
+            entries = list(DocsPage.decode(data))
+            changed = False
+            for idx, entry in enumerate(entries):
+                docid = pageid * PAGE_SIZE + idx
+                if old_ranks and old_ranks[docid] == DELETED_RANK:
+                    deleted.add(docid)
+                if entry.rtype == IndexEntry.TYPE_REDIRECT:
+                    orig_docids.append(entry.orig_docid)
+                    scores.append(0)
+                    continue
+                orig_docids.append(docid)
+                link = entry.link
+                if entry.rtype == IndexEntry.TYPE_ORIG_SIMPLE_LINK:
+                    link = to_filename(entry.title)
+                if link in removed:
+                    deleted.add(docid)
+                elif link in rescored and rescored[link] != entry.score:
+                    entry.score = rescored[link]
+                    changed = True
+                scores.append(entry.score)
+            if changed:
+                sql = "UPDATE docs SET data = ? WHERE pageid = ?"
+                database.execute(sql, (DocsPage.encode(entries), pageid))
+            last_entries = entries
+            last_quants = array.array('B', word_quants)
+
+        # append the new documents, completing the last page
+        quantity = len(orig_docids)
+        if quantity % PAGE_SIZE == 0:
+            last_entries, last_quants = [], array.array('B')
+        new_postings = defaultdict(DocSet)
+        source = sorted(source, key=operator.itemgetter(2), reverse=True)
+        sql = "INSERT OR REPLACE INTO docs (pageid, word_quants, data) VALUES (?, ?, ?)"
+        for docid, idx_entry, words in source_documents(source, quantity):
+            last_entries.append(idx_entry)
+            last_quants.append(len(words))
+            if idx_entry.rtype == IndexEntry.TYPE_REDIRECT:
+                orig_docids.append(idx_entry.orig_docid)
+            else:
+                orig_docids.append(docid)
+                if has_fulltext and fulltext_used < fulltext_size:
+                    text = article_text(idx_entry, fulltext_text)
+                    fulltext_used += len(text.encode("utf8"))
+                    database.execute("INSERT INTO fulltext (rowid, text) VALUES (?, ?)",
+                                     (docid, normalize_words(text)))
+            scores.append(idx_entry.score)
+            for idx, word in enumerate(words):
+                new_postings[word].append(docid, idx)
+            if len(last_entries) == PAGE_SIZE:
+                database.execute(sql, (docid // PAGE_SIZE, last_quants.tobytes(),
+                                       DocsPage.encode(last_entries)))
+                last_entries, last_quants = [], array.array('B')
+        if last_entries and len(orig_docids) > quantity:
+            database.execute(sql, ((len(orig_docids) - 1) // PAGE_SIZE, last_quants.tobytes(),
+                                   DocsPage.encode(last_entries)))
+        added = len(orig_docids) - quantity
+        if has_fulltext:
+            sql = "INSERT OR REPLACE INTO params (name, value) VALUES (?, ?)"
+            database.executemany(
+                sql, [("fulltext_size", fulltext_size), ("fulltext_used", fulltext_used)])
+
+        # merge the postings in the tokens, adding the new ones to the n-grams,
+        # deletes and short keys
+        new_grams = defaultdict(list)
+        new_variants = defaultdict(list)
+        new_short_keys = defaultdict(int)
+        tokenid = database.execute("SELECT max(tokenid) FROM tokens").fetchone()[0]
+        for word, docset in sorted(new_postings.items()):
+            row = database.execute(
+                "SELECT tokenid, docsets FROM tokens WHERE word = ?", (word,)).fetchone()
+            if row is None:
+                tokenid += 1
+                sql = "INSERT INTO tokens (tokenid, word, docsets) VALUES (?, ?, ?)"
+                database.execute(sql, (tokenid, word, docset))
+                for gram in ngrams(word):
+                    new_grams[gram].append(tokenid)
+                for key in short_keys(word):
+                    new_short_keys[key] += 1
+                if typos and len(word) >= TYPO_MIN_LENGTH:
+                    for variant in deletes(word):
+                        new_variants[variant].append(tokenid)
+            else:
+                merged = DocSet.decode(row[1])
+                for docid, positions in docset.items():
+                    for position in positions:
+                        merged.append(docid, position)
+                sql = "UPDATE tokens SET docsets = ? WHERE tokenid = ?"
+                database.execute(sql, (merged, row[0]))
+        for gram, tokenids in new_grams.items():
+            row = database.execute(
+                "SELECT tokenids FROM trigrams WHERE gram = ?", (gram,)).fetchone()
+            if row is not None:
+                tokenids = DocSet.delta_decode(row[0]) + tokenids
+            sql = "INSERT OR REPLACE INTO trigrams (gram, tokenids) VALUES (?, ?)"
+            database.execute(sql, (gram, DocSet.delta_encode(tokenids)))
+        for variant, tokenids in new_variants.items():
+            row = database.execute(
+                "SELECT tokenids FROM deletes WHERE variant = ?", (variant,)).fetchone()
+            if row is not None:
+                tokenids = DocSet.delta_decode(row[0]) + tokenids
+            sql = "INSERT OR REPLACE INTO deletes (variant, tokenids) VALUES (?, ?)"
+            database.execute(sql, (variant, DocSet.delta_encode(tokenids)))
+        for key, tokens in new_short_keys.items():
+            row = database.execute(
+                "SELECT tokens FROM short_keys WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                tokens += row[0]
+            sql = "INSERT OR REPLACE INTO short_keys (key, tokens) VALUES (?, ?)"
+            database.execute(sql, (key, tokens))
+
+        # the new docids are in the range of the last shard, if the index is split
+        row = database.execute("SELECT max(shardid) FROM shards").fetchone()
+        if row[0] is not None:
+            shard_db = open_connection(shard_filename(directory, row[0]))
+            for word, docset in new_postings.items():
+                row = shard_db.execute(
+                    "SELECT docsets FROM tokens WHERE word = ?", (word,)).fetchone()
+                if row is not None:
+                    merged = DocSet.decode(row[0])
+                    for docid, positions in docset.items():
+                        for position in positions:
+                            merged.append(docid, position)
+                    docset = merged
+                sql = "INSERT OR REPLACE INTO tokens (word, docsets) VALUES (?, ?)"
+                shard_db.execute(sql, (word, docset))
+            shard_db.commit()
+            shard_db.close()
+
+        # rank the articles by score (keeping the previous order between the ones with the
+        # same score), each one followed by its redirects
+        redirects = defaultdict(list)
+        articles = []
+        for docid, orig_docid in enumerate(orig_docids):
+            if orig_docid == docid:
+                if docid not in deleted:
+                    articles.append(docid)
+            else:
+                redirects[orig_docid].append(docid)
+
+        def previous_rank(docid):
+            if docid < len(old_ranks):
+                return old_ranks[docid]
+            return docid
+        articles.sort(key=lambda docid: (-scores[docid], previous_rank(docid)))
+        ranks = array.array('I', [DELETED_RANK]) * len(orig_docids)
+        rank = 0
+        for docid in articles:
+            ranks[docid] = rank
+            rank += 1
+            for redir_docid in redirects[docid]:
+                ranks[redir_docid] = rank
+                rank += 1
+        sql = "INSERT OR REPLACE INTO ranks (pageid, ranks) VALUES (?, ?)"
+        for start in range(0, len(ranks), PAGE_SIZE):
+            page_ranks = ranks[start:start + PAGE_SIZE]
+            if page_ranks != old_ranks[start:start + PAGE_SIZE]:
+                database.execute(sql, (start // PAGE_SIZE, page_ranks.tobytes()))
+
+        # recompute the best docids of the short prefixes, as not only the added documents
+        # may be among them (the rescored and removed ones change the best of any prefix)
+        docid_of_rank = {rank: docid for docid, rank in enumerate(ranks) if rank != DELETED_RANK}
+        prefixes_dict = defaultdict(list)
+        for word, encoded in database.execute("SELECT word, docsets FROM tokens").fetchall():
+            docids = DocSet.first_docids(encoded, DocSet.postings_quantity(encoded))
+            best_ranks = heapq.nsmallest(SUGGEST_STORED, (
+                ranks[docid] for docid in docids if ranks[docid] != DELETED_RANK))
+            if not best_ranks:
+                continue
+            for size in range(1, min(len(word), SUGGEST_PREFIX_LENGTH) + 1):
+                prefix = word[:size]
+                prefixes_dict[prefix] = heapq.nsmallest(
+                    SUGGEST_STORED, set(prefixes_dict[prefix]).union(best_ranks))
+        database.execute("DELETE FROM prefixes")
+        sql = "INSERT INTO prefixes (prefix, docids) VALUES (?, ?)"
+        for prefix, best_ranks in prefixes_dict.items():
+            best = sorted(docid_of_rank[rank] for rank in best_ranks)
+            database.execute(sql, (prefix, DocSet.delta_encode(best)))
+
+        database.commit()
+        database.execute("vacuum")
+        database.close()
+        logger.info("Index updated: %d docs added, %d articles removed, %d rescored",
+                    added, len(removed), len(rescored))
+        return added
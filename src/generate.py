@@ -198,6 +198,11 @@ def gen_run_config(lang_config):
     f.write('import os\n\n')
     f.write('VERSION = %s\n' % repr(config.VERSION))
     f.write('SERVER_MODE = %s\n' % config.SERVER_MODE)
+    f.write('INDEX_IN_MEMORY = %s\n' % config.INDEX_IN_MEMORY)
+    f.write('INDEX_HOT_PAGES = %d\n' % config.INDEX_HOT_PAGES)
+    fulltext = config.imageconf.get('fulltext') or {}
+    latency = fulltext.get('max_latency', config.INDEX_FULLTEXT_LATENCY)
+    f.write('INDEX_FULLTEXT_LATENCY = %d\n' % latency)
     f.write('EDICION_ESPECIAL = %s\n' % repr(config.EDICION_ESPECIAL))
     f.write('HOSTNAME = "%s"\n' % config.HOSTNAME)
     f.write('PORT = %d\n' % config.PORT)
@@ -207,6 +212,10 @@ def gen_run_config(lang_config):
     f.write('DESTACADOS = {}\n'.format(config.DESTACADOS))
     f.write('BROWSER_WD_SECONDS = %d\n' % config.BROWSER_WD_SECONDS)
     f.write('SEARCH_RESULTS = %d\n' % config.SEARCH_RESULTS)
+    f.write('SEARCH_CACHE_SIZE = %d\n' % config.SEARCH_CACHE_SIZE)
+    f.write('SEARCH_CACHE_PERSIST = %s\n' % config.SEARCH_CACHE_PERSIST)
+    f.write('ARTICLES_CACHE_SIZE = %d\n' % config.ARTICLES_CACHE_SIZE)
+    f.write('ARTICLES_CACHE_SIZE_SERVER = %d\n' % config.ARTICLES_CACHE_SIZE_SERVER)
     f.write('LANGUAGE = "%s"\n' % config.LANGUAGE)
     f.write('URL_WIKIPEDIA = "%s"\n' % config.URL_WIKIPEDIA)
     f.write('PYTHON_DOCS_FILENAME = "%s"\n' % config.PYTHON_DOCS_FILENAME)
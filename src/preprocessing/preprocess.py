@@ -248,6 +248,7 @@ class PagesSelector(object):
 
         # used from outside to decided regenerate index, blocks, etc
         self._same_info_through_runs = None
+        self._previous_pages = None
 
     @property
     def top_pages(self):
@@ -263,6 +264,13 @@ class PagesSelector(object):
             raise ValueError("You need to first 'calculate' everything.")
         return self._same_info_through_runs
 
+    @property
+    def previous_pages(self):
+        """The list of top pages of the previous run (None if there wasn't one)."""
+        if not self._calculated:
+            raise ValueError("You need to first 'calculate' everything.")
+        return self._previous_pages
+
     def calculate(self):
         """Calculate the HTMLs with more score and store both lists."""
         self._calculated = True
@@ -300,6 +308,7 @@ class PagesSelector(object):
                     old_stuff.append((dir3, arch, int(score)))
                 if sorted(old_stuff) == sorted(self._top_pages):
                     self._same_info_through_runs = True
+                self._previous_pages = old_stuff
 
         if not self._same_info_through_runs:
             # previous info not there, or different: write to disk
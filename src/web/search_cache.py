@@ -0,0 +1,216 @@
+# Copyright 2021 CDPedistas (see AUTHORS.txt)
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# For further info, check  https://github.com/PyAr/CDPedia/
+
+"""Cache of the results of the searches done in the web server."""
+
+import array
+import collections
+import functools
+import json
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+# estimated bytes used by each result besides its texts (the tuple and the str objects)
+RESULT_OVERHEAD = 250
+
+# a result of a search, as shown in the pages
+SearchResult = collections.namedtuple('SearchResult', 'link title description')
+
+
+def is_private(directory):
+    """Tell if only the current user can access the directory (always, in the systems
+    without owners of the files)."""
+    if not hasattr(os, 'getuid'):
+        return True
+    stat = os.stat(directory)
+    return stat.st_uid == os.getuid() and not stat.st_mode & 0o077
+
+
+def result_size(result):
+    """Return the estimated bytes used by a result."""
+    return RESULT_OVERHEAD + sum(len(text or '') for text in result)
+
+
+class SearchResults:
+    """The results of a search, taken only when they are needed.
+
+    They can be sliced (or indexed) as a list. The search is done the first time some
+    result is needed, calling search: it returns the ids of all the results, ranked, and
+    the correction of the searched words (None if there is none). Only those ids are kept,
+    not the state of the search, and each result is taken from its id by get_result when
+    it's needed (and then kept too), so the search is never done again.
+
+    The correction is known after taking some result.
+    """
+
+    def __init__(self, search, get_result, ranked=None, results=(), correction=None):
+        self._search = search
+        self._get_result = get_result
+        self._ranked = None
+        self._results = list(results)
+        self.correction = correction
+        self.size = sum(result_size(result) for result in self._results)
+        self.size += len(correction or '')
+        if ranked is not None:
+            self._set_ranked(ranked)
+        self._lock = threading.Lock()
+
+    def _set_ranked(self, ranked):
+        """Keep the ids of the results, in the little memory of an array."""
+        self._ranked = array.array('I', ranked)
+        self.size += self._ranked.itemsize * len(self._ranked)
+
+    @property
+    def exhausted(self):
+        """If all the results were already taken."""
+        return self._ranked is not None and len(self._results) == len(self._ranked)
+
+    def _fetch(self, quantity):
+        """Take the results until having that quantity (all, if None)."""
+        if self._ranked is None:
+            ranked, correction = self._search()
+            self._set_ranked(ranked)
+            if correction is not None:
+                self.correction = correction
+                self.size += len(correction)
+        taken = [self._get_result(docid) for docid in self._ranked[len(self._results):quantity]]
+        self._results.extend(taken)
+        self.size += sum(result_size(result) for result in taken)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            needed = idx.stop
+        else:
+            needed = idx + 1
+        if needed is not None and needed <= 0:
+            # counting from the end, all are needed
+            needed = None
+        with self._lock:
+            self._fetch(needed)
+            return self._results[idx]
+
+    def taken(self):
+        """Return the ranked ids of the results (None if not searched yet), the results
+        already taken, and the correction of the searched words."""
+        with self._lock:
+            ranked = None if self._ranked is None else self._ranked.tolist()
+            return ranked, list(self._results), self.correction
+
+
+class SearchCache:
+    """The results of the last searches, by the normalized words searched.
+
+    The search function receives those words and returns the ranked ids of all the results
+    and the correction of the words, or None if they are not misspelled; get_result
+    returns the result of an id (see SearchResults). The least recently used results are
+    discarded when all of them take more than max_size bytes (estimated), and everything
+    is discarded if the version of the index changes.
+
+    If a filename is given the results are loaded from it, and saved there by save (as
+    JSON, in a directory only accessible by the user).
+    """
+
+    def __init__(self, search, get_result, max_size, filename=None):
+        self._search = search
+        self._get_result = get_result
+        self.max_size = max_size
+        self.filename = filename
+        self.hits = 0
+        self.misses = 0
+        self._version = None
+        self._entries = collections.OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        if filename is not None and os.path.exists(filename):
+            self._load()
+
+    def _new_results(self, key, *taken):
+        """Return the results of searching the key, with the ones already taken if given."""
+        return SearchResults(functools.partial(self._search, key), self._get_result, *taken)
+
+    def _load(self):
+        """Load the results saved in the file."""
+        try:
+            if not is_private(os.path.dirname(os.path.abspath(self.filename))):
+                raise ValueError("the directory is accessible by other users")
+            with open(self.filename, 'rt', encoding='utf8') as fh:
+                version, entries = json.load(fh)
+            loaded = []
+            for key, ranked, results, correction in entries:
+                key = tuple(key)
+                results = [SearchResult(*result) for result in results]
+                loaded.append((key, self._new_results(key, ranked, results, correction)))
+        except Exception as err:
+            logger.warning("Couldn't load the search cache from %r: %s", self.filename, err)
+            return
+        self._version = version
+        self._entries.update(loaded)
+        self._discard_oldest()
+        logger.info("Search cache loaded from %r: %d searches", self.filename, len(entries))
+
+    def _discard_oldest(self):
+        """Discard the least recently used results while all of them are too big."""
+        # the results grow while they are used, so their sizes are added again each time
+        self._size = sum(results.size for results in self._entries.values())
+        while self._size > self.max_size and len(self._entries) > 1:
+            _, results = self._entries.popitem(last=False)
+            self._size -= results.size
+
+    def get(self, key, version):
+        """Return the results of searching the key in that version of the index."""
+        with self._lock:
+            if version != self._version:
+                self._entries.clear()
+                self._version = version
+            results = self._entries.get(key)
+            if results is None:
+                self.misses += 1
+                results = self._entries[key] = self._new_results(key)
+            else:
+                self.hits += 1
+                self._entries.move_to_end(key)
+            self._discard_oldest()
+        return results
+
+    def stats(self):
+        """Return the hits and misses of the cache, and the searches and bytes it has."""
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'searches': len(self._entries), 'size': self._size}
+
+    def save(self):
+        """Save the results taken so far to the file, if any."""
+        if self.filename is None:
+            return
+        with self._lock:
+            entries = [(key,) + results.taken() for key, results in self._entries.items()]
+            data = (self._version, entries)
+        temp_filename = self.filename + '.tmp'
+        try:
+            directory = os.path.dirname(os.path.abspath(self.filename))
+            os.makedirs(directory, mode=0o700, exist_ok=True)
+            if not is_private(directory):
+                raise OSError("the directory is accessible by other users")
+            with open(temp_filename, 'wt', encoding='utf8') as fh:
+                json.dump(data, fh)
+            os.replace(temp_filename, self.filename)
+        except OSError as err:
+            logger.warning("Couldn't save the search cache to %r: %s", self.filename, err)
+            return
+        logger.info("Search cache saved to %r: %s", self.filename, self.stats())
@@ -28,6 +28,28 @@ re_header = re.compile(r'\<h1 id="firstHeading" class="firstHeading"\>([^\<]*)\<
 re_title = re.compile('<title>(.*)</title>')
 
 
+class MemoryViewFile(object):
+    """A read only file over a memoryview, to send it in chunks.
+
+    The chunks are bytes (as the WSGI servers need), so only one of them is copied at a time.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.position = 0
+
+    def read(self, size=-1):
+        start = self.position
+        if size < 0:
+            self.position = len(self.data)
+        else:
+            self.position = min(start + size, len(self.data))
+        return self.data[start:self.position].tobytes()
+
+    def close(self):
+        self.data.release()
+
+
 class TemplateManager(object):
     """Handle templates from disk."""
 
@@ -16,9 +16,10 @@
 #
 # For further info, check  https://github.com/PyAr/CDPedia/
 
-import functools
+import atexit
 import gettext
 import itertools
+import json
 import logging
 import os
 import posixpath
@@ -32,11 +33,13 @@ from werkzeug.wrappers import Request, Response
 from werkzeug.routing import Map, Rule
 from werkzeug.exceptions import HTTPException, NotFound, InternalServerError
 from werkzeug.utils import redirect
+from werkzeug.wsgi import wrap_file
 from jinja2 import Environment, FileSystemLoader
 
 import config
 from . import utils
 from .destacados import Destacados
+from .search_cache import SearchCache, SearchResult
 from src.armado import cdpindex
 from src.armado.cdpindex import normalize_words
 from src.armado import compresor
@@ -45,7 +48,16 @@ from .test_infra import load_test_infra_data
 from .utils import TemplateManager
 
 ARTICLES_BASE_URL = "wiki"
-SEARCH_CACHE_SIZE = 100
+
+# the pages of search results (not under /search, where any key could collide with the
+# other endpoints there)
+SEARCH_RESULTS_URL = "results"
+
+# seconds the browsers can keep the pages of search results (the index doesn't change)
+SEARCH_MAX_AGE = 3600
+
+# bytes of the chunks in which the images are sent
+IMAGE_CHUNK_SIZE = 64 * 1024
 
 logger = logging.getLogger(__name__)
 
@@ -84,16 +96,28 @@ class CDPedia:
         self.img_mngr = compresor.ImageManager(verbose=verbose)
         self.featured_mngr = Destacados(self.art_mngr, debug=False)
 
-        self.index = cdpindex.IndexInterface(config.DIR_INDICE)
+        self.index = cdpindex.IndexInterface(config.DIR_INDICE, config.INDEX_IN_MEMORY)
         self.index.start()
 
         self.tmpdir = os.path.join(tempfile.gettempdir(), "cdpedia")
+        cache_filename = None
+        if config.SEARCH_CACHE_PERSIST:
+            # not in tmpdir, whose files are served
+            cache_filename = os.path.join(
+                tempfile.gettempdir(), "cdpedia-search", "search_cache.json")
+        self.search_cache = SearchCache(
+            self._search_index, self._search_result, config.SEARCH_CACHE_SIZE * 1024 ** 2,
+            cache_filename)
+        if cache_filename is not None:
+            atexit.register(self.search_cache.save)
+
         self.url_map = Map([
             Rule('/', endpoint='main_page'),
             Rule('/%s/<path:name>' % ARTICLES_BASE_URL, endpoint='article'),
             Rule('/al_azar', endpoint='random'),
             Rule('/search', endpoint='search', methods=['POST']),
-            Rule('/search/<path:key>', endpoint='search_results'),
+            Rule('/search/suggest', endpoint='search_suggest'),
+            Rule('/%s/<path:key>' % SEARCH_RESULTS_URL, endpoint='search_results'),
             Rule('/images/<path:name>', endpoint='image'),
             Rule('/institucional/<path:path>', endpoint='institutional'),
             Rule('/watchdog/update', endpoint='watchdog_update'),
@@ -178,7 +202,12 @@ class CDPedia:
             img = img_template.render(width=width, height=height, show_text=show_text)
             return Response(img, mimetype='image/svg+xml')
         type_ = guess_type(name)[0]
-        return Response(asset_data, mimetype=type_)
+        # the image is sent by chunks from the mapped block, with the file wrapper of the
+        # server if it has one
+        body = wrap_file(request.environ, utils.MemoryViewFile(asset_data), IMAGE_CHUNK_SIZE)
+        response = Response(body, mimetype=type_, direct_passthrough=True)
+        response.content_length = len(asset_data)
+        return response
 
     def on_favicon(self, request):
         asset_file = os.path.join(config.DIR_ASSETS, 'static', 'misc', 'favicon.ico')
@@ -210,29 +239,68 @@ class CDPedia:
         link = "%s/%s" % (ARTICLES_BASE_URL, to3dirs.from_path(idx_entry.link))
         return redirect(urllib.parse.quote(link.encode("utf-8")))
 
-    @functools.lru_cache(SEARCH_CACHE_SIZE)
     def _search(self, search_string):
-        """Really do the search."""
-        search_string_norm = normalize_words(search_string)
-        words = search_string_norm.split()
-        results = list(self.index.search(words))
-
+        """Really do the search (or get its results from the cache)."""
+        words = tuple(normalize_words(search_string).split())
+        return self.search_cache.get(words, self.index.version())
+
+    def _search_index(self, words):
+        """Return the ranked docids of the results of searching the words in the index, and
+        the text with the misspelled words corrected (None if all of them are in the index)."""
+        corrections = {}
+        docids = self.index.search_ranked(list(words), corrections)
+        did_you_mean = None
+        if corrections:
+            did_you_mean = self.index.did_you_mean(" ".join(words), corrections)
+        return docids, did_you_mean
+
+    def _search_result(self, docid):
+        """Return the result of the search to show for a docid."""
+        entry = self.index.get_doc(docid)
         # remove 3 dirs from link and add the proper base url
-        for result in results:
-            result.link = "wiki/{}".format(
-                urllib.parse.quote(to3dirs.from_path(result.link), safe=()))
-
-        return results
+        return SearchResult(
+            "wiki/{}".format(urllib.parse.quote(to3dirs.from_path(entry.link), safe=())),
+            entry.title, entry.description)
 
     def on_search(self, request):
-        """Search he received keywords in the POST request in the index."""
+        """Redirect the keywords received in the POST request to the page of their results."""
         search_string = request.form.get("keywords", '')
         search_string = urllib.parse.unquote_plus(search_string)
         if not search_string:
             return redirect("/")
+        return redirect("/{}/{}".format(SEARCH_RESULTS_URL, urllib.parse.quote(search_string)))
 
-        results = self._search(search_string)
-        return self.render_template('search.html', search_string=search_string, results=results)
+    def on_search_results(self, request, key):
+        """Show a page of the results of searching the key in the index."""
+        try:
+            page = max(int(request.args.get("page", 1)), 1)
+        except ValueError:
+            page = 1
+        start = (page - 1) * config.SEARCH_RESULTS
+
+        # one more result is taken, to know if there is a next page
+        search_results = self._search(key)
+        results = search_results[start:start + config.SEARCH_RESULTS + 1]
+        next_page = page + 1 if len(results) > config.SEARCH_RESULTS else None
+        prev_page = page - 1 if page > 1 else None
+        # the correction was found (only once) by the search, if the words are misspelled
+        did_you_mean = search_results.correction if page == 1 else None
+        search_url = "/{}/{}".format(SEARCH_RESULTS_URL, urllib.parse.quote(key))
+        response = self.render_template(
+            'search.html', search_string=key, results=results[:config.SEARCH_RESULTS],
+            did_you_mean=did_you_mean, search_url=search_url,
+            prev_page=prev_page, next_page=next_page)
+        response.cache_control.max_age = SEARCH_MAX_AGE
+        return response
+
+    def on_search_suggest(self, request):
+        """Return as JSON the best articles for the prefix being written."""
+        text = request.args.get("q", '')
+        suggestions = [{
+            "title": entry.title,
+            "link": "/wiki/{}".format(urllib.parse.quote(to3dirs.from_path(entry.link), safe=())),
+        } for entry in self.index.suggest(text)]
+        return Response(json.dumps(suggestions), mimetype='application/json')
 
     def on_tutorial(self, request):
         tmpdir = os.path.join(self.tmpdir)
@@ -16,6 +16,9 @@
 
 """Tests for the cdpindex module."""
 
+import os
+import unicodedata
+
 import config
 from src.armado import cdpindex, to3dirs
 
@@ -36,6 +39,7 @@ def data(mocker, tmp_path):
     mocker.patch('config.LOG_TITLES', str(tmp_path / 'titles.txt'))
     mocker.patch('config.LOG_REDIRECTS', str(tmp_path / 'redirects.txt'))
     mocker.patch('config.DIR_INDICE', str(tmp_path / 'index'))
+    mocker.patch('config.imageconf', {})
     # url and titles that should exist after preprocessing
     with open(config.LOG_TITLES, 'wt', encoding='utf-8') as fh:
         fh.write('foo|foo|\n')
@@ -60,6 +64,33 @@ def test_word_normalization(text_raw, text_norm):
     assert text_norm == cdpindex.normalize_words(text_raw)
 
 
+def test_word_normalization_by_char():
+    """The fast normalization gives the same than decomposing the whole text."""
+    def reference(text):
+        text = unicodedata.normalize('NFKD', text)
+        return ''.join('' if unicodedata.combining(c) else c.lower() for c in text)
+
+    chars = [chr(code) for code in range(0x10000) if not 0xD800 <= code <= 0xDFFF]
+    assert [cdpindex.normalize_words(c) for c in chars] == [reference(c) for c in chars]
+    for text in ('Ǆemal ﬁn', 'Ⅻ ½', 'e\u0301\u0327', '𝐀𝐁 moño', 'ÁRBOL'):
+        assert cdpindex.normalize_words(text) == reference(text)
+
+
+def test_normalize_many(mocker):
+    """Normalize many texts at once, in batches."""
+    mocker.patch('src.armado.sqlite_index.NORMALIZE_BATCH', 2)
+    texts = ['FOO', 'ñandú', '', 'AC/DC', 'παϊδάκια']
+    assert list(cdpindex.normalize_many(texts)) == [
+        'foo', 'nandu', '', 'ac/dc', 'παιδακια']
+    assert list(cdpindex.normalize_many([])) == []
+
+
+def test_tokenize_many():
+    """Tokenize many titles at once."""
+    titles = ['Foo BAR', 'Grañón (La Rioja)', 'España_82']
+    assert list(cdpindex.tokenize_many(titles)) == [cdpindex.tokenize(t) for t in titles]
+
+
 def test_normal_entries_top_pages(index, data, mocker):
     """All entries from top_pages should be added to the index."""
     top_pages = [
@@ -147,6 +178,92 @@ def test_redirects_with_special_chars(index, data, mocker, title):
     assert len(entries) == 1
 
 
+def test_fulltext_by_image_type(index, data, mocker):
+    """The full text of the articles is indexed as configured for the image type."""
+    mocker.patch('config.imageconf', {'fulltext': {'max_size': 3, 'body': True}})
+    top_pages = [('f/o/o', 'foo', 10)]
+    mocker.patch('src.preprocessing.preprocess.pages_selector', mocker.Mock(top_pages=top_pages))
+    cdpindex.generate_from_html(None, None)
+    kwargs = index.create.call_args[1]
+    assert kwargs['fulltext_size'] == 3 * 1024 ** 2
+    assert kwargs['fulltext_text'] is cdpindex.article_text
+
+
+@pytest.mark.parametrize('imageconf, typos', (
+    ({}, True),
+    ({'typos': False}, False),
+))
+def test_typos_by_image_type(index, data, mocker, imageconf, typos):
+    """The misspelled words are tolerated as configured for the image type."""
+    mocker.patch('config.imageconf', imageconf)
+    top_pages = [('f/o/o', 'foo', 10)]
+    mocker.patch('src.preprocessing.preprocess.pages_selector', mocker.Mock(top_pages=top_pages))
+    cdpindex.generate_from_html(None, None)
+    assert index.create.call_args[1]['typos'] is typos
+
+
+def test_article_text(mocker, tmp_path):
+    """Get the text of the body of an article."""
+    mocker.patch('config.DIR_PAGSLISTAS', str(tmp_path))
+    os.makedirs(str(tmp_path / 'f' / 'o' / 'o'))
+    with open(str(tmp_path / 'f' / 'o' / 'o' / 'foo'), 'wt', encoding='utf-8') as fh:
+        fh.write('<html><h1>Foo</h1><div class="mw-parser-output"><p>Some <b>text</b>.</p>'
+                 '<p>More text</p></div></html>')
+    assert cdpindex.article_text('f/o/o/foo').split() == ['Some', 'text', '.', 'More', 'text']
+
+
+def test_incremental_update(index, data, mocker):
+    """Only the differences with the previous run are applied to the existing index."""
+    mocker.patch('config.INDEX_INCREMENTAL', True)
+    os.mkdir(config.DIR_INDICE)
+    open(os.path.join(config.DIR_INDICE, 'index.sqlite'), 'wb').close()
+    previous_pages = [
+        ('f/o/o', 'foo', 10000),
+        ('b/a/r', 'bar', 10000),
+        ('o/l/d', 'old', 10000),
+    ]
+    top_pages = [
+        ('f/o/o', 'foo', 10500),
+        ('b/a/r', 'bar', 30000),
+        ('b/a/z', 'baz', 10000),
+    ]
+    mocker.patch('src.preprocessing.preprocess.pages_selector', mocker.Mock(
+        top_pages=top_pages, previous_pages=previous_pages))
+    index.stored_params.return_value = {
+        'fulltext_size': None, 'fulltext_body': False, 'shards': 1, 'typos': True}
+    assert cdpindex.generate_from_html(None, None) == 3
+    assert index.create.call_count == 0
+    assert index.update.call_count == 1
+    directory, entries_gen, removed, rescored = index.update.call_args[0]
+    assert directory == config.DIR_INDICE
+    assert [entry[1] for entry in entries_gen] == ['b/a/z/baz']
+    assert removed == ['o/l/d/old']
+    assert rescored == {'b/a/r/bar': 80}
+    assert index.update.call_args[1] == {'fulltext_text': None, 'fulltext_size': None}
+
+
+@pytest.mark.parametrize('changed', (
+    {'fulltext_size': 3 * 1024 ** 2},
+    {'fulltext_body': True},
+    {'shards': 4},
+    {'typos': False},
+))
+def test_incremental_update_params_changed(index, data, mocker, changed):
+    """The index is created again if it was created with other parameters."""
+    mocker.patch('config.INDEX_INCREMENTAL', True)
+    mocker.patch('config.INDEX_SHARDS', 1)
+    os.mkdir(config.DIR_INDICE)
+    open(os.path.join(config.DIR_INDICE, 'index.sqlite'), 'wb').close()
+    pages = [('f/o/o', 'foo', 10000)]
+    mocker.patch('src.preprocessing.preprocess.pages_selector', mocker.Mock(
+        top_pages=pages, previous_pages=pages))
+    index.stored_params.return_value = dict(
+        {'fulltext_size': None, 'fulltext_body': False, 'shards': 1, 'typos': True}, **changed)
+    assert cdpindex.generate_from_html(None, None) == 1
+    assert index.update.call_count == 0
+    assert index.create.call_count == 1
+
+
 @pytest.mark.parametrize('title, expected_tokens', (
     ('Foo BAR', ['foo', 'bar']),
     ('José de San Martín', ['jose', 'de', 'san', 'martin']),
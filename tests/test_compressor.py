@@ -16,10 +16,12 @@
 
 """Tests for the 'compresor' module."""
 
+import sys
 import urllib.parse
 
 import config
-from src.armado.compresor import ArticleManager
+from src.armado.compresor import (
+    ArticleCache, ArticleManager, BlockHeader, BloqueImagenes, Comprimido, Redirect, name_hash)
 
 import pytest
 
@@ -28,16 +30,141 @@ import pytest
 def test_redirects(mocker, tmp_path, filename):
     """Check that redirects are correctly registered in article block."""
 
-    mocker.patch('config.DIR_PAGES_BLOCKS', str(tmp_path))
+    mocker.patch('config.DIR_PAGSLISTAS', str(tmp_path / 'pages'))
+    mocker.patch('config.DIR_PAGES_BLOCKS', str(tmp_path / 'blocks'))
+    mocker.patch('config.LANGUAGE_FILE', str(tmp_path / 'blocks' / 'language.txt'))
+    mocker.patch('src.armado.compresor.ArticleManager.archive_dir', str(tmp_path / 'blocks'))
     mocker.patch('config.LOG_REDIRECTS', str(tmp_path / 'redirects.txt'))
-    mocker.patch('src.armado.compresor.Comprimido')
-    top_pages = [('f/o/o', filename, 10)]
+    crear = mocker.patch('src.armado.compresor.Comprimido.crear')
+    top_pages = [('f/o/o', 'other', 10), ('f/o/o', filename, 10)]
     mocker.patch('src.preprocessing.preprocess.pages_selector', mocker.Mock(top_pages=top_pages))
+    for _, name, _ in top_pages:
+        page = tmp_path / 'pages' / 'f/o/o' / name
+        page.parent.mkdir(parents=True, exist_ok=True)
+        page.write_bytes(b'x' * 10)
 
     title = urllib.parse.unquote(filename)  # only should unquote special filesystem chars
     with open(config.LOG_REDIRECTS, 'w', encoding='utf-8') as fh:
-        fh.write('spam|{}\n'.format(title))
+        fh.write('spam|{}#fragment\n'.format(title))
+        fh.write('eggs|spam\n')  # a chain of redirects
+        fh.write('ham|missing\n')
 
     _, tot_archs, tot_redirs = ArticleManager.generar_bloques('es', None)
-    assert tot_archs == 1
-    assert tot_redirs == 1
+    assert tot_archs == 2
+    assert tot_redirs == 2
+
+    # both redirects point directly to the article, in the only block
+    (redirects, block, filenames, _), = [call[0] for call in crear.call_args_list]
+    assert block == 0
+    position = 10 if filenames[0][1] == 'other' else 0
+    expected = Redirect(filename, 0, position, 10)
+    assert sorted(redirects) == [('eggs', expected), ('spam', expected)]
+    assert (tmp_path / 'blocks' / 'numbloques.txt').read_text() == '1\n'
+    assert (tmp_path / 'blocks' / 'language.txt').read_text() == 'es\n'
+
+
+def test_articles_block(mocker, tmp_path):
+    """Read the articles from a block, compressed in several frames."""
+    mocker.patch('config.DIR_PAGSLISTAS', str(tmp_path / 'pages'))
+    mocker.patch('config.DIR_PAGES_BLOCKS', str(tmp_path))
+    mocker.patch('src.armado.compresor.FRAME_SIZE', 100)
+    articles = {'foo': b'foo' * 20, 'bar': b'bar' * 20, 'big': b'x' * 300, 'baz': b'',
+                'spam': 'ñandú'.encode('utf8') * 5}
+    for filename, content in articles.items():
+        page = tmp_path / 'pages' / 'f/o/o' / filename
+        page.parent.mkdir(parents=True, exist_ok=True)
+        page.write_bytes(content)
+
+    top_filenames = [('f/o/o', filename) for filename in articles]
+    header, _, _ = Comprimido.layout(top_filenames)
+    Comprimido.crear([('redir', Redirect('bar', 3, *header['bar']))], 3, top_filenames)
+
+    manager = mocker.Mock()
+    block = Comprimido(str(tmp_path / '00000003.cdp'), manager=manager)
+    assert block.frames == 4
+    for filename, content in sorted(articles.items()):
+        assert block.get_item(filename) == content
+    assert block.get_item('missing') is None
+    manager.archive_extension = '.cdp'
+    manager.getBloque.return_value = block
+    assert block.get_item('redir') == articles['bar']
+    manager.getBloque.assert_called_once_with('00000003.cdp')
+
+
+def test_block_header():
+    """Find the items in the header by their names."""
+    header = {'foo': (0, 10), 'Fóõ_Bàr': (10, 5), 'spam': Redirect('Fóõ_Bàr', 0, 10, 5),
+              'eggs': Redirect('other', 7, 123, 45)}
+    for i in range(100):
+        header['item{}'.format(i)] = (15 + i, 1)
+    encoded = BlockHeader.encode(header)
+    data = b'prefix' + encoded + b'articles'
+    block_header = BlockHeader(data, 6)
+    assert len(block_header) == len(header)
+    for name, info in header.items():
+        assert block_header.get(name) == info
+        assert name in block_header
+    assert block_header.get('missing') is None
+    assert 'missing' not in block_header
+    assert sorted(block_header.values(), key=str) == sorted(header.values(), key=str)
+    assert sorted(block_header.items()) == sorted(
+        (name_hash(name), info) for name, info in header.items())
+
+
+def test_images_block(mocker, tmp_path):
+    """Read the images from a block."""
+    mocker.patch('config.DIR_IMGSLISTAS', str(tmp_path / 'images'))
+    mocker.patch('config.DIR_IMAGES_BLOCKS', str(tmp_path))
+    images = {'a/foo.png': b'foo', 'b/bar.jpg': b'bar' * 100}
+    for filename, content in images.items():
+        image = tmp_path / 'images' / filename
+        image.parent.mkdir(parents=True, exist_ok=True)
+        image.write_bytes(content)
+
+    BloqueImagenes.crear(7, list(images))
+    block = BloqueImagenes(str(tmp_path / '00000007.cdi'))
+    for filename, content in images.items():
+        item = block.get_item(filename)
+        assert isinstance(item, memoryview)
+        assert item == content
+        item.release()
+    assert block.get_item('missing') is None
+    block.close()
+
+
+def test_article_cache():
+    """Keep the last articles used while they fit in the cache."""
+    article_size = sys.getsizeof('x' * 100)
+    cache = ArticleCache(article_size * 2)
+    cache.put('foo', 'x' * 100)
+    cache.put('bar', 'y' * 100)
+    assert cache.get('foo') == 'x' * 100  # bar is now the least recently used
+    cache.put('baz', 'z' * 100)
+    assert cache.get('bar') is None
+    assert cache.get('baz') == 'z' * 100
+    cache.put('big', 'x' * 1000)  # bigger than the whole cache
+    assert cache.get('big') is None
+    assert cache.stats() == {'hits': 2, 'misses': 2, 'hit_rate': 0.5,
+                             'articles': 2, 'size': article_size * 2}
+
+
+def test_article_manager_cached(mocker, tmp_path):
+    """Decompress the articles only the first time they are read."""
+    mocker.patch('config.DIR_PAGSLISTAS', str(tmp_path / 'pages'))
+    mocker.patch('config.DIR_PAGES_BLOCKS', str(tmp_path))
+    mocker.patch.object(ArticleManager, 'archive_dir', str(tmp_path))
+    page = tmp_path / 'pages' / 'f/o/o' / 'foo'
+    page.parent.mkdir(parents=True)
+    page.write_bytes('ñandú'.encode('utf8'))
+    Comprimido.crear([('redir', Redirect('foo', 0, 0, 8))], 0, [('f/o/o', 'foo')])
+    ArticleManager.guardarNumBloques(1)
+
+    manager = ArticleManager(cache_size=1)
+    read = mocker.spy(Comprimido, '_read')
+    assert manager.get_item('foo') == 'ñandú'
+    assert manager.get_item('foo') == 'ñandú'
+    assert manager.get_item('redir') == 'ñandú'
+    assert manager.get_item('redir') == 'ñandú'
+    assert manager.get_item('missing') is None
+    assert read.call_count == 2
+    assert manager.cache.stats()['hits'] == 2
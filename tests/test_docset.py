@@ -129,3 +129,66 @@ def test_to_empty_title():
     """Test to filename w/empty title error."""
     with pytest.raises(ValueError):
         sqlite_index.to_filename('')
+
+
+# ----- Test the sorted sequences intersection
+
+
+@pytest.mark.parametrize('small, large, expected', (
+    ([], [1, 2, 3], []),
+    ([2], [1, 2, 3], [2]),
+    ([0, 4], [1, 2, 3], []),
+    ([1, 3, 40, 41], list(range(0, 50, 1)), [1, 3, 40, 41]),
+    ([5, 17, 99, 1000], list(range(0, 1000, 3)), [99]),
+    ([2, 6], [0, 2, 6, 7], [2, 6]),
+))
+def test_intersect_sorted(small, large, expected):
+    """Intersect galloping through the large sequence."""
+    assert sqlite_index.intersect_sorted(small, large) == expected
+
+
+def test_postings_quantity():
+    """Count the postings without decoding."""
+    docset = sqlite_index.DocSet()
+    docset.append(3, 1)
+    docset.append(3, 2)
+    docset.append(700, 0)
+    assert sqlite_index.DocSet.postings_quantity(docset.encode()) == 3
+    assert sqlite_index.DocSet.postings_quantity(sqlite_index.DocSet().encode()) == 0
+
+
+def test_items_for():
+    """Get only the positions of some documents."""
+    docset = sqlite_index.DocSet()
+    for docid in range(10):
+        docset.append(docid, docid + 1)
+    assert dict(docset.items_for({2, 5, 20})) == {2: [3], 5: [6]}
+    assert dict(docset.items_for(set(range(5, 100)))) == {d: [d + 1] for d in range(5, 10)}
+
+
+@pytest.mark.parametrize('values', (
+    [],
+    [0, 1, 2, 3],
+    [127, 128, 129, 300, 16383, 16384, 16385],
+    [5, 2 ** 20, 2 ** 20 + 1, 2 ** 28 + 7, 2 ** 31],
+))
+def test_delta_encode_decode_multibyte(values):
+    """Encode and decode numbers using one or several bytes each."""
+    encoded = sqlite_index.DocSet.delta_encode(values)
+    assert sqlite_index.DocSet.delta_decode(encoded) == values
+
+
+def test_delta_encode_format():
+    """The deltas are stored as little-endian 7 bits groups, with a continuation flag."""
+    assert sqlite_index.DocSet.delta_encode([3, 5, 305]) == bytes([3, 2, 0xAC, 0x02])
+
+
+def test_decode_docset_sorted():
+    """Pairs appended out of order are handled."""
+    docset = sqlite_index.DocSet()
+    for docid, pos in [(5, 1), (2, 0), (5, 0), (300, 2)]:
+        docset.append(docid, pos)
+    assert list(docset.items()) == [(2, [0]), (5, [0, 1]), (300, [2])]
+    assert docset.docids() == [2, 5, 300]
+    decoded = sqlite_index.DocSet.decode(docset.encode())
+    assert list(decoded.items()) == list(docset.items())
@@ -15,6 +15,13 @@
 # For further info, check  https://github.com/PyAr/CDPedia/
 
 
+import gc
+import os
+import sqlite3
+import threading
+import weakref
+from unittest import mock
+
 import pytest
 
 from src.armado import sqlite_index
@@ -212,3 +219,909 @@ def test_redir(create_index):
     idx_entry.rtype = IndexEntry.TYPE_REDIRECT
     idx_entry.subtitle = "zzz xxx"
     assert set(res) == {idx_entry}
+
+
+# --- Test the n-grams search.
+
+
+def test_ngrams():
+    """Get the n-grams of a word."""
+    assert sqlite_index.ngrams("blanca") == {"bla", "lan", "anc", "nca"}
+    assert sqlite_index.ngrams("abc") == {"abc"}
+    assert sqlite_index.ngrams("ab") == set()
+
+
+def test_search_infix(create_index):
+    """Match a key in the middle of the words, using the n-grams."""
+    idx = create_index(to_idx_data(["ala blanca", "conejo blanco", "conejo negro"]))
+    res = idx.search(["lanc"])
+    assert set(res) == {get_ie('ala blanca'), get_ie('conejo blanco')}
+    res = idx.search(["nej", "egr"])
+    assert set(res) == {get_ie('conejo negro')}
+
+
+def test_search_ngrams_not_contiguous(create_index):
+    """All the n-grams of the key are in the word, but not the key itself."""
+    idx = create_index(to_idx_data(["abcxbcd"]))
+    res = idx.search(["abcd"])
+    assert list(res) == []
+    res = idx.search(["xbcd"])
+    assert list(res) == [get_ie("abcxbcd")]
+
+
+# --- Test the ranking of the search.
+
+
+@pytest.fixture()
+def broad_search(create_index):
+    """A search with a lot of candidates, over several pages."""
+    titles = ["blanca {}".format(i) for i in range(1500)]
+    titles += ["casa blanca", "blanca", "la casa es blanca"]
+    idx = create_index(to_idx_data(titles))
+    with idx.connection() as db:
+        yield sqlite_index.Search(db, ["blanca"])
+
+
+def test_rank_top_same_as_full_order(broad_search):
+    """The bounded ranking gives the same results than sorting all the candidates."""
+    full = sorted(
+        ((broad_search.score(docid), docid) for docid in broad_search.candidates), reverse=True)
+    assert broad_search.ordered == full
+    for quantity in (1, 10, 333):
+        assert broad_search.top(quantity) == full[:quantity]
+
+
+def test_rank_top_early_termination(broad_search):
+    """Not all the candidates are scored for a small top."""
+    broad_search.top(10)
+    assert len(broad_search._scores) < len(broad_search.candidates)
+
+
+def test_rank_lazy_all_results(broad_search):
+    """Consuming the lazy ranking gives everything, in order."""
+    assert list(broad_search.ranked(7)) == broad_search.ordered
+
+
+def test_search_by_chunks(create_index, monkeypatch):
+    """The search is ranked by chunks, without holding a connection between them."""
+    monkeypatch.setattr(sqlite_index, "SEARCH_CHUNK", 2)
+    titles = ["blanca {}".format(i) for i in range(7)]
+    idx = create_index(to_idx_data(titles))
+    res = idx.search(["blanca"])
+    first = next(res)
+    assert idx._pool._idle.qsize() == 1
+    assert [first.title] + [entry.title for entry in res] == titles
+
+
+def test_search_ranked(create_index):
+    """The docids of all the results are given at once, in the order of the search."""
+    idx = create_index(to_idx_data(["ala blanca", "conejo blanco", "conejo negro"]))
+    corrections = {}
+    docids = idx.search_ranked(["cnoejo"], corrections)
+    assert [idx.get_doc(docid) for docid in docids] == list(idx.search(["cnoejo"]))
+    assert len(docids) == 2
+    assert corrections == {"cnoejo": "conejo"}
+
+
+def test_search_positions_only_for_survivors(create_index):
+    """The words positions are kept only for the documents having all the keys."""
+    idx = create_index(to_idx_data(["ala blanca", "conejo blanco", "conejo negro"]))
+    with idx.connection() as db:
+        search = sqlite_index.Search(db, ["conejo", "negro"])
+    assert len(search.candidates) == 1
+    assert list(search.docs) == search.candidates
+    assert search.docs[search.candidates[0]] == {0: "conejo", 1: "negro"}
+
+
+def test_levenshtein_values(create_index):
+    """The similitude of the phrases to the keys, the lower the more similar."""
+    idx = create_index(to_idx_data(["ala blanca"]))
+    with idx.connection() as db:
+        search = sqlite_index.Search(db, ["ala", "blanca"])
+    assert search.iterative_levenshtein(["ala", "blanca"]) == search.EXACT_MATCH
+    assert search.iterative_levenshtein(["alas", "blancas"]) == 30
+    assert search.iterative_levenshtein(["ala", "", "blanca"]) == 25
+    assert search.iterative_levenshtein(["blanca", "ala"]) == 225
+    assert search.iterative_levenshtein(["hala", "blanca", "x"]) == 55
+    assert search.iterative_levenshtein(["blanca"]) == 200
+
+
+def test_levenshtein_cached_by_phrase(create_index):
+    """The similitude is computed once for each phrase."""
+    idx = create_index(to_idx_data(["ala blanca"]))
+    with idx.connection() as db:
+        search = sqlite_index.Search(db, ["ala"])
+    first = search.iterative_levenshtein(["ala", "roja"])
+    search._costs.clear()
+    assert search.iterative_levenshtein(["ala", "roja"]) == first
+    assert search._costs == {}
+
+
+# --- Test the connections to the index.
+
+
+def test_connection_read_only(create_index):
+    """The index can not be modified through its connections."""
+    idx = create_index(to_idx_data(["ala blanca"]))
+    with idx.connection() as db:
+        with pytest.raises(sqlite3.OperationalError):
+            db.execute("DELETE FROM tokens")
+
+
+def test_connection_reused(create_index):
+    """Idle connections are lent again."""
+    idx = create_index(to_idx_data(["ala blanca"]))
+    with idx.connection() as db1:
+        pass
+    with idx.connection() as db2:
+        # a connection in use is not lent
+        with idx.connection() as db3:
+            pass
+    assert db1 is db2
+    assert db3 is not db2
+
+
+def test_connection_pool_size(tmpdir):
+    """No more than the pool size connections are kept idle."""
+    sqlite_index.Index.create(str(tmpdir), to_idx_data(["ala blanca"]))
+    idx = sqlite_index.Index(str(tmpdir), pool_size=1)
+    with idx.connection() as db1:
+        with idx.connection() as db2:
+            pass
+    # the first one returned to the pool is kept, the other closed
+    db2.execute("select 1")
+    with pytest.raises(sqlite3.ProgrammingError):
+        db1.execute("select 1")
+
+
+def test_connection_missing_index(tmpdir):
+    """Fail early if there is no index."""
+    with pytest.raises(sqlite3.OperationalError):
+        sqlite_index.Index(str(tmpdir))
+
+
+def test_search_concurrent(create_index):
+    """Searches from several threads at the same time."""
+    idx = create_index(to_idx_data(["ala blanca", "conejo blanco", "conejo negro"]))
+    results = []
+
+    def search():
+        for _ in range(20):
+            results.append(set(idx.search(["blanc"])))
+
+    threads = [threading.Thread(target=search) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(results) == 80
+    assert all(res == {get_ie('ala blanca'), get_ie('conejo blanco')} for res in results)
+
+
+# --- Test the index loaded in memory.
+
+
+def test_in_memory(tmpdir):
+    """The index is copied to memory and doesn't need the disk anymore."""
+    data = to_idx_data(["ala blanca", "conejo blanco", "conejo negro"])
+    sqlite_index.Index.create(str(tmpdir), data)
+    idx = sqlite_index.Index(str(tmpdir), in_memory=True)
+    os.remove(os.path.join(str(tmpdir), "index.sqlite"))
+    assert idx.in_memory
+    assert idx.memory_used() > 0
+    res = idx.search(["blanc"])
+    assert set(res) == {get_ie('ala blanca'), get_ie('conejo blanco')}
+
+
+def test_in_memory_read_only(tmpdir):
+    """The index in memory can not be modified."""
+    sqlite_index.Index.create(str(tmpdir), to_idx_data(["ala blanca"]))
+    idx = sqlite_index.Index(str(tmpdir), in_memory=True)
+    with idx.connection() as db:
+        with pytest.raises(sqlite3.OperationalError):
+            db.execute("DELETE FROM tokens")
+
+
+def test_in_memory_not_shared_cache(tmpdir):
+    """The connections to the index in memory have their own cache, so they don't lock
+    each other."""
+    sqlite_index.Index.create(str(tmpdir), to_idx_data(["ala blanca"]))
+    idx = sqlite_index.Index(str(tmpdir), in_memory=True)
+    with idx.connection() as db1, idx.connection() as db2:
+        assert db1 is not db2
+        assert "cache=shared" not in idx._pool._uri
+        assert "vfs=memdb" in idx._pool._uri
+        assert list(db1.execute("SELECT count(*) FROM tokens")) == list(
+            db2.execute("SELECT count(*) FROM tokens"))
+
+
+def test_in_memory_old_sqlite(tmpdir, monkeypatch):
+    """The index is not loaded in memory if SQLite can't share it between connections."""
+    monkeypatch.setattr(sqlite3, "sqlite_version_info", (3, 31, 1))
+    sqlite_index.Index.create(str(tmpdir), to_idx_data(["ala blanca"]))
+    idx = sqlite_index.Index(str(tmpdir), in_memory=True)
+    assert not idx.in_memory
+    assert list(idx.values()) == [get_ie("ala blanca")]
+
+
+def test_in_memory_separated(tmpdir):
+    """Different indexes in memory don't mix."""
+    dir1 = tmpdir.mkdir("one")
+    dir2 = tmpdir.mkdir("two")
+    sqlite_index.Index.create(str(dir1), to_idx_data(["ala blanca"]))
+    sqlite_index.Index.create(str(dir2), to_idx_data(["conejo negro"]))
+    idx1 = sqlite_index.Index(str(dir1), in_memory=True)
+    idx2 = sqlite_index.Index(str(dir2), in_memory=True)
+    assert list(idx1.values()) == [get_ie("ala blanca")]
+    assert list(idx2.values()) == [get_ie("conejo negro")]
+
+
+def test_warm_up(create_index):
+    """Decompress the first pages beforehand."""
+    titles = ["blanca {}".format(i) for i in range(sqlite_index.PAGE_SIZE + 1)]
+    idx = create_index(to_idx_data(titles))
+    assert idx.warm_up(10) == 2
+
+    # those pages are already in the cache
+    hits = idx._get_page.cache_info().hits
+    idx._get_page(0)
+    idx._get_page(1)
+    assert idx._get_page.cache_info().hits == hits + 2
+
+
+# --- Test the pages of documents.
+
+
+def test_docs_page_encode_decode():
+    """Entries are the same after storing them in a page."""
+    entries = [
+        IndexEntry(IndexEntry.TYPE_ORIG_ARTICLE, link='a/b/c/Abc', title='Ábc', score=12,
+                   description='una descripción'),
+        IndexEntry(IndexEntry.TYPE_ORIG_SIMPLE_LINK, link=None, title='Simple', score=3),
+        IndexEntry(IndexEntry.TYPE_REDIRECT, link=None, title=None, subtitle='otro título',
+                   orig_docid=70000),
+    ]
+    page = sqlite_index.DocsPage.decode(sqlite_index.DocsPage.encode(entries))
+    assert len(page) == 3
+    assert list(page) == entries
+    assert page[2] == entries[2]
+    with pytest.raises(IndexError):
+        page[3]
+
+
+# --- Test the suggestions for a prefix.
+
+
+def test_suggest_short_prefix(create_index):
+    """Suggest titles with a word starting with a short prefix."""
+    data = to_idx_data(["ala blanca", "conejo blanco", "conejo negro", "blindado"])
+    data[0][2] = 10
+    data[1][2] = 5
+    idx = create_index(data)
+    res = idx.suggest("bla")
+    assert [entry.title for entry in res] == ["ala blanca", "conejo blanco"]
+    assert idx.suggest("xyz") == []
+    assert idx.suggest("") == []
+
+
+def test_suggest_long_prefix(create_index):
+    """Suggest titles with a word starting with a long prefix, using the last word."""
+    idx = create_index(to_idx_data(["ala blanca", "conejo blanco", "conejo negro", "blindado"]))
+    res = idx.suggest("conejo Blanc")
+    assert set(res) == {get_ie("ala blanca"), get_ie("conejo blanco")}
+    assert idx.suggest("blancos") == []
+
+
+def test_suggest_quantity(create_index):
+    """Don't suggest more than the given quantity, the best ones."""
+    data = to_idx_data(["blanca {}".format(i) for i in range(30)])
+    for i, item in enumerate(data):
+        item[2] = i
+    idx = create_index(data)
+    res = idx.suggest("bl", quantity=5)
+    assert [entry.score for entry in res] == [29, 28, 27, 26, 25]
+    res = idx.suggest("blanc", quantity=5)
+    assert [entry.score for entry in res] == [29, 28, 27, 26, 25]
+
+
+def test_first_docids():
+    """Decode only the first docids of a docset."""
+    docset = sqlite_index.DocSet()
+    for docid in (3, 3, 7, 500, 501, 70000):
+        docset.append(docid, 0)
+    encoded = docset.encode()
+    assert sqlite_index.DocSet.first_docids(encoded, 3) == [3, 7, 500]
+    assert sqlite_index.DocSet.first_docids(encoded, 10) == [3, 7, 500, 501, 70000]
+
+
+# --- Test the budget of the searches.
+
+
+def test_first_postings():
+    """Keep only the first pairs of an encoded docset."""
+    docset = sqlite_index.DocSet()
+    for docid, position in ((3, 0), (3, 2), (7, 1), (500, 0), (70000, 4)):
+        docset.append(docid, position)
+    encoded = docset.encode()
+    first = sqlite_index.DocSet.decode(sqlite_index.DocSet.first_postings(encoded, 4))
+    assert list(first.items()) == [(3, [0, 2]), (7, [1]), (500, [0])]
+    assert sqlite_index.DocSet.first_postings(encoded, 5) == encoded
+    assert sqlite_index.DocSet.first_postings(encoded, 0) == b""
+
+
+def test_best_postings():
+    """Keep only the pairs of the best documents of an encoded docset, by their rank."""
+    docset = sqlite_index.DocSet()
+    for docid, position in ((3, 0), (3, 2), (7, 1), (500, 0), (70000, 4)):
+        docset.append(docid, position)
+    encoded = docset.encode()
+    ranks = {3: 4, 7: 2, 500: 9, 70000: 0}
+    best = sqlite_index.DocSet.best_postings(encoded, 3, ranks.__getitem__)
+    assert list(sqlite_index.DocSet.decode(best).items()) == [(7, [1]), (70000, [4])]
+    assert sqlite_index.DocSet.best_postings(encoded, 5, ranks.__getitem__) == encoded
+    assert sqlite_index.DocSet.best_postings(encoded, 0, ranks.__getitem__) == b""
+
+
+def test_limit_postings():
+    """The budget of postings is shared, cutting only the biggest docsets."""
+    tokens = []
+    for word, quantity in (("big", 100), ("small", 2), ("medium", 10)):
+        docset = sqlite_index.DocSet()
+        for docid in range(quantity):
+            docset.append(docid, 0)
+        tokens.append((word, docset.encode()))
+    assert sqlite_index.limit_postings(tokens, 200) == tokens
+    limited = sqlite_index.limit_postings(tokens, 20)
+    assert [word for word, _ in limited] == ["big", "small", "medium"]
+    sizes = [sqlite_index.DocSet.postings_quantity(encoded) for _, encoded in limited]
+    assert sizes == [9, 2, 9]
+    assert sqlite_index.DocSet.decode(limited[0][1]).docids() == list(range(9))
+
+
+def test_short_keys():
+    """Get the keys too short for the n-grams in a word."""
+    assert sqlite_index.short_keys("abab") == {"a", "b", "ab", "ba"}
+    assert sqlite_index.short_keys("a") == {"a"}
+
+
+@pytest.mark.parametrize("key", ["a", "ala"])
+def test_search_key_too_common(create_index, monkeypatch, key):
+    """If a key is in too many tokens only the ones starting with it are used."""
+    idx = create_index(to_idx_data(["ala", "alas", "sala", "cala", "bala", "palabra"]))
+    assert len(list(idx.search([key]))) == 6
+    monkeypatch.setattr(sqlite_index, "MAX_KEY_TOKENS", 3)
+    res = idx.search([key])
+    assert {entry.title for entry in res} == {"ala", "alas"}
+
+
+def test_search_postings_limited(create_index, monkeypatch):
+    """Only the first postings of the keys are used if they have too many."""
+    monkeypatch.setattr(sqlite_index, "MAX_KEY_POSTINGS", 3)
+    idx = create_index(to_idx_data(["blanca {}".format(i) for i in range(10)]))
+    res = idx.search(["blanca"])
+    assert [entry.title for entry in res] == ["blanca 0", "blanca 1", "blanca 2"]
+
+
+def test_search_postings_limited_updated(tmpdir, monkeypatch):
+    """In an updated index the postings of the best documents are used, not the first."""
+    monkeypatch.setattr(sqlite_index, "MAX_KEY_POSTINGS", 3)
+    titles = ["blanca {}".format(i) for i in range(10)]
+    sqlite_index.Index.create(str(tmpdir), scored_data([(title, 10) for title in titles]))
+    added = scored_data([("blanca nueva", 50)])
+    sqlite_index.Index.update(str(tmpdir), added, rescored={"blanca 7": 20})
+    idx = sqlite_index.Index(str(tmpdir))
+    res = idx.search(["blanca"])
+    assert [entry.title for entry in res] == ["blanca nueva", "blanca 7", "blanca 0"]
+
+
+def test_stored_params(tmpdir):
+    """The parameters used to create the index are kept."""
+    sqlite_index.Index.create(str(tmpdir), to_idx_data(["ala blanca"]))
+    assert sqlite_index.Index.stored_params(str(tmpdir)) == {
+        "fulltext_size": None, "fulltext_body": False, "shards": 1, "typos": True}
+    sqlite_index.Index.create(str(tmpdir.mkdir("other")), to_idx_data(["ala blanca"]),
+                              fulltext_size=1000, fulltext_text=str, shards=3, typos=False)
+    assert sqlite_index.Index.stored_params(str(tmpdir.join("other"))) == {
+        "fulltext_size": 1000, "fulltext_body": True, "shards": 3, "typos": False}
+
+
+def test_update_short_keys(tmpdir):
+    """The quantity of tokens having the short keys is kept when updating the index."""
+    sqlite_index.Index.create(str(tmpdir), to_idx_data(["ala", "sal"]))
+    sqlite_index.Index.update(str(tmpdir), to_idx_data(["bala", "sal"]))
+    db = sqlite3.connect(os.path.join(str(tmpdir), "index.sqlite"))
+    counts = dict(db.execute("SELECT key, tokens FROM short_keys").fetchall())
+    assert counts["al"] == 3
+    assert counts["b"] == 1
+    assert counts["s"] == 1
+
+
+def test_search_not_kept(create_index):
+    """Nothing of a search is kept after using it."""
+    idx = create_index(to_idx_data(["ala blanca", "conejo blanco", "conejo negro"]))
+    with idx.connection() as db:
+        search = sqlite_index.Search(db, ["blanc"])
+        assert len(list(search.ranked())) == 2
+    search_ref = weakref.ref(search)
+    del search
+    gc.collect()
+    assert search_ref() is None
+
+
+# --- Test the index creation with bounded memory.
+
+
+def test_create_spilling_postings(tmpdir):
+    """The index is the same when the postings are spilled to disk while creating it."""
+    titles = ["ala blanca", "conejo blanco", "conejo negro", "blanca ojeda", "caja blanca"]
+    dir1 = tmpdir.mkdir("memory")
+    dir2 = tmpdir.mkdir("spilled")
+    sqlite_index.Index.create(str(dir1), to_idx_data(titles))
+    sqlite_index.Index.create(str(dir2), to_idx_data(titles), max_postings=2)
+    idx1 = sqlite_index.Index(str(dir1))
+    idx2 = sqlite_index.Index(str(dir2))
+    assert list(idx1.items()) == list(idx2.items())
+    assert list(idx1.values()) == list(idx2.values())
+    assert list(idx1.search(["blanc"])) == list(idx2.search(["blanc"]))
+
+
+def test_sorted_by_score(tmpdir):
+    """Items are given by score, keeping the original order between equal scores."""
+    source = [("a", "", 1), ("b", "", 5), ("c", "", 1), ("d", "", 7), ("e", "", 5)]
+    quantity, items = sqlite_index.sorted_by_score(iter(source), str(tmpdir))
+    assert quantity == 5
+    assert [item[0] for item in items] == ["d", "b", "e", "a", "c"]
+
+
+def test_postings_runs(tmpdir):
+    """Postings are grouped by word after merging the runs."""
+    postings = sqlite_index.PostingsRuns(str(tmpdir), 3)
+    for word, docid, pos in [("b", 1, 0), ("a", 2, 1), ("b", 0, 1), ("c", 5, 0),
+                             ("a", 1, 0), ("b", 0, 0), ("a", 9, 2)]:
+        postings.append(word, docid, pos)
+    result = [(word, list(docset.items())) for word, docset in postings.docsets()]
+    assert result == [
+        ("a", [(1, [0]), (2, [1]), (9, [2])]),
+        ("b", [(0, [0, 1]), (1, [0])]),
+        ("c", [(5, [0])]),
+    ]
+
+
+@pytest.mark.parametrize('workers', (1, 3))
+def test_create_pages_in_order(tmpdir, workers):
+    """The pages compressed in other processes are stored in order."""
+    titles = ["blanca {}".format(i) for i in range(7 * sqlite_index.PAGE_SIZE + 3)]
+    data = to_idx_data(titles)
+    sqlite_index.Index.create(str(tmpdir), data, workers=workers)
+    idx = sqlite_index.Index(str(tmpdir))
+    assert len(idx) == len(titles)
+    assert [entry.title for entry in idx.values()] == titles
+
+
+# --- Test the incremental update of the index.
+
+
+def scored_data(titles_scores):
+    """Generate the data to create an index, with the given scores."""
+    data = to_idx_data(title for title, _ in titles_scores)
+    for item, (_, score) in zip(data, titles_scores):
+        item[2] = score
+    return data
+
+
+def test_update_same_as_create(tmpdir):
+    """Searching in an updated index gives the same as in one created with the final data."""
+    initial = [("ala blanca", 10), ("conejo blanco", 30), ("conejo negro", 20),
+               ("blanca ojeda", 5), ("caja blanca", 15)]
+    final = [("ala blanca", 10), ("conejo blanco", 3), ("conejo negro", 20),
+             ("caja blanca", 15), ("conejo blando", 25), ("zeta", 1), ("caja negra", 12)]
+    dir1 = tmpdir.mkdir("created")
+    dir2 = tmpdir.mkdir("updated")
+    sqlite_index.Index.create(str(dir1), scored_data(final))
+    sqlite_index.Index.create(str(dir2), scored_data(initial))
+    added = scored_data([("conejo blando", 25), ("zeta", 1), ("caja negra", 12)])
+    quantity = sqlite_index.Index.update(
+        str(dir2), added, removed=["blanca ojeda"], rescored={"conejo blanco": 3})
+    assert quantity == 3
+
+    idx1 = sqlite_index.Index(str(dir1))
+    idx2 = sqlite_index.Index(str(dir2))
+    assert idx2.ranked
+    assert set(idx1.values()) == set(idx2.values())
+    for keys in (["blanc"], ["conejo"], ["caja"], ["neg"], ["ojeda"], ["z"]):
+        assert list(idx1.search(keys)) == list(idx2.search(keys))
+    assert idx1.suggest("con") == idx2.suggest("con")
+    assert idx1.suggest("blan") == idx2.suggest("blan")
+    assert idx2.random() != get_ie("blanca ojeda")
+
+
+def test_update_prefixes_same_as_create(tmpdir, monkeypatch):
+    """The suggestions of an updated index are the ones of an index created with the final
+    data, even for the rescored and removed articles."""
+    monkeypatch.setattr(sqlite_index, "SUGGEST_STORED", 2)
+    initial = [("gato {}".format(i), 50 - i) for i in range(8)] + [("galgo", 40)]
+    final = [(title, score) for title, score in initial if title != "gato 0"]
+    final[5] = ("gato 6", 100)
+    final.append(("ganso", 45))
+    dir1 = tmpdir.mkdir("created")
+    dir2 = tmpdir.mkdir("updated")
+    sqlite_index.Index.create(str(dir1), scored_data(final))
+    sqlite_index.Index.create(str(dir2), scored_data(initial))
+    sqlite_index.Index.update(
+        str(dir2), scored_data([("ganso", 45)]), removed=["gato 0"], rescored={"gato 6": 100})
+
+    idx1 = sqlite_index.Index(str(dir1))
+    idx2 = sqlite_index.Index(str(dir2))
+    for prefix in ("g", "ga", "gat", "gal", "gan", "gato"):
+        assert idx1.suggest(prefix) == idx2.suggest(prefix)
+    assert [entry.title for entry in idx2.suggest("g")] == ["gato 6", "gato 1"]
+
+
+def test_update_removes_redirects(tmpdir):
+    """The redirects of a removed article are not found anymore."""
+    data = to_idx_data(["aaa", "abc", "bcd"])
+    data[0][-1] = {("zzz",)}
+    sqlite_index.Index.create(str(tmpdir), data)
+    sqlite_index.Index.update(str(tmpdir), [], removed=["aaa"])
+    idx = sqlite_index.Index(str(tmpdir))
+    assert list(idx.search(["z"])) == []
+    assert list(idx.search(["a"])) == [get_ie("abc")]
+    assert set(idx.values()) == {get_ie("abc"), get_ie("bcd")}
+
+
+def test_update_twice(tmpdir):
+    """An already updated index can be updated again, appending pages."""
+    titles = ["blanca {}".format(i) for i in range(sqlite_index.PAGE_SIZE - 3)]
+    sqlite_index.Index.create(str(tmpdir), to_idx_data(titles))
+    more_titles = ["blanca {}".format(i) for i in range(len(titles), len(titles) + 10)]
+    sqlite_index.Index.update(str(tmpdir), to_idx_data(more_titles), removed=["blanca 1"])
+    sqlite_index.Index.update(str(tmpdir), scored_data([("negra", 5)]), removed=["blanca 2"])
+    idx = sqlite_index.Index(str(tmpdir))
+    assert len(idx) == sqlite_index.PAGE_SIZE + 8
+    assert list(idx.search(["negra"])) == [IndexEntry(
+        rtype=IndexEntry.TYPE_ORIG_ARTICLE, title="negra", link="negra", score=5)]
+    values = [entry.title for entry in idx.values()]
+    assert values == [title for title in titles + more_titles + ["negra"]
+                      if title not in ("blanca 1", "blanca 2")]
+    res = idx.search(["blanca", "51"])
+    assert {entry.title for entry in res} == {
+        title for title in titles + more_titles if "51" in title}
+
+
+# --- Test the search in the full text of the articles.
+
+
+def fulltext_data():
+    """Data to create an index, with descriptions."""
+    data = to_idx_data(["ala blanca", "conejo blanco", "conejo negro", "caja"])
+    data[0][3] = "Un ala de un ave, tiene plumas blancas"
+    data[1][3] = "Un conejo que no es negro"
+    data[2][3] = "Conejo de color negro, como la pluma del cuervo y el cuervo mismo"
+    data[3][3] = "Recipiente para guardar cosas, hecho de cartón"
+    return data
+
+
+def test_fulltext_fallback(tmpdir):
+    """Search in the text of the articles when few titles are found."""
+    sqlite_index.Index.create(str(tmpdir), fulltext_data(), fulltext_size=1000)
+    idx = sqlite_index.Index(str(tmpdir))
+    assert idx.has_fulltext
+    # the word is in both, but the shortest text is more relevant
+    res = [entry.title for entry in idx.search(["pluma"])]
+    assert res == ["ala blanca", "conejo negro"]
+    res = [entry.title for entry in idx.search(["negro"])]
+    assert res == ["conejo negro", "conejo blanco"]
+    res = [entry.title for entry in idx.search(["cuervo", "conejo"])]
+    assert res == ["conejo negro"]
+
+
+def test_fulltext_not_created(create_index):
+    """The full text is not indexed by default."""
+    idx = create_index(fulltext_data())
+    assert not idx.has_fulltext
+    assert list(idx.search(["pluma"])) == []
+
+
+def test_fulltext_size_limit(tmpdir):
+    """Only the text of the most important articles is indexed, up to the limit."""
+    data = fulltext_data()
+    data[2][2] = 10
+    sqlite_index.Index.create(str(tmpdir), data, fulltext_size=20)
+    idx = sqlite_index.Index(str(tmpdir))
+    res = [entry.title for entry in idx.search(["pluma"])]
+    assert res == ["conejo negro"]
+
+
+def test_fulltext_size_limit_text_not_read(tmpdir):
+    """The text of the articles is not read once the limit is reached."""
+    read = []
+
+    def get_text(link):
+        read.append(link)
+        return "texto"
+
+    sqlite_index.Index.create(str(tmpdir), fulltext_data(), fulltext_size=50,
+                              fulltext_text=get_text)
+    assert read == ["ala blanca", "conejo blanco"]
+
+
+def test_fulltext_latency(tmpdir, monkeypatch):
+    """The search in the full text is interrupted if it takes too long."""
+    monkeypatch.setattr(sqlite_index, "FULLTEXT_CHECK_PERIOD", 1)
+    sqlite_index.Index.create(str(tmpdir), fulltext_data(), fulltext_size=1000)
+    idx = sqlite_index.Index(str(tmpdir), fulltext_latency=-1)
+    assert list(idx.search(["pluma"])) == []
+    res = [entry.title for entry in idx.search(["caja"])]
+    assert res == ["caja"]
+
+
+def test_fulltext_body(tmpdir):
+    """Index also the text given for the articles."""
+    bodies = {"caja": "Sirve para guardar plumas"}
+    sqlite_index.Index.create(str(tmpdir), fulltext_data(), fulltext_size=1000,
+                              fulltext_text=lambda link: bodies.get(link, ""))
+    idx = sqlite_index.Index(str(tmpdir))
+    res = {entry.title for entry in idx.search(["pluma"])}
+    assert res == {"conejo negro", "ala blanca", "caja"}
+
+
+def test_fulltext_update(tmpdir):
+    """The text of the added articles is indexed, the removed ones are not found."""
+    sqlite_index.Index.create(str(tmpdir), fulltext_data(), fulltext_size=1000)
+    added = to_idx_data(["pajaro"])
+    added[0][3] = "Animal con plumas"
+    sqlite_index.Index.update(str(tmpdir), added, removed=["conejo negro"])
+    idx = sqlite_index.Index(str(tmpdir))
+    res = {entry.title for entry in idx.search(["pluma"])}
+    assert res == {"ala blanca", "pajaro"}
+
+
+def test_fulltext_update_size_limit(tmpdir):
+    """The text of the added articles is indexed only while there is room for it, as in
+    the index created, or up to the new limit if given."""
+    sqlite_index.Index.create(str(tmpdir), fulltext_data(), fulltext_size=180)
+    added = to_idx_data(["pajaro", "gallina"])
+    added[0][3] = "Animal con plumas"
+    added[1][3] = "Ave de corral, con plumas"
+    read = []
+
+    def get_text(link):
+        read.append(link)
+        return ""
+
+    sqlite_index.Index.update(str(tmpdir), added, fulltext_text=get_text)
+    assert read == ["pajaro"]
+    idx = sqlite_index.Index(str(tmpdir))
+    res = {entry.title for entry in idx.search(["pluma"])}
+    assert res == {"ala blanca", "conejo negro", "pajaro"}
+
+    added = to_idx_data(["paloma"])
+    added[0][3] = "Ave con plumas"
+    sqlite_index.Index.update(str(tmpdir), added, fulltext_size=1000)
+    idx = sqlite_index.Index(str(tmpdir))
+    res = {entry.title for entry in idx.search(["pluma"])}
+    assert res == {"ala blanca", "conejo negro", "pajaro", "paloma"}
+
+
+# --- Test the typo tolerance.
+
+
+def test_deletes():
+    """Variants of the start of a word with deleted chars."""
+    assert sqlite_index.deletes("casa") == {"casa", "asa", "csa", "caa", "cas"}
+    assert sqlite_index.deletes("ab", 2) == {"ab", "a", "b", ""}
+    # only the start of long words is used
+    assert sqlite_index.deletes("conejitos") == sqlite_index.deletes("conejit")
+
+
+@pytest.mark.parametrize('word1, word2, distance', (
+    ("casa", "casa", 0),
+    ("casa", "caza", 1),
+    ("casa", "cas", 1),
+    ("casa", "cassa", 1),
+    ("casa", "csaa", 1),
+    ("casa", "perro", 5),
+    ("", "ab", 2),
+))
+def test_edit_distance(word1, word2, distance):
+    """Edit distance, counting transpositions."""
+    assert sqlite_index.edit_distance(word1, word2) == distance
+    assert sqlite_index.edit_distance(word2, word1) == distance
+
+
+def test_search_misspelled(create_index):
+    """Words close to a misspelled key are searched."""
+    idx = create_index(to_idx_data(
+        ["ala blanca", "conejo blanco", "conejo negro", "caja", "murcielago"]))
+    res = {entry.title for entry in idx.search(["cnoejo"])}
+    assert res == {"conejo blanco", "conejo negro"}
+    res = {entry.title for entry in idx.search(["conejo", "nefro"])}
+    assert res == {"conejo negro"}
+    res = {entry.title for entry in idx.search(["murcielagos"])}
+    assert res == {"murcielago"}
+    # too short, or too far
+    assert list(idx.search(["cja"])) == []
+    assert list(idx.search(["cinejp"])) == []
+
+
+def test_did_you_mean(create_index):
+    """Suggest the closest words, the most used ones first."""
+    idx = create_index(to_idx_data(["ala blanca", "conejo blanco", "conejo negro", "mapa"]))
+    assert idx.did_you_mean("Cnoejo negor") == "conejo negro"
+    assert idx.did_you_mean("blancx") == "blanca"
+    assert idx.did_you_mean("mapo") == "mapa"
+    assert idx.did_you_mean("conejo blanc") is None
+    assert idx.did_you_mean("xyzxyz") is None
+
+
+def test_did_you_mean_from_search(create_index):
+    """The search gives the corrections of the misspelled keys, to suggest them later."""
+    idx = create_index(to_idx_data(["ala blanca", "conejo blanco", "conejo negro", "mapa"]))
+    corrections = {}
+    res = idx.search(["Cnoejo", "negro"], corrections)
+    assert corrections == {"cnoejo": "conejo"}
+    assert [entry.title for entry in res] == ["conejo negro"]
+    with mock.patch.object(idx, "connection") as connection:
+        assert idx.did_you_mean("Cnoejo negro", corrections) == "conejo negro"
+        assert idx.did_you_mean("conejo negro", {}) is None
+    connection.assert_not_called()
+
+
+def test_update_misspelled(tmpdir):
+    """The new words are also found misspelled after updating the index."""
+    sqlite_index.Index.create(str(tmpdir), to_idx_data(["ala blanca", "conejo negro"]))
+    sqlite_index.Index.update(str(tmpdir), to_idx_data(["murcielago"]))
+    idx = sqlite_index.Index(str(tmpdir))
+    res = [entry.title for entry in idx.search(["murcilago"])]
+    assert res == ["murcielago"]
+
+
+def test_typos_disabled(tmpdir):
+    """Without the typos tolerance, the variants of the words are not stored."""
+    sqlite_index.Index.create(str(tmpdir), to_idx_data(["ala blanca", "conejo negro"]),
+                              typos=False)
+    sqlite_index.Index.update(str(tmpdir), to_idx_data(["murcielago"]))
+    idx = sqlite_index.Index(str(tmpdir))
+    assert idx._fetchall("SELECT count(*) FROM deletes") == [(0,)]
+    assert list(idx.search(["cnoejo"])) == []
+    assert list(idx.search(["murcilago"])) == []
+    assert idx.did_you_mean("cnoejo") is None
+    assert [entry.title for entry in idx.search(["conejo"])] == ["conejo negro"]
+
+
+@pytest.mark.parametrize('table', ('deletes', 'trigrams', 'prefixes', 'short_keys'))
+def test_tables_without_rowid(create_index, table):
+    """The keys of the tables are not stored twice, in the table and in an index of them."""
+    idx = create_index(to_idx_data(["ala blanca", "conejo negro"]))
+    sql = "SELECT count(*) FROM sqlite_master WHERE tbl_name = ? AND type = 'index'"
+    assert idx._fetchall(sql, (table,)) == [(0,)]
+
+
+# --- Test the phrases and proximity queries.
+
+
+@pytest.mark.parametrize('keys, expected', (
+    (["guerra", "civil"], (["guerra", "civil"], [], [])),
+    (['"guerra', 'civil"'], (["guerra", "civil"], [(0, 1)], [])),
+    (['la', '"guerra', 'civil', 'española"'], (["la", "guerra", "civil", "española"],
+                                               [(1, 2, 3)], [])),
+    (['"guerra"', 'civil'], (["guerra", "civil"], [], [])),
+    (['guerra', 'near/2', 'civil'], (["guerra", "civil"], [], [(0, 1, 2)])),
+    (['"guerra', 'civil"', 'near/0', 'paz'], (["guerra", "civil", "paz"], [(0, 1)],
+                                              [(1, 2, 0)])),
+    (['near/2', 'civil'], (["civil"], [], [])),
+    (['near', 'civil'], (["near", "civil"], [], [])),
+    (['"guerra', 'near/2', 'civil"'], (["guerra", "near/2", "civil"], [(0, 1, 2)], [])),
+))
+def test_parse_query(keys, expected):
+    """Separate the keys from the query operators."""
+    assert sqlite_index.parse_query(keys) == expected
+
+
+def test_search_phrase(create_index):
+    """The keys of a phrase must be consecutive, in order."""
+    idx = create_index(to_idx_data([
+        "guerra civil española", "civil guerra", "guerra fria civil", "guerra civilizada"]))
+    res = {entry.title for entry in idx.search(['"guerra', 'civil"'])}
+    assert res == {"guerra civil española", "guerra civilizada"}
+    res = {entry.title for entry in idx.search(['"civil', 'guerra"'])}
+    assert res == {"civil guerra"}
+    res = {entry.title for entry in idx.search(['"guerra', 'civil', 'esp"'])}
+    assert res == {"guerra civil española"}
+    assert list(idx.search(['"guerra', 'espa"'])) == []
+
+
+def test_search_near(create_index):
+    """The keys joined by the proximity operator can't be far away."""
+    idx = create_index(to_idx_data([
+        "guerra civil española", "civil guerra", "guerra fria civil", "guerra de la paz civil"]))
+    res = {entry.title for entry in idx.search(["guerra", "NEAR/0", "civil"])}
+    assert res == {"guerra civil española", "civil guerra"}
+    res = {entry.title for entry in idx.search(["guerra", "NEAR/1", "civil"])}
+    assert res == {"guerra civil española", "civil guerra", "guerra fria civil"}
+    res = {entry.title for entry in idx.search(["guerra", "near/5", "civil"])}
+    assert len(res) == 4
+
+
+@pytest.mark.parametrize('keys', (['"'], ['""'], ['near/2'], ['"', 'near/2', '"']))
+def test_search_only_operators(create_index, keys):
+    """A query without keys finds nothing."""
+    idx = create_index(to_idx_data(["guerra civil", "near"]))
+    assert list(idx.search(keys)) == []
+
+
+def test_intersect_no_keys(create_index):
+    """Nothing is found without the tokens of any key."""
+    idx = create_index(to_idx_data(["guerra civil"]))
+    with idx.connection() as db:
+        assert sqlite_index.Search(db, [])._intersect([]) == []
+
+
+def test_did_you_mean_with_operators(create_index):
+    """The query operators are kept when suggesting the closest words."""
+    idx = create_index(to_idx_data(["guerra civil", "pared"]))
+    assert idx.did_you_mean('"guerra civl" near/3 parde') == '"guerra civil" near/3 pared'
+
+
+# --- Test the index split in shards.
+
+
+@pytest.fixture()
+def sharded_indexes(tmpdir):
+    """Create the same index with and without shards."""
+
+    def f(data, shards=3):
+        dir1 = tmpdir.mkdir("single")
+        dir2 = tmpdir.mkdir("sharded")
+        sqlite_index.Index.create(str(dir1), data)
+        sqlite_index.Index.create(str(dir2), data, shards=shards)
+        return str(dir1), str(dir2)
+
+    return f
+
+
+def test_shards_created(sharded_indexes):
+    """The postings are split in the shards by ranges of docids."""
+    titles = ["blanca {}".format(i) for i in range(10)]
+    _, directory = sharded_indexes(to_idx_data(titles), shards=3)
+    idx = sqlite_index.Index(directory)
+    assert idx.shards == [0, 1, 2]
+    docids = []
+    for shardid in idx.shards:
+        db = sqlite3.connect(sqlite_index.shard_filename(directory, shardid))
+        rows = db.execute("SELECT docsets FROM tokens WHERE word = 'blanca'").fetchall()
+        docids.append(sqlite_index.DocSet.decode(rows[0][0]).docids())
+    assert docids == [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]]
+
+
+def test_shards_same_search(sharded_indexes):
+    """Searching in the shards gives the same results than in the whole index."""
+    data = scored_data([("blanca {}".format(i), i % 7) for i in range(60)])
+    data += scored_data([("conejo blanco", 3), ("conejo negro", 20), ("guerra civil", 9)])
+    dir1, dir2 = sharded_indexes(data, shards=4)
+    idx1 = sqlite_index.Index(dir1)
+    idx2 = sqlite_index.Index(dir2)
+    for keys in (["blanc"], ["conejo"], ["bla", "1"], ['"guerra', 'civil"'], ["cnoejo"],
+                 ["xyz"], ["blanca", "near/0", "5"]):
+        assert list(idx1.search(keys)) == list(idx2.search(keys))
+
+
+def test_shards_lazy_ranking(sharded_indexes, monkeypatch):
+    """All the results are given, even if more than the first asked quantity."""
+    monkeypatch.setattr(sqlite_index, "MAX_RESULTS", 1000)
+    titles = ["blanca {}".format(i) for i in range(700)]
+    _, directory = sharded_indexes(to_idx_data(titles), shards=2)
+    idx = sqlite_index.Index(directory)
+    assert len(list(idx.search(["blanca"]))) == 700
+
+
+def test_shards_update(sharded_indexes):
+    """The new postings are added to the last shard when updating the index."""
+    initial = scored_data([("conejo blanco", 3), ("conejo negro", 20), ("caja", 9)])
+    _, directory = sharded_indexes(initial, shards=2)
+    added = scored_data([("conejo pardo", 10), ("ala", 1)])
+    sqlite_index.Index.update(directory, added, removed=["conejo negro"])
+    idx = sqlite_index.Index(directory)
+    res = [entry.title for entry in idx.search(["conejo"])]
+    assert res == ["conejo pardo", "conejo blanco"]
+    assert [entry.title for entry in idx.search(["ala"])] == ["ala"]
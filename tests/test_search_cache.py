@@ -0,0 +1,235 @@
+# Copyright 2021 CDPedistas (see AUTHORS.txt)
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# For further info, check  https://github.com/PyAr/CDPedia/
+
+import json
+import os
+
+import pytest
+
+from src.web.search_cache import RESULT_OVERHEAD, SearchCache, SearchResult, SearchResults
+
+
+# the words of the fake results, by their ids
+_words = []
+
+
+def fake_get_result(docid):
+    """Return the fake result of an id."""
+    word = _words[docid]
+    return SearchResult("wiki/" + word, word, "")
+
+
+def fake_search(key):
+    """Give the id of a result for each word of the key, and then other ten (without
+    correction)."""
+    ranked = []
+    for word in list(key) + ["other{}".format(i) for i in range(10)]:
+        if word not in _words:
+            _words.append(word)
+        ranked.append(_words.index(word))
+    return ranked, None
+
+
+def fake_results(key):
+    """Return the results of the fake search."""
+    return [fake_get_result(docid) for docid in fake_search(key)[0]]
+
+
+def fake_cache(max_size, filename=None, search=fake_search):
+    """Return a cache of the fake search."""
+    return SearchCache(search, fake_get_result, max_size, filename)
+
+
+def test_results_lazy():
+    """The results are taken only as they are needed, searching only once."""
+    items = fake_results(())
+    ranked = fake_search(())[0]
+    searched = []
+    taken = []
+
+    def search():
+        searched.append(True)
+        return ranked, None
+
+    def get_result(docid):
+        taken.append(docid)
+        return fake_get_result(docid)
+
+    results = SearchResults(search, get_result)
+    assert searched == []
+    assert results[2:4] == items[2:4]
+    assert taken == ranked[:4]
+    assert results[0] == items[0]
+    assert not results.exhausted
+    assert results[3:] == items[3:]
+    assert results[-1] == items[-1]
+    assert results.exhausted
+    assert searched == [True]
+    assert taken == ranked
+
+
+def test_results_size():
+    """The size of the results grows as they are taken."""
+    results = SearchResults(
+        lambda: ([1, 2, 3], None), lambda docid: SearchResult("wiki/a", "a", "text"))
+    assert results.size == 0
+    results[:2]
+    assert results.size == 3 * 4 + 2 * (RESULT_OVERHEAD + 11)
+
+
+def test_cache_hits():
+    """The same search is taken from the cache."""
+    searched = []
+
+    def search(key):
+        searched.append(key)
+        return fake_search(key)
+
+    cache = fake_cache(10000, search=search)
+    results = cache.get(("foo",), "v1")
+    assert cache.get(("foo",), "v1") is results
+    assert cache.get(("bar",), "v1") is not results
+    assert searched == []  # nothing was needed yet
+    results[0]
+    cache.get(("foo",), "v1")[0]
+    cache.get(("bar",), "v1")[0]
+    assert searched == [("foo",), ("bar",)]
+    # the size is updated when getting results, before taking more of them
+    assert cache.stats() == {'hits': 3, 'misses': 2, 'searches': 2,
+                             'size': 11 * 4 + RESULT_OVERHEAD + 11}
+
+
+def test_cache_max_size():
+    """The least recently used results are discarded when there are too much of them."""
+    cache = fake_cache(3 * RESULT_OVERHEAD + 150)
+    cache.get(("a",), "v1")[:2]
+    cache.get(("b",), "v1")[:1]
+    cache.get(("a",), "v1")
+    cache.get(("c",), "v1")[:1]
+    assert list(cache._entries) == [("b",), ("a",), ("c",)]
+    # the size of the results is checked again when getting other ones
+    cache.get(("d",), "v1")
+    assert list(cache._entries) == [("a",), ("c",), ("d",)]
+    assert cache.stats()['size'] == 3 * RESULT_OVERHEAD + 7 + 17 + 7 + 2 * 11 * 4
+
+
+def test_cache_version_changed():
+    """All the results are discarded if the index changes."""
+    cache = fake_cache(10000)
+    results = cache.get(("foo",), "v1")
+    assert cache.get(("foo",), "v2") is not results
+    assert cache.stats()['misses'] == 2
+
+
+def test_cache_persisted(tmp_path):
+    """The results are saved, and the rest are taken after the loaded ones without
+    searching again."""
+    filename = str(tmp_path / "cache" / "search.json")
+    cache = fake_cache(10000, filename)
+    cache.get(("foo",), "v1")[:3]
+    cache.get(("bar",), "v1")[:20]
+    cache.save()
+
+    def search(key):
+        raise AssertionError("searched again")
+
+    taken = []
+
+    def get_result(docid):
+        taken.append(docid)
+        return fake_get_result(docid)
+
+    cache = SearchCache(search, get_result, 10000, filename)
+    foo = cache.get(("foo",), "v1")
+    assert foo[:3] == fake_results(("foo",))[:3]
+    assert cache.get(("bar",), "v1")[:] == fake_results(("bar",))
+    assert taken == []
+    assert foo[:5] == fake_results(("foo",))[:5]
+    assert taken == fake_search(("foo",))[0][3:5]
+    assert cache.stats()['hits'] == 2
+
+
+def test_cache_persisted_other_version(tmp_path):
+    """The loaded results are discarded if the index changed."""
+    filename = str(tmp_path / "search.json")
+    cache = fake_cache(10000, filename)
+    cache.get(("foo",), "v1")[:3]
+    cache.save()
+    cache = fake_cache(10000, filename)
+    cache.get(("foo",), "v2")
+    assert cache.stats()['hits'] == 0
+
+
+def test_cache_persisted_private(tmp_path):
+    """The results are saved as JSON, in a directory only accessible by the user."""
+    filename = tmp_path / "cache" / "search.json"
+    cache = fake_cache(10000, str(filename))
+    cache.get(("foo",), "v1")[:1]
+    cache.get(("bar",), "v1")
+    cache.save()
+    assert os.stat(str(tmp_path / "cache")).st_mode & 0o777 == 0o700
+    assert json.loads(filename.read_text()) == ["v1", [
+        [["foo"], fake_search(("foo",))[0], [["wiki/foo", "foo", ""]], None],
+        [["bar"], None, [], None]]]
+
+
+@pytest.mark.skipif(not hasattr(os, 'getuid'), reason="no owners of the files")
+def test_cache_shared_directory(tmp_path):
+    """The results are not loaded nor saved in a directory accessible by other users."""
+    filename = tmp_path / "cache" / "search.json"
+    cache = fake_cache(10000, str(filename))
+    cache.get(("foo",), "v1")[:1]
+    cache.save()
+    os.chmod(str(tmp_path / "cache"), 0o777)
+    cache = fake_cache(10000, str(filename))
+    cache.get(("foo",), "v1")
+    assert cache.stats()['hits'] == 0
+    filename.unlink()
+    cache.save()
+    assert not filename.exists()
+
+
+def test_cache_corrupted_file(tmp_path):
+    """A broken file is ignored."""
+    filename = tmp_path / "search.json"
+    filename.write_bytes(b"garbage")
+    cache = fake_cache(10000, str(filename))
+    assert cache.get(("foo",), "v1")[:1] == [SearchResult("wiki/foo", "foo", "")]
+
+
+def test_results_correction():
+    """The correction of the words is given by the search, and kept with the results."""
+    results = SearchResults(lambda: ([0], "fixed"), lambda docid: SearchResult("wiki/a", "a", ""))
+    assert results.correction is None
+    results[:1]
+    assert results.correction == "fixed"
+    assert results.size == 4 + RESULT_OVERHEAD + 7 + len("fixed")
+
+
+def test_cache_persisted_correction(tmp_path):
+    """The correction is saved with the results, so it's not searched again."""
+    filename = str(tmp_path / "search.json")
+    cache = fake_cache(10000, filename, search=lambda key: ([], "fixed"))
+    cache.get(("foo",), "v1")[:3]
+    cache.save()
+
+    def search(key):
+        raise AssertionError("searched again")
+
+    cache = fake_cache(10000, filename, search=search)
+    results = cache.get(("foo",), "v1")
+    assert results[:3] == []
+    assert results.correction == "fixed"
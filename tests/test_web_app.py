@@ -17,17 +17,23 @@
 # For further info, check  https://github.com/PyAr/CDPedia/
 
 
+import io
+import json
 import os
 import tarfile
+import wsgiref.handlers
+import wsgiref.util
 from unittest.mock import patch
 
 from werkzeug.test import Client
 from werkzeug.wrappers import Response
+from werkzeug.wsgi import FileWrapper
 
 import config
 from src.armado import cdpindex
 from src.armado.sqlite_index import IndexEntry
 from src.web import web_app, utils
+from src.web.search_cache import SearchResult, SearchResults
 from src.web.test_infra import TEST_INFRA_FILENAME
 
 import pytest
@@ -105,6 +111,34 @@ def test_images_not_found(create_app_client):
     assert response.status_code == 500
 
 
+@pytest.mark.parametrize('environ', (
+    {}, {'wsgi.file_wrapper': FileWrapper}, {'wsgi.file_wrapper': wsgiref.util.FileWrapper}))
+def test_images_found(create_app_client, environ):
+    app, client = create_app_client()
+    image = b'fake image' * 10000
+    app.img_mngr.get_item = lambda name: memoryview(image)
+    response = client.get("/images/foo/bar.png", environ_overrides=environ)
+    assert response.status_code == 200
+    assert response.headers["Content-type"] == "image/png"
+    assert response.headers["Content-Length"] == str(len(image))
+    assert response.data == image
+
+
+def test_images_wsgiref(create_app_client):
+    app, _ = create_app_client()
+    image = b'fake image' * 10000
+    app.img_mngr.get_item = lambda name: memoryview(image)
+    environ = {}
+    wsgiref.util.setup_testing_defaults(environ)
+    environ['PATH_INFO'] = '/images/foo/bar.png'
+    output = io.BytesIO()
+    handler = wsgiref.handlers.SimpleHandler(io.BytesIO(), output, io.StringIO(), environ)
+    handler.run(app)
+    headers, body = output.getvalue().split(b'\r\n\r\n', 1)
+    assert headers.startswith(b'HTTP/1.0 200 OK')
+    assert body == image
+
+
 def test_wiki_article_not_found(create_app_client):
     _, client = create_app_client()
     response = client.get("/wiki/this_article_does_not_exists")
@@ -183,20 +217,119 @@ def test_watchdog_on(create_app_client):
     assert b"watchdog" in response.data
 
 
+def fake_search_results(entries):
+    """Return the results of a search that gives those entries."""
+    results = [SearchResult(entry.link, entry.title, entry.description) for entry in entries]
+    return SearchResults(lambda: (list(range(len(results))), None), results.__getitem__)
+
+
 def test_search_endpoint_ok(create_app_client):
     _, client = create_app_client()
     with patch.object(web_app.CDPedia, '_search') as mock:
-        mock.return_value = [
+        mock.return_value = fake_search_results([
             IndexEntry(
                 IndexEntry.TYPE_ORIG_ARTICLE,
                 link='t/e/s/testlink', title='testtitle', description='testtext'),
-        ]
-        response = client.post("/search", data={"keywords": "foo bar"})
+        ])
+        response = client.get("/results/foo%20bar")
     assert response.status_code == 200
     mock.assert_called_once_with('foo bar')
     assert b'testlink' in response.data
     assert b'testtitle' in response.data
     assert b'testtext' in response.data
+    assert b'paging-results' not in response.data
+    assert response.cache_control.max_age == web_app.SEARCH_MAX_AGE
+
+
+def test_search_endpoint_redirect(create_app_client):
+    _, client = create_app_client()
+    response = client.post("/search", data={"keywords": "foo bar/baz"})
+    assert response.status_code == 302
+    assert response.location == "http://localhost/results/foo%20bar/baz"
+
+
+def test_search_endpoint_suggest_key(create_app_client):
+    _, client = create_app_client()
+    response = client.post("/search", data={"keywords": "suggest"}, follow_redirects=True)
+    assert response.status_code == 200
+    assert response.mimetype == 'text/html'
+    assert b'suggest' in response.data
+
+
+def test_search_endpoint_escaped(create_app_client):
+    _, client = create_app_client()
+    response = client.get("/results/%3Cscript%3Ealert(1)%3C%2Fscript%3E")
+    assert response.status_code == 200
+    assert b'<script>alert(1)</script>' not in response.data
+    assert b'&lt;script&gt;alert(1)&lt;/script&gt;' in response.data
+
+
+def test_search_endpoint_did_you_mean_escaped(create_app_client):
+    app, client = create_app_client()
+    app.index.did_you_mean = lambda text, corrections: '"><script>alert(1)</script>'
+    response = client.get("/results/kez1")
+    assert b'<script>' not in response.data
+    assert b'value="&#34;&gt;&lt;script&gt;' in response.data
+
+
+def test_search_endpoint_only_operators(create_app_client):
+    _, client = create_app_client()
+    response = client.get("/results/%22")
+    assert response.status_code == 200
+    assert b'search-result' not in response.data
+
+
+def test_search_endpoint_did_you_mean(create_app_client):
+    _, client = create_app_client()
+    response = client.post("/search", data={"keywords": "kez1"}, follow_redirects=True)
+    assert response.status_code == 200
+    assert b'class="did-you-mean"' in response.data
+    assert b'value="key1"' in response.data
+
+
+def test_search_endpoint_did_you_mean_once(create_app_client):
+    app, client = create_app_client()
+    with patch.object(app.index, 'did_you_mean', wraps=app.index.did_you_mean) as mock:
+        client.get("/results/key1")
+        assert mock.call_count == 0  # the key is in the index
+        first = client.get("/results/kez1")
+        second = client.get("/results/kez1")
+        assert mock.call_count == 1
+    assert b'value="key1"' in first.data
+    assert b'value="key1"' in second.data
+
+
+def test_search_endpoint_pages(mocker, create_app_client):
+    mocker.patch('config.SEARCH_RESULTS', 2)
+    _, client = create_app_client()
+    with patch.object(web_app.CDPedia, '_search') as mock:
+        mock.return_value = fake_search_results([
+            IndexEntry(IndexEntry.TYPE_ORIG_ARTICLE, link='t/e/s/link{}'.format(i),
+                       title='title{}'.format(i))
+            for i in range(5)])
+        first = client.get("/results/foo")
+        second = client.get("/results/foo?page=2")
+        last = client.get("/results/foo?page=3")
+    assert b'title1' in first.data and b'title2' not in first.data
+    assert b'href="/results/foo?page=2"' in first.data
+    assert b'?page=0' not in first.data
+    assert b'title2' in second.data and b'title3' in second.data
+    assert b'title1' not in second.data
+    assert b'href="/results/foo?page=1"' in second.data
+    assert b'href="/results/foo?page=3"' in second.data
+    assert b'title4' in last.data
+    assert b'?page=4' not in last.data
+
+
+def test_search_endpoint_pages_searched_once(mocker, create_app_client):
+    mocker.patch('config.SEARCH_RESULTS', 1)
+    app, client = create_app_client()
+    with patch.object(app.index, 'search_ranked', wraps=app.index.search_ranked) as mock:
+        first = client.get("/results/key")
+        second = client.get("/results/key?page=2")
+    assert mock.call_count == 1
+    assert b'Page2' in first.data and b'Page1' not in first.data
+    assert b'Page1' in second.data and b'Page2' not in second.data
 
 
 def test_search_endpoint_empty(create_app_client):
@@ -209,19 +342,20 @@ def test_search_endpoint_empty(create_app_client):
 def test_search_real_search(create_app_client):
     app = web_app.create_app(watchdog=None, with_static=False)
 
-    with patch.object(app.index, 'search') as index_mock:
-        index_mock.return_value = [
-            IndexEntry(
-                IndexEntry.TYPE_ORIG_ARTICLE, link='t/e/s/testlink1',
-                title='testtitle1', score=123, description='testtext1'),
-            IndexEntry(
-                IndexEntry.TYPE_ORIG_ARTICLE, link='t/e/s/testlink moño',
-                title='testtitle2', score=456, description='testtext2'),
-        ]
-        results = app._search("foo bar Moño")
-    index_mock.assert_called_once_with(['foo', 'bar', 'mono'])
+    entries = [
+        IndexEntry(
+            IndexEntry.TYPE_ORIG_ARTICLE, link='t/e/s/testlink1',
+            title='testtitle1', score=123, description='testtext1'),
+        IndexEntry(
+            IndexEntry.TYPE_ORIG_ARTICLE, link='t/e/s/testlink moño',
+            title='testtitle2', score=456, description='testtext2'),
+    ]
+    with patch.object(app.index, 'search_ranked') as index_mock:
+        index_mock.return_value = [1, 0]
+        with patch.object(app.index, 'get_doc', entries.__getitem__):
+            result2, result1 = app._search("foo bar Moño")[:]
+    index_mock.assert_called_once_with(['foo', 'bar', 'mono'], {})
 
-    result1, result2 = results
     assert result1.link == 'wiki/testlink1'
     assert result1.title == 'testtitle1'
     assert result1.description == 'testtext1'
@@ -230,16 +364,33 @@ def test_search_real_search(create_app_client):
     assert result2.description == 'testtext2'
 
 
+def test_search_cached_normalized(create_app_client):
+    app = web_app.create_app(watchdog=None, with_static=False)
+
+    entry = IndexEntry(IndexEntry.TYPE_ORIG_ARTICLE, link='t/e/s/testlink', title='testtitle')
+    with patch.object(app.index, 'search_ranked') as index_mock:
+        index_mock.return_value = [0]
+        with patch.object(app.index, 'get_doc', lambda docid: entry):
+            results1 = app._search("Moño  bar")
+            results1[0]
+            results2 = app._search(" mono BAR")
+            results2[0]
+    index_mock.assert_called_once_with(['mono', 'bar'], {})
+    assert results1 is results2
+    assert app.search_cache.hits == 1
+    assert app.search_cache.misses == 1
+
+
 def test_search_term_with_slash(create_app_client):
     app = web_app.create_app(watchdog=None, with_static=False)
 
-    with patch.object(app.index, 'search') as index_mock:
-        index_mock.return_value = [
-            IndexEntry(IndexEntry.TYPE_ORIG_ARTICLE, link='f/o/o/foo/bar', title='testtitle')
-        ]
-        results = app._search("foo/bar")
-    index_mock.assert_called_once_with(['foo/bar'])
-    assert results[0].link == 'wiki/foo%2Fbar'
+    entry = IndexEntry(IndexEntry.TYPE_ORIG_ARTICLE, link='f/o/o/foo/bar', title='testtitle')
+    with patch.object(app.index, 'search_ranked') as index_mock:
+        index_mock.return_value = [0]
+        with patch.object(app.index, 'get_doc', lambda docid: entry):
+            result = app._search("foo/bar")[0]
+    index_mock.assert_called_once_with(['foo/bar'], {})
+    assert result.link == 'wiki/foo%2Fbar'
 
 
 def test_on_tutorial(create_app_client):
@@ -291,3 +442,21 @@ def test_on_test_infra_data_ok(mocker, create_app_client):
 def test_get_origin_link(create_app_client):
     assert utils.get_orig_link('Python').endswith("/wiki/Python")
     assert utils.get_orig_link('"Love_and_Theft"').endswith("/wiki/%22Love_and_Theft%22")
+
+
+def test_search_suggest(create_app_client):
+    _, client = create_app_client()
+    response = client.get("/search/suggest?q=ke")
+    assert response.status_code == 200
+    assert response.headers["Content-type"] == "application/json"
+    assert json.loads(response.data.decode("utf8")) == [
+        {"title": "Page2", "link": "/wiki/page2"},
+        {"title": "Page1", "link": "/wiki/page1"},
+    ]
+
+
+def test_search_suggest_empty(create_app_client):
+    _, client = create_app_client()
+    response = client.get("/search/suggest?q=")
+    assert response.status_code == 200
+    assert json.loads(response.data.decode("utf8")) == []
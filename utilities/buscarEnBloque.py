@@ -33,6 +33,8 @@ def main(manager, nom_item, verbose):
     else:
         print("Returned item length", len(info))
         if verbose:
+            if isinstance(info, memoryview):
+                info = info.tobytes()
             print("Article:\n", repr(info))
 
 
@@ -20,11 +20,10 @@
 
 from __future__ import division, with_statement, print_function
 
-import operator
 import sys
 import os
 sys.path.append(os.getcwd())
-from src.armado.compresor import Comprimido, BloqueImagenes  # NOQA import after fixing path
+from src.armado.compresor import Comprimido, BloqueImagenes, Redirect  # NOQA import after fixing path
 
 
 def main(fname, a_extraer):
@@ -36,32 +35,40 @@ def main(fname, a_extraer):
         c = Comprimido(fname)
     print("From the header (%d bytes): %d files in total" % (c.header_size, len(c.header)))
 
-    # header: dict with k -> filename
-    #                  v -> (seek, size) or the name of the target
+    # header: only the hashes of the filenames are stored, with their
+    #         (seek, size) or the Redirect to the target
     archivos = []
     redirects = 0
-    for name, info in c.header.items():
-        if isinstance(info, str):
+    for name_hash, info in c.header.items():
+        if isinstance(info, Redirect):
             redirects += 1
         else:
             (seek, size) = info
-            archivos.append((name, seek, size))
+            archivos.append((seek, size, name_hash))
     print("    %d reales   %d redirects" % (len(archivos), redirects))
-    archivos.sort(key=operator.itemgetter(1))
-    size_archs = archivos[-1][1] + archivos[-1][2]  # del último, posic + largo
+    archivos.sort()
+    size_archs = archivos[-1][0] + archivos[-1][1]  # del último, posic + largo
 
     print("Overhead header: %.1f%%" % (100 * (4 + c.header_size) / size_archs))
     print("Net compression: at %.2f%%" % (100 * fsize / size_archs))
 
     if not a_extraer:
-        # showing the files inside
-        print("Files:")
-        for name, seek, size in archivos:
-            print("  ", name.encode("utf8"))
+        # showing the files inside (only the hashes of their names are in the header)
+        print("Files (hash, position, size):")
+        for seek, size, name_hash in archivos:
+            print("   %016x %10d %8d" % (name_hash, seek, size))
     else:
         # extract the indicated files
         for arch in a_extraer:
             print("Extracting", arch.encode("utf8"))
+            info = c.header.get(arch)
+            if info is None:
+                print("  not found")
+                continue
+            if isinstance(info, Redirect):
+                print("  redirect to %r (block %d, position %d, size %d)" % (
+                    info.target.encode("utf8"), info.block, info.position, info.size))
+                continue
             data = c.get_item(arch)
             with open(os.path.basename(arch), "wb") as fdest:
                 fdest.write(data)